@@ -1,13 +1,34 @@
-from flasgger import Swagger
+"""
+Inventory Management Service package
+
+Importing the package only builds the single Flask app, its configuration and
+the database extensions; the engines connect on first use. The routes and
+error handlers live in app.server: call register_routes(), or import
+app.server, to register them and thereby import the heavier request handling
+modules. Scripts that only use the models skip them.
+"""
+
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 
 app = Flask(__name__)
 
 # Load the confguration
 app.config.from_object('config')
 
-Swagger(app)
-db = SQLAlchemy(app)
+from app.admission_control import AdmissionController
+from app.docs import LazySwagger
+from app.replicas import RoutingSQLAlchemy
+from app.sharding import ShardRouter
+LazySwagger(app)
+db = RoutingSQLAlchemy(app)
+shards = ShardRouter(app, db)
+admission = AdmissionController(app)
+
+from app import models
+from app.repositories import Storage
+storage = Storage(app)
 
-from app import server, models
+def register_routes():
+    """ Imports app.server to register the routes and error handlers, and returns the app """
+    from app import server
+    return app
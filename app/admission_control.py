@@ -0,0 +1,280 @@
+"""
+Admission Control
+
+AdmissionController keeps a slow database from piling up requests behind
+the handlers. Before a request runs it is:
+
+  - rate limited per client with a token bucket refilled at ADMISSION_RATE
+    requests per second up to ADMISSION_BURST (429 when empty). The client
+    is the peer address, or behind ADMISSION_TRUSTED_PROXIES proxies the
+    X-Forwarded-For entry added by the nearest of them, as the entries
+    further left are set by the client itself
+  - admitted if fewer than ADMISSION_MAX_READS reads (GET, HEAD and OPTIONS) or
+    ADMISSION_MAX_WRITES writes are running, otherwise queued for up to
+    ADMISSION_QUEUE_TIMEOUT seconds behind at most ADMISSION_MAX_QUEUE
+    other requests, otherwise shed (503)
+  - given a deadline ADMISSION_DEADLINE seconds away. Statements the
+    request sends to the database after it are cancelled (503), and on
+    MySQL every SELECT is limited to the time left with a
+    MAX_EXECUTION_TIME hint. Queries run on the shard threads are not.
+
+Shed requests get a Retry-After header. Handlers decorated with
+@admission.unlimited skip all of it, those decorated with
+@admission.long_running skip the deadline. The deadline also ends when
+the handler returns, so streamed responses are not cut off. The limits are
+built from the config with the controller; reset() applies a changed one.
+"""
+
+import math
+import threading
+import time
+import sqlalchemy
+from flask import g, has_request_context, jsonify, request
+from flask_api import status
+from sqlalchemy.engine import Engine
+
+READ_METHODS = ['GET', 'HEAD', 'OPTIONS']
+READS = 'reads'
+WRITES = 'writes'
+# Clients whose token buckets are kept before idle ones are dropped
+MAX_CLIENTS = 10000
+# MySQL error of a statement interrupted by MAX_EXECUTION_TIME
+MYSQL_QUERY_TIMEOUT = 3024
+# Request globals
+SLOT = 'admission_slot'
+DEADLINE = 'admission_deadline'
+
+SERVICE_UNAVAILABLE_ERROR = 'Service Unavailable'
+TOO_MANY_REQUESTS_ERROR = 'Too Many Requests'
+OVERLOADED_MSG = 'The service is overloaded. Please retry later.'
+RATE_LIMITED_MSG = 'Too many requests from your client. Please retry later.'
+
+class DeadlineExceeded(Exception):
+    """ Raised when a request uses the database past its deadline """
+    pass
+
+class ConcurrencyLimit(object):
+    """ Lets up to limit requests run at once and up to max_queue more wait for a slot """
+
+    def __init__(self, limit, max_queue):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        """ Takes a slot, waiting up to timeout seconds; returns False if the request is shed """
+        with self.condition:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.shed += 1
+                return False
+            self.waiting += 1
+            self.queued += 1
+            give_up = time.time() + timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = give_up - time.time()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        """ Frees a slot for the next waiting request """
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def serialize(self):
+        """ Returns the limit and counters """
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed': self.shed
+        }
+
+class TokenBuckets(object):
+    """ A token bucket per client, refilled at rate tokens per second up to burst """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.limited = 0
+        self.lock = threading.Lock()
+
+    def take(self, client):
+        """ Takes a token of client; returns 0, or the seconds until one is available """
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets[client] = (tokens, now)
+                self.limited += 1
+                return (1 - tokens) / self.rate
+            if client not in self.buckets and len(self.buckets) >= MAX_CLIENTS:
+                self.drop_idle(now)
+            self.buckets[client] = (tokens - 1, now)
+            return 0
+
+    def drop_idle(self, now):
+        """ Forgets the clients whose buckets have refilled, or all of them if none has """
+        self.buckets = dict((client, (tokens, updated))
+                            for client, (tokens, updated) in self.buckets.items()
+                            if tokens + (now - updated) * self.rate < self.burst)
+        if len(self.buckets) >= MAX_CLIENTS:
+            self.buckets = {}
+
+class AdmissionController(object):
+    """ Limits the requests running at once and sheds the excess """
+
+    def __init__(self, app):
+        self.app = app
+        self.exempt = set(['static'])
+        self.no_deadline = set()
+        self.limits = None
+        self.buckets = None
+        self.deadlines_exceeded = 0
+        self.lock = threading.Lock()
+        app.config.setdefault('ADMISSION_MAX_READS', None)
+        app.config.setdefault('ADMISSION_MAX_WRITES', None)
+        app.config.setdefault('ADMISSION_MAX_QUEUE', 0)
+        app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 1.0)
+        app.config.setdefault('ADMISSION_RATE', None)
+        app.config.setdefault('ADMISSION_BURST', None)
+        app.config.setdefault('ADMISSION_DEADLINE', None)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+        app.config.setdefault('ADMISSION_TRUSTED_PROXIES', 0)
+        self.reset()
+        app.before_request(self.admit)
+        app.after_request(self.end_deadline)
+        app.teardown_request(self.release)
+
+    def unlimited(self, function):
+        """ Decorator exempting a handler from admission control """
+        self.exempt.add(function.__name__)
+        return function
+
+    def long_running(self, function):
+        """ Decorator exempting a handler from the request deadline """
+        self.no_deadline.add(function.__name__)
+        return function
+
+    def reset(self):
+        """ Applies the configuration and zeroes the counters """
+        config = self.app.config
+        limits = {}
+        for route_class, limit in [(READS, config['ADMISSION_MAX_READS']),
+                                   (WRITES, config['ADMISSION_MAX_WRITES'])]:
+            if limit is not None:
+                limits[route_class] = ConcurrencyLimit(limit, config['ADMISSION_MAX_QUEUE'])
+        buckets = None
+        if config['ADMISSION_RATE']:
+            buckets = TokenBuckets(config['ADMISSION_RATE'],
+                                   config['ADMISSION_BURST'] or config['ADMISSION_RATE'])
+        # running requests see either the old or the new limits, never half of them
+        with self.lock:
+            self.limits = limits
+            self.buckets = buckets
+            self.deadlines_exceeded = 0
+
+    def client(self):
+        """ Returns the address of the client of the request, skipping the trusted proxies """
+        proxies = self.app.config['ADMISSION_TRUSTED_PROXIES']
+        if proxies:
+            forwarded = [address.strip() for address
+                         in request.headers.get('X-Forwarded-For', '').split(',')]
+            if len(forwarded) >= proxies and forwarded[-proxies]:
+                return forwarded[-proxies]
+        return request.remote_addr
+
+    def admit(self):
+        """ Rate limits, admits or sheds the request and sets its deadline """
+        if request.endpoint in self.exempt:
+            return None
+        config = self.app.config
+        if self.buckets is not None:
+            wait = self.buckets.take(self.client())
+            if wait:
+                return reject(status.HTTP_429_TOO_MANY_REQUESTS, TOO_MANY_REQUESTS_ERROR,
+                              RATE_LIMITED_MSG, int(math.ceil(wait)))
+
+        limit = self.limits.get(READS if request.method in READ_METHODS else WRITES)
+        if limit is not None:
+            if not limit.acquire(config['ADMISSION_QUEUE_TIMEOUT']):
+                return reject(status.HTTP_503_SERVICE_UNAVAILABLE, SERVICE_UNAVAILABLE_ERROR,
+                              OVERLOADED_MSG, config['ADMISSION_RETRY_AFTER'])
+            setattr(g, SLOT, limit)
+        if config['ADMISSION_DEADLINE'] is not None and request.endpoint not in self.no_deadline:
+            setattr(g, DEADLINE, time.time() + config['ADMISSION_DEADLINE'])
+        return None
+
+    @staticmethod
+    def end_deadline(response):
+        """ Lifts the deadline once the handler has returned """
+        g.pop(DEADLINE, None)
+        return response
+
+    @staticmethod
+    def release(exception=None):
+        """ Frees the slot of the request """
+        limit = g.pop(SLOT, None)
+        if limit is not None:
+            limit.release()
+
+    def count_deadline_exceeded(self):
+        """ Counts a request cancelled by its deadline """
+        with self.lock:
+            self.deadlines_exceeded += 1
+
+    def serialize(self):
+        """ Returns the counters of the limits """
+        stats = dict((route_class, limit.serialize()) for route_class, limit in self.limits.items())
+        stats['rate_limited'] = self.buckets.limited if self.buckets is not None else 0
+        stats['deadline_exceeded'] = self.deadlines_exceeded
+        return stats
+
+def reject(status_code, error, message, retry_after):
+    """ Returns the response of a request that is not admitted """
+    response = jsonify(status=status_code, error=error, message=message)
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@sqlalchemy.event.listens_for(Engine, 'before_cursor_execute', retval=True)
+def enforce_deadline(conn, cursor, statement, parameters, context, executemany):
+    """ Cancels the statements of a request past its deadline """
+    if not has_request_context() or g.get(DEADLINE) is None:
+        return statement, parameters
+    remaining = getattr(g, DEADLINE) - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded('The request ran past its deadline')
+    if conn.dialect.name == 'mysql' and statement.lstrip()[:6].upper() == 'SELECT':
+        statement = 'SELECT /*+ MAX_EXECUTION_TIME({}) */{}'.format(
+            int(remaining * 1000) + 1, statement.lstrip()[6:])
+    return statement, parameters
+
+@sqlalchemy.event.listens_for(Engine, 'handle_error')
+def interrupted_by_deadline(context):
+    """ Turns a MySQL statement interrupted by MAX_EXECUTION_TIME into DeadlineExceeded """
+    error_args = getattr(context.original_exception, 'args', None)
+    if error_args and error_args[0] == MYSQL_QUERY_TIMEOUT:
+        return DeadlineExceeded(error_args[-1])
+    return None
@@ -0,0 +1,173 @@
+"""
+Static Asset Pipeline
+
+Build the admin UI assets once per release with:
+    python -m app.assets [--base-url URL] [ASSET_DIR]
+The buildpack runs it from bin/post_compile when the app is staged, so
+instances start without building.
+
+The build copies every file under app/static/css and app/static/js to the
+asset directory (app/assets by default) under a name containing a hash of its
+content, stores gzip (and brotli, if the brotli module is installed) variants
+next to it and writes index.html with its references rewritten to the
+fingerprinted names under the base URL (ASSET_BASE_URL, or assets/).
+
+Upload the asset directory to a CDN or static file server and build with its
+URL as the base URL to take the assets off the Python workers entirely; they
+only serve index.html then. Otherwise /assets/ serves the build itself.
+Fingerprinted assets never change, so they are served with an immutable
+one-year Cache-Control and browsers do not request them again. index.html is
+revalidated on every load by its ETag. Both are served in the best encoding
+the client accepts. Without a build, index.html is served from app/static as
+before.
+"""
+
+from __future__ import print_function
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+import sys
+from flask import abort, current_app, request, safe_join, send_file
+
+try:
+    import brotli
+except ImportError:  # brotli variants are optional
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DEFAULT_ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+ASSET_SOURCES = ['css', 'js']
+INDEX = 'index.html'
+MANIFEST = 'manifest.json'
+# URL prefix of the fingerprinted assets
+ASSET_URL = 'assets/'
+STATIC_URL = 'static/'
+# Encodings of the precompressed variants, preferred first, and their file suffixes
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_manifests = {}
+
+def get_asset_dir():
+    """ Returns the directory of the built assets """
+    return current_app.config.get('ASSET_DIR') or DEFAULT_ASSET_DIR
+
+def fingerprint(path, content):
+    """ Returns path with a hash of content inserted before its extension """
+    root, extension = os.path.splitext(path)
+    if root.endswith('.min'):
+        root, extension = root[:-len('.min')], '.min' + extension
+    return '{}.{}{}'.format(root, hashlib.md5(content).hexdigest()[:10], extension)
+
+def compress_gzip(content):
+    """ Returns content compressed with gzip, byte for byte the same on every build """
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=9, mtime=0) as gz_file:
+        gz_file.write(content)
+    return buf.getvalue()
+
+def write_asset(asset_dir, path, content):
+    """ Writes an asset and its precompressed variants """
+    target = os.path.join(asset_dir, path)
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    with open(target, 'wb') as asset_file:
+        asset_file.write(content)
+    with open(target + '.gz', 'wb') as asset_file:
+        asset_file.write(compress_gzip(content))
+    if brotli is not None:
+        with open(target + '.br', 'wb') as asset_file:
+            asset_file.write(brotli.compress(content))
+
+def build(asset_dir=DEFAULT_ASSET_DIR, base_url=ASSET_URL):
+    """ Builds the fingerprinted and precompressed assets into asset_dir, linked under base_url """
+    if os.path.isdir(asset_dir):
+        shutil.rmtree(asset_dir)
+    manifest = {}
+    for source in ASSET_SOURCES:
+        for dirpath, _, filenames in os.walk(os.path.join(STATIC_DIR, source)):
+            for filename in sorted(filenames):
+                path = os.path.relpath(os.path.join(dirpath, filename), STATIC_DIR)
+                path = path.replace(os.sep, '/')
+                with open(os.path.join(STATIC_DIR, path), 'rb') as asset_file:
+                    content = asset_file.read()
+                manifest[path] = fingerprint(path, content)
+                write_asset(asset_dir, manifest[path], content)
+
+    with open(os.path.join(STATIC_DIR, INDEX), 'rb') as index_file:
+        index = index_file.read().decode('utf-8')
+    for path, fingerprinted in manifest.items():
+        index = index.replace(STATIC_URL + path, base_url + fingerprinted)
+    write_asset(asset_dir, INDEX, index.encode('utf-8'))
+    with open(os.path.join(asset_dir, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
+
+def load_manifest(asset_dir):
+    """ Returns the set of fingerprinted paths of a build, or None if there is no build """
+    if asset_dir not in _manifests:
+        path = os.path.join(asset_dir, MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path) as manifest_file:
+            _manifests[asset_dir] = set(json.load(manifest_file).values())
+    return _manifests[asset_dir]
+
+def send_asset_file(asset_dir, filename):
+    """ Sends a built file in the best precompressed encoding the client accepts """
+    path = safe_join(asset_dir, filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.exists(path + suffix):
+            response = send_file(path + suffix, mimetype=mimetype, conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def send_index():
+    """ Sends the built index.html, revalidated on every load, or the source one without a build """
+    asset_dir = get_asset_dir()
+    if load_manifest(asset_dir) is None:
+        return current_app.send_static_file(INDEX)
+    response = send_asset_file(asset_dir, INDEX)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def send_asset(filename):
+    """ Sends a fingerprinted asset with an immutable Cache-Control """
+    asset_dir = get_asset_dir()
+    manifest = load_manifest(asset_dir)
+    if manifest is None or filename not in manifest:
+        abort(404)
+    response = send_asset_file(asset_dir, filename)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+def main(argv):
+    """ Builds the assets into the given directory or app/assets """
+    parser = argparse.ArgumentParser(prog='python -m app.assets',
+                                     description='Build the fingerprinted admin UI assets.')
+    parser.add_argument('asset_dir', nargs='?', default=DEFAULT_ASSET_DIR,
+                        help='the directory to build into (default: app/assets)')
+    parser.add_argument('--base-url', default=os.getenv('ASSET_BASE_URL') or ASSET_URL,
+                        help='the URL index.html links the assets under, like a CDN '
+                             '(default: ASSET_BASE_URL or assets/)')
+    args = parser.parse_args(argv)
+    base_url = args.base_url if args.base_url.endswith('/') else args.base_url + '/'
+    manifest = build(args.asset_dir, base_url)
+    for path in sorted(manifest):
+        print("{} -> {}".format(path, manifest[path]))
+    if brotli is None:
+        print("brotli is not installed, only gzip variants were written")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,162 @@
+"""
+Batch Operations
+
+Applies an ordered list of create, update and restock operations with one
+commit. Every operation is validated like the single product endpoints and
+sees the products as left by the operations before it. If one of them
+fails, none is applied. With shards a commit only spans one shard, so a
+batch must only write products of one shard to stay all or nothing; one
+spanning several is rejected before anything is read.
+
+The products the operations refer to are read with one query before the
+first operation runs, and the data of every operation is validated against
+the schema of its kind before that, in one pass: a batch with invalid data
+is rejected with the errors of all the invalid operations, without reading
+any product. Operations look like:
+    {"op": "create", "data": {"prod_id": 1, "prod_name": "foo", ...}}
+    {"op": "update", "prod_id": 1, "data": {"new_qty": 5}, "if_match": "2"}
+    {"op": "restock", "prod_id": 1, "data": {"restock_amt": 10}}
+"""
+
+from collections import OrderedDict
+from flask_api import status
+from app import shards
+from app.models import CREATE, DataValidationError, INVALID_MSG, INVALID_RESTOCK_MSG, NEW_QTY, \
+    PROD_ID, RESTOCK, RESTOCK_AMT, UPDATE, ProductInformation, validate_product, \
+    validate_restock, validate_update
+from app.schema import is_integer
+
+OPERATIONS = [CREATE, UPDATE, RESTOCK]
+MAX_OPERATIONS = 1000
+# Keys of an operation
+OP = 'op'
+DATA = 'data'
+IF_MATCH = 'if_match'
+INDEX = 'index'
+MESSAGE = 'message'
+# Validators of the data of each kind of operation
+VALIDATORS = {
+    CREATE: validate_product,
+    UPDATE: validate_update,
+    RESTOCK: validate_restock
+}
+
+INVALID_OPERATION_MSG = "Invalid operation: give 'op' (create, update or restock), " \
+        "'prod_id' (but for create) and 'data'"
+EXISTS_MSG = "Product with id '{}' already exists"
+NOT_FOUND_MSG = "Product with id '{}' was not found in Inventory"
+PRECONDITION_FAILED_MSG = "Product with id '{}' does not match if_match"
+SHARDS_MSG = 'The products of a batch must be on one shard, these are on shards {}'
+
+class BatchError(Exception):
+    """ Raised when an operation of a batch cannot be applied """
+
+    def __init__(self, index, status_code, message, errors=None):
+        Exception.__init__(self, message)
+        self.index = index
+        self.status_code = status_code
+        self.message = message
+        self.errors = errors or [{INDEX: index, MESSAGE: message}]
+
+def apply_batch(operations):
+    """
+    Applies operations in one transaction and returns the result of each.
+
+    Args:
+        operations (list): the operations, in the order to apply them
+    Raises BatchError for the first operation that fails, after rolling back, or
+    listing all the operations with invalid data.
+    """
+    values = validate_operations(operations)
+    prod_ids = set(operation[PROD_ID] for operation in operations if operation[OP] != CREATE)
+    prod_ids.update(operation[DATA][PROD_ID] for operation in operations
+                    if operation[OP] == CREATE)
+    if shards.enabled():
+        indexes = sorted(set(shards.shard_of(prod_id) for prod_id in prod_ids))
+        if len(indexes) > 1:
+            raise BatchError(0, status.HTTP_400_BAD_REQUEST,
+                             SHARDS_MSG.format(', '.join(str(index) for index in indexes)))
+    products = dict((prod_info.prod_id, prod_info)
+                    for prod_info in ProductInformation.find_many(list(prod_ids)))
+    created = set()
+    # change_seq follows the order the products are first written in
+    changed = OrderedDict()
+    try:
+        results = [apply_operation(index, operation, values[index], products, created, changed)
+                   for index, operation in enumerate(operations)]
+        # a product created by the batch is a create in the change feed
+        for prod_id in created:
+            changed[prod_id].change_type = CREATE
+        ProductInformation.save_all(list(changed.values()))
+    except Exception:
+        ProductInformation.rollback(*set(shards.session_for(prod_id) for prod_id in prod_ids))
+        raise
+    return results
+
+def validate_operations(operations):
+    """
+    Validates every operation and its data in one pass and returns the values
+    of the data, or raises a BatchError with the index and message of every
+    invalid operation.
+    """
+    values = []
+    errors = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get(OP) not in OPERATIONS or \
+                not isinstance(operation.get(DATA), dict) or \
+                (operation[OP] != CREATE and not is_integer(operation.get(PROD_ID))):
+            errors.append({INDEX: index, MESSAGE: INVALID_OPERATION_MSG})
+            continue
+        data_values, data_errors = VALIDATORS[operation[OP]](operation[DATA])
+        values.append(data_values)
+        if data_errors:
+            message = INVALID_RESTOCK_MSG if operation[OP] == RESTOCK \
+                else INVALID_MSG + ', '.join(data_errors)
+            errors.append({INDEX: index, MESSAGE: message})
+    if errors:
+        raise BatchError(errors[0][INDEX], status.HTTP_400_BAD_REQUEST, errors[0][MESSAGE],
+                         errors)
+    return values
+
+def apply_operation(index, operation, values, products, created, changed):
+    """ Applies one operation with the validated values of its data and returns its result """
+    if operation[OP] == CREATE:
+        prod_info = ProductInformation().assign(values)
+        if prod_info.prod_id in products:
+            raise BatchError(index, status.HTTP_400_BAD_REQUEST,
+                             EXISTS_MSG.format(prod_info.prod_id))
+        products[prod_info.prod_id] = prod_info
+        created.add(prod_info.prod_id)
+        status_code = status.HTTP_201_CREATED
+    else:
+        prod_info = products.get(operation[PROD_ID])
+        if prod_info is None:
+            raise BatchError(index, status.HTTP_404_NOT_FOUND,
+                             NOT_FOUND_MSG.format(operation[PROD_ID]))
+        if_match = operation.get(IF_MATCH)
+        if if_match is not None and str(if_match).strip('"') != prod_info.etag():
+            raise BatchError(index, status.HTTP_412_PRECONDITION_FAILED,
+                             PRECONDITION_FAILED_MSG.format(prod_info.prod_id))
+        try:
+            if operation[OP] == UPDATE:
+                prod_info.assign_update(values)
+                if NEW_QTY in values:
+                    # set outright, so no earlier automatic restock is left in it
+                    prod_info.restocked = 0
+            else:
+                prod_info.restock(values[RESTOCK_AMT])
+        except DataValidationError as error:
+            raise BatchError(index, status.HTTP_400_BAD_REQUEST, error.args[0])
+        status_code = status.HTTP_200_OK
+
+    try:
+        prod_info.restock_if_needed()
+    except DataValidationError as error:
+        raise BatchError(index, status.HTTP_400_BAD_REQUEST, error.args[0])
+    changed[prod_info.prod_id] = prod_info
+    return {
+        OP: operation[OP],
+        PROD_ID: prod_info.prod_id,
+        'status': status_code,
+        DATA: prod_info.serialize()
+    }
@@ -0,0 +1,231 @@
+"""
+Bulk Import
+
+Loads products from CSV (with a header row of ProductInformation fields) or
+newline delimited JSON. The input is read a line at a time and written a
+chunk of rows per transaction, so files of any size are imported in
+constant memory. The rows of a chunk are validated against the product schema
+in one pass; invalid rows are skipped and reported with their line number and
+all their errors.
+
+In insert mode rows with an existing prod_id are rejected, in upsert mode
+they replace the stored product, unless they leave fewer products than its
+reservations hold.
+
+Import a file from the command line with:
+    python -m app.bulk_import [--upsert] [--chunk-size N] FILE
+"""
+
+from __future__ import print_function
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+from sqlalchemy.exc import SQLAlchemyError
+from app import shards
+from app.models import DataValidationError, FIELDS, INVALID_MSG, PROD_NAME, RESERVED_COLUMNS, \
+    ProductInformation, ReservedQuantityError, validate_product
+from app.schema import validate_all
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+INSERT = 'insert'
+UPSERT = 'upsert'
+DEFAULT_CHUNK_SIZE = 1000
+# Per row errors beyond this number are counted but not reported
+MAX_REPORTED_ERRORS = 1000
+
+EXISTS_MSG = "Product with id '{}' already exists"
+INVALID_ROW_MSG = 'Invalid row: {}'
+UNKNOWN_COLUMNS_MSG = 'Unknown CSV columns: {}'
+NOT_AN_OBJECT_MSG = 'Invalid row: expected a JSON object'
+
+logger = logging.getLogger(__name__)
+
+class ImportReport(object):
+    """ Counts the imported and failed rows of an import """
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, line, message):
+        """ Records a row that could not be imported """
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def serialize(self):
+        """ Serializes the report into a dictionary """
+        return {
+            'rows': self.rows,
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors
+        }
+
+def text(value):
+    """ Returns a value read by the csv module as unicode text """
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def decode_lines(lines):
+    """ Yields the lines of a binary stream as the str the csv and json modules expect """
+    for line in lines:
+        yield line if isinstance(line, str) else line.decode('utf-8')
+
+def read_csv(lines):
+    """ Yields (line number, row or error message) for the records of a CSV stream """
+    reader = csv.reader(decode_lines(lines))
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [column.strip() for column in header]
+    unknown = [column for column in header if column not in FIELDS]
+    if unknown:
+        raise DataValidationError(UNKNOWN_COLUMNS_MSG.format(', '.join(unknown)))
+    for record in reader:
+        if not record:
+            continue
+        row = {}
+        try:
+            for column, value in zip(header, record):
+                if column == PROD_NAME:
+                    row[column] = text(value)
+                elif value.strip():
+                    row[column] = int(value)
+        except ValueError as error:
+            yield reader.line_num, INVALID_ROW_MSG.format(error)
+            continue
+        yield reader.line_num, row
+
+def read_ndjson(lines):
+    """ Yields (line number, row or error message) for the lines of an NDJSON stream """
+    for line_num, line in enumerate(decode_lines(lines), 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_num, INVALID_ROW_MSG.format(error)
+            continue
+        if not isinstance(row, dict):
+            yield line_num, NOT_AN_OBJECT_MSG
+            continue
+        yield line_num, row
+
+READERS = {CSV: read_csv, NDJSON: read_ndjson}
+
+def import_rows(rows, mode=INSERT, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Imports (line number, row or error message) pairs a chunk at a time.
+
+    Args:
+        rows: an iterable of the pairs, like read_csv() or read_ndjson() return
+        mode (string): insert or upsert
+        chunk_size (int): the number of rows written per transaction
+        progress: called with the report after every chunk
+    Returns the ImportReport.
+    """
+    report = ImportReport()
+    chunk = []
+    for line, row in rows:
+        report.rows += 1
+        if not isinstance(row, dict):
+            report.add_error(line, row)
+            continue
+        chunk.append((line, row))
+        if len(chunk) == chunk_size:
+            import_chunk(chunk, mode, report)
+            chunk = []
+            if progress is not None:
+                progress(report)
+    if chunk:
+        import_chunk(chunk, mode, report)
+        if progress is not None:
+            progress(report)
+    return report
+
+def import_chunk(chunk, mode, report):
+    """ Validates a chunk of rows and saves the valid ones in one transaction """
+    results, invalid = validate_all(validate_product, [row for _, row in chunk])
+    for index, errors in invalid:
+        report.add_error(chunk[index][0], INVALID_MSG + ', '.join(errors))
+        results[index] = None
+    valid = [(line, values, ProductInformation().assign(values))
+             for (line, _), values in zip(chunk, results) if values is not None]
+
+    existing = dict((prod_info.prod_id, prod_info) for prod_info in
+                    ProductInformation.find_many([prod_info.prod_id for _, _, prod_info in valid]))
+    prod_infos = {}
+    lines = []
+    for line, values, prod_info in valid:
+        stored = prod_infos.get(prod_info.prod_id, existing.get(prod_info.prod_id))
+        if stored is None:
+            prod_infos[prod_info.prod_id] = prod_info
+        elif mode == UPSERT:
+            # checked on the unsaved row, so a rejected one leaves the stored product untouched
+            for reserved in RESERVED_COLUMNS.values():
+                setattr(prod_info, reserved, getattr(stored, reserved))
+            try:
+                prod_info.check_reserved()
+            except ReservedQuantityError as error:
+                report.add_error(line, str(error))
+                continue
+            prod_infos[prod_info.prod_id] = stored.assign(values)
+        else:
+            report.add_error(line, EXISTS_MSG.format(prod_info.prod_id))
+            continue
+        lines.append(line)
+
+    try:
+        ProductInformation.save_all(list(prod_infos.values()))
+    except (SQLAlchemyError, ReservedQuantityError) as error:
+        # every shard the chunk wrote to, so later chunks start clean transactions
+        ProductInformation.rollback(*set(shards.session_for(prod_id) for prod_id in prod_infos))
+        logger.error("Import of lines {} to {} failed: {}".format(lines[0], lines[-1], error))
+        for line in lines:
+            report.add_error(line, str(error.orig if hasattr(error, 'orig') else error))
+        return
+    report.imported += len(lines)
+
+def main(argv):
+    """ Imports a CSV or NDJSON file into the database """
+    parser = argparse.ArgumentParser(prog='python -m app.bulk_import',
+                                     description='Import products from a CSV or NDJSON file.')
+    parser.add_argument('file')
+    parser.add_argument('--format', choices=sorted(READERS),
+                        help='the file format (default: by extension, csv or ndjson)')
+    parser.add_argument('--upsert', action='store_true', help='replace existing products')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='the number of rows written per transaction')
+    args = parser.parse_args(argv)
+    file_format = args.format or (CSV if args.file.endswith('.csv') else NDJSON)
+
+    from app import register_routes
+    register_routes()
+    ProductInformation.init_db()
+    started = time.time()
+
+    def progress(report):
+        """ Prints the progress of the import """
+        print("{} rows, {} imported, {} failed, {:.0f} rows/s".format(
+            report.rows, report.imported, report.failed,
+            report.rows / max(time.time() - started, 0.001)))
+
+    with open(args.file, 'rb') as import_file:
+        try:
+            report = import_rows(READERS[file_format](import_file),
+                                 UPSERT if args.upsert else INSERT, args.chunk_size, progress)
+        except DataValidationError as error:
+            print(error.args[0])
+            return 1
+    for error in report.errors:
+        print("line {}: {}".format(error['line'], error['error']))
+    return 1 if report.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
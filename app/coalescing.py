@@ -0,0 +1,83 @@
+"""
+Read Coalescing
+
+Handlers decorated with @coalesce share their work between identical
+requests running at the same time: the first one runs the handler and the
+others wait for its response instead of sending the same queries. Requests
+are identical when they have the same endpoint, path, query arguments and
+Accept header.
+
+A waiting request gets the response of a call that was already running
+when it arrived, so it is as fresh as if it had arrived a moment sooner;
+nothing is kept once the call returns. Clients that just wrote, which read
+from the primary database, are never coalesced so they always see their
+own writes.
+"""
+
+import threading
+from functools import wraps
+from flask import Response, make_response, request
+from app.replicas import PRIMARY_COOKIE
+
+class Call(object):
+    """ A handler call in flight """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """ Runs one call at a time per key, handing its result to the callers that wait for it """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, function):
+        """ Returns function(), or the result of the call of the same key in flight """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+flights = SingleFlight()
+
+def request_key():
+    """ Returns what a response of the current request depends on """
+    return (request.endpoint, request.path, tuple(sorted(request.args.items(multi=True))),
+            request.headers.get('Accept'))
+
+def copy_response(response):
+    """ Returns a new response with the status, headers and body of another """
+    return Response(response.get_data(), status=response.status_code,
+                    headers=list(response.headers.items()))
+
+def coalesce(function):
+    """ Lets identical concurrent requests share one call of a read handler """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if PRIMARY_COOKIE in request.cookies:
+            return function(*args, **kwargs)
+        response = flights.do(request_key(), lambda: make_response(function(*args, **kwargs)))
+        return copy_response(response)
+    return wrapper
@@ -0,0 +1,147 @@
+"""
+Lazy API Documentation
+
+Importing Flasgger pulls in jsonschema and PyYAML, which makes up a large part
+of the start-up time. LazySwagger reserves the Flasgger routes (the spec routes
+of the SWAGGER config, /apidocs and /flasgger_static) in front of the app and
+only imports and sets up Flasgger when one of them is first requested. The
+docs are then served by a separate Flask app that mirrors the routes of the
+service, so the spec documents exactly the same endpoints.
+
+Flasgger would parse every route docstring again for each spec request.
+Instead the specs are generated once into app/specs/<endpoint>.json and
+served from memory with an ETag. Regenerate them after changing a route
+docstring with:
+    python -m app.docs
+and check that they are up to date with:
+    python -m app.docs --check
+A spec without a generated file is built from the docstrings on first request.
+"""
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+import sys
+from threading import RLock
+from flask import Flask, Request, Response
+
+# Routes Flasgger serves besides the specs
+DOCS_PREFIXES = ('/apidocs', '/flasgger_static')
+# Where the generated specs are kept
+SPEC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'specs')
+DEFAULT_SPEC_MAX_AGE = 300
+
+class LazySwagger(object):
+    """ WSGI middleware setting up the Flasgger docs on their first request """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.docs_app = None
+        self.specs = {}
+        self.lock = RLock()
+        app.wsgi_app = self
+        app.extensions['lazy_swagger'] = self
+
+    def get_spec_config(self, path):
+        """ Returns the SWAGGER config of the spec served at path, or None """
+        for spec in self.app.config.get('SWAGGER', {}).get('specs', []):
+            if spec['route'] == path:
+                return spec
+        return None
+
+    def get_prefixes(self):
+        """ Returns the URL prefixes served by Flasgger """
+        specs = self.app.config.get('SWAGGER', {}).get('specs', [])
+        return tuple(spec['route'] for spec in specs) + DOCS_PREFIXES
+
+    def get_docs_app(self):
+        """ Returns the docs app, creating it on first use """
+        with self.lock:
+            if self.docs_app is None:
+                from flasgger import Swagger
+                docs_app = Flask(self.app.import_name)
+                docs_app.config.update(self.app.config)
+                for rule in self.app.url_map.iter_rules():
+                    if rule.endpoint != 'static':
+                        docs_app.add_url_rule(rule.rule, rule.endpoint,
+                                              self.app.view_functions[rule.endpoint],
+                                              methods=rule.methods)
+                Swagger(docs_app)
+                self.docs_app = docs_app
+            return self.docs_app
+
+    def generate_spec(self, spec):
+        """ Builds the JSON document of a spec from the route docstrings """
+        docs_app = self.get_docs_app()
+        with docs_app.test_request_context(spec['route']):
+            response = docs_app.view_functions['flasgger.' + spec['endpoint']]()
+        return json.dumps(json.loads(response.get_data()), indent=2, sort_keys=True,
+                          separators=(',', ': ')) + '\n'
+
+    @staticmethod
+    def get_spec_path(spec):
+        """ Returns the path of the generated spec file """
+        return os.path.join(SPEC_DIR, spec['endpoint'] + '.json')
+
+    def load_spec(self, spec):
+        """ Returns the JSON document of a spec, generating it if there is no spec file """
+        path = LazySwagger.get_spec_path(spec)
+        if os.path.exists(path):
+            with open(path, 'rb') as spec_file:
+                return spec_file.read().decode('utf-8')
+        return self.generate_spec(spec)
+
+    def get_spec(self, spec):
+        """ Returns the encoded JSON document of a spec and its ETag, loading it on first use """
+        with self.lock:
+            if spec['endpoint'] not in self.specs:
+                body = self.load_spec(spec).encode('utf-8')
+                self.specs[spec['endpoint']] = (body, hashlib.md5(body).hexdigest())
+            return self.specs[spec['endpoint']]
+
+    def serve_spec(self, spec, environ, start_response):
+        """ Serves a spec from memory, answering revalidations with 304 Not Modified """
+        body, etag = self.get_spec(spec)
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = self.app.config.get('SWAGGER_SPEC_MAX_AGE',
+                                                             DEFAULT_SPEC_MAX_AGE)
+        response.make_conditional(Request(environ))
+        return response(environ, start_response)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        spec = self.get_spec_config(path)
+        if spec is not None:
+            return self.serve_spec(spec, environ, start_response)
+        if path.startswith(self.get_prefixes()):
+            return self.get_docs_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+def main(argv):
+    """ Writes the spec files, or with --check verifies that they match the docstrings """
+    from app import register_routes
+    app = register_routes()
+    docs = app.extensions['lazy_swagger']
+    outdated = []
+    for spec in app.config['SWAGGER']['specs']:
+        path = LazySwagger.get_spec_path(spec)
+        document = docs.generate_spec(spec)
+        if '--check' in argv:
+            if not os.path.exists(path) or docs.load_spec(spec) != document:
+                outdated.append(path)
+            continue
+        if not os.path.isdir(SPEC_DIR):
+            os.makedirs(SPEC_DIR)
+        with open(path, 'wb') as spec_file:
+            spec_file.write(document.encode('utf-8'))
+        print("Wrote {}".format(path))
+    for path in outdated:
+        print("{} does not match the route docstrings, run python -m app.docs".format(path))
+    return 1 if outdated else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
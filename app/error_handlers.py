@@ -1,11 +1,16 @@
 from flask import jsonify
+from app import admission, shards
+from app.admission_control import DeadlineExceeded, SERVICE_UNAVAILABLE_ERROR, reject
 from app.server import app
-from app.models import DataValidationError
+from app.models import DataValidationError, ReservedQuantityError
 from flask_api import status
+from sqlalchemy.orm.exc import StaleDataError
 
 BAD_REQUEST_ERROR = 'Bad Request.'
 METHOD_NOT_ALLOWED_ERROR = 'Method Not Allowed'
 NOT_FOUND_ERROR = 'Not Found.'
+CONFLICT_ERROR = 'Conflict'
+PRECONDITION_FAILED_ERROR = 'Precondition Failed'
 UNSUPPORTED_MEDIA_TYPE_ERROR = 'Unsupported media type'
 INTERNAL_SERVER_ERROR = 'Internal Server Error'
 
@@ -34,6 +39,48 @@ def not_found(error):
     return jsonify(status=status.HTTP_404_NOT_FOUND, error=NOT_FOUND_ERROR,
                    message=error.message), status.HTTP_404_NOT_FOUND
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def conflict(error):
+    """ Handles reservations that cannot be held, confirmed or released """
+    app.logger.error(str(error))
+    return jsonify(status=status.HTTP_409_CONFLICT, error=CONFLICT_ERROR,
+                   message=error.description), status.HTTP_409_CONFLICT
+
+@app.errorhandler(ReservedQuantityError)
+def reserved_quantity_error(error):
+    """ Handles writes that would leave fewer products than the reservations hold """
+    shards.rollback()
+    app.logger.error(str(error))
+    return jsonify(status=status.HTTP_409_CONFLICT, error=CONFLICT_ERROR,
+                   message=str(error)), status.HTTP_409_CONFLICT
+
+@app.errorhandler(StaleDataError)
+def concurrent_update_error(error):
+    """ Handles writes that lost the race against a concurrent write """
+    shards.rollback()
+    app.logger.error(str(error))
+    return jsonify(status=status.HTTP_412_PRECONDITION_FAILED, error=PRECONDITION_FAILED_ERROR,
+                   message='The product was modified concurrently. Please retry.'), \
+           status.HTTP_412_PRECONDITION_FAILED
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(error):
+    """ Handles requests that used the database past their deadline """
+    shards.rollback()
+    admission.count_deadline_exceeded()
+    app.logger.error(str(error))
+    return reject(status.HTTP_503_SERVICE_UNAVAILABLE, SERVICE_UNAVAILABLE_ERROR,
+                  'The request took too long. Please retry later.',
+                  app.config['ADMISSION_RETRY_AFTER'])
+
+@app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """ Handles If-Match headers that do not match the current version """
+    message = error.message or str(error)
+    app.logger.error(message)
+    return jsonify(status=status.HTTP_412_PRECONDITION_FAILED, error=PRECONDITION_FAILED_ERROR,
+                   message=message), status.HTTP_412_PRECONDITION_FAILED
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -0,0 +1,124 @@
+"""
+Live Inventory Change Events
+
+A single ChangeBroker per process pulls committed changes from the change feed
+(ProductInformation.find_changes) and fans them out to every Server-Sent Events
+subscriber. Subscribers never touch the database, except once when they resume
+from a Last-Event-ID that is older than the in-memory buffer.
+"""
+
+import json
+import logging
+import threading
+from collections import deque
+from app import db
+from app.models import CHANGE_SEQ, CHANGE_TYPE, PROD_ID, ProductInformation
+from app.workers import PeriodicWorker
+
+# Default broker settings, overridden by the app config
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_HEARTBEAT_INTERVAL = 15.0
+DEFAULT_BUFFER_SIZE = 1000
+# Number of changes read from the database at a time
+BATCH_SIZE = 500
+
+HEARTBEAT = ': heartbeat\n\n'
+
+class ChangeEvent(object):
+    """ A committed change, encoded once for all subscribers """
+    __slots__ = ('seq', 'prod_id', 'message')
+
+    def __init__(self, change):
+        self.seq = change[CHANGE_SEQ]
+        self.prod_id = change[PROD_ID]
+        self.message = 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+            self.seq, change[CHANGE_TYPE], json.dumps(change))
+
+class ChangeBroker(PeriodicWorker):
+    """ Publishes committed inventory changes to any number of subscribers """
+    logger = logging.getLogger(__name__)
+    thread_name = 'change-broker'
+    interval_key = 'EVENTS_POLL_INTERVAL'
+    failure_msg = 'Polling changes failed: {}'
+
+    def __init__(self, app):
+        super(ChangeBroker, self).__init__(app)
+        self.buffer = deque()
+        self.head = None    # the last change_seq seen by the broker
+        self.floor = None   # the buffer holds every change after this change_seq
+        self.condition = threading.Condition()
+        app.config.setdefault('EVENTS_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+
+    def starting(self):
+        """ Publishes the changes after the current change_seq """
+        with self.app.app_context():
+            head = ProductInformation.current_change_seq()
+        with self.condition:
+            self.head = self.floor = head
+
+    def stop(self):
+        """ Stops the publisher thread and ends the subscriptions """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        super(ChangeBroker, self).stop()
+
+    def work(self):
+        """ Reads the changes committed since the last poll and publishes them """
+        size = self.app.config.get('EVENTS_BUFFER_SIZE', DEFAULT_BUFFER_SIZE)
+        while True:
+            changes = ProductInformation.find_changes(self.head, BATCH_SIZE)
+            if not changes:
+                return
+            events = [ChangeEvent(change.serialize_change()) for change in changes]
+            with self.condition:
+                self.buffer.extend(events)
+                while len(self.buffer) > size:
+                    self.floor = self.buffer.popleft().seq
+                self.head = events[-1].seq
+                self.condition.notify_all()
+            if len(changes) < BATCH_SIZE:
+                return
+
+    def events_after(self, cursor):
+        """
+        Returns the buffered events after cursor,
+        or None if some of them have already left the buffer.
+        """
+        with self.condition:
+            if cursor < self.floor:
+                return None
+            return [event for event in self.buffer if event.seq > cursor]
+
+    def subscribe(self, last_event_id=None, prod_ids=None):
+        """
+        Yields Server-Sent Events messages for every change after last_event_id,
+        or for every new change if no last_event_id is given.
+
+        Args:
+            last_event_id (int): the change_seq of the last event the client received
+            prod_ids (set): only changes of these products are sent if given
+        """
+        self.start()
+        heartbeat = self.app.config.get('EVENTS_HEARTBEAT_INTERVAL', DEFAULT_HEARTBEAT_INTERVAL)
+        with self.condition:
+            cursor = self.head if last_event_id is None else last_event_id
+        while self.running:
+            events = self.events_after(cursor)
+            if events is None:
+                # resuming from further back than the buffer reaches
+                changes = ProductInformation.find_changes(cursor, BATCH_SIZE)
+                events = [ChangeEvent(change.serialize_change()) for change in changes]
+                db.session.remove()
+            if not events:
+                with self.condition:
+                    if self.head <= cursor:
+                        self.condition.wait(heartbeat)
+                    idle = self.head <= cursor
+                if idle:
+                    yield HEARTBEAT
+                continue
+            for event in events:
+                if prod_ids is None or event.prod_id in prod_ids:
+                    yield event.message
+            cursor = events[-1].seq
@@ -0,0 +1,62 @@
+"""
+Response Formats
+
+Product responses are encoded in the format picked from the Accept header:
+    application/json                            the default
+    application/msgpack                         MessagePack, structured like the JSON
+    application/vnd.inventory.columnar+json     one array per field
+    application/vnd.inventory.columnar+msgpack  one array per field, in MessagePack
+
+The columnar formats turn a list of products into an object mapping every
+serialized field to the array of its values, so the keys are sent once per
+response instead of once per product. A single product becomes arrays of one
+value. Create, update and restock also accept MessagePack request bodies.
+"""
+
+import json
+import msgpack
+from app.models import DataValidationError, FIELDS
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+X_MSGPACK = 'application/x-msgpack'
+COLUMNAR_JSON = 'application/vnd.inventory.columnar+json'
+COLUMNAR_MSGPACK = 'application/vnd.inventory.columnar+msgpack'
+# Response formats, the first one wins when the client accepts several equally
+MEDIA_TYPES = [JSON, MSGPACK, X_MSGPACK, COLUMNAR_JSON, COLUMNAR_MSGPACK]
+MSGPACK_TYPES = [MSGPACK, X_MSGPACK, COLUMNAR_MSGPACK]
+COLUMNAR_TYPES = [COLUMNAR_JSON, COLUMNAR_MSGPACK]
+
+BAD_MSGPACK_MSG = 'Invalid MessagePack body: {}'
+
+def negotiate(accept_mimetypes, media_types=None):
+    """ Returns the media type of media_types (MEDIA_TYPES by default) the client prefers """
+    media_types = media_types or MEDIA_TYPES
+    return accept_mimetypes.best_match(media_types, default=media_types[0])
+
+def columnar(rows, fields=None):
+    """ Turns a list of serialized products into a dictionary of one list per field """
+    return dict((field, [row[field] for row in rows]) for field in fields or FIELDS)
+
+def encode(data, media_type):
+    """ Encodes a document in JSON or MessagePack """
+    if media_type in MSGPACK_TYPES:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+def layout(rows, media_type, fields=None):
+    """ Returns a list of serialized products in the columnar or row layout of the media type """
+    if media_type in COLUMNAR_TYPES:
+        return columnar(rows, fields)
+    return rows
+
+def encode_products(rows, media_type, fields=None):
+    """ Encodes a list of serialized products in a columnar or row format """
+    return encode(layout(rows, media_type, fields), media_type)
+
+def decode(body):
+    """ Decodes a MessagePack request body """
+    try:
+        return msgpack.unpackb(body, raw=False)
+    except (ValueError, msgpack.exceptions.UnpackException) as error:
+        raise DataValidationError(BAD_MSGPACK_MSG.format(error))
@@ -0,0 +1,90 @@
+"""
+Hot Products
+
+Every restock updates the row of its product, so the restocks of one product
+queue up behind each other's row lock. HotProducts counts the restocks of
+every product; once one gets HOT_WRITE_RATE restocks within HOT_WRITE_WINDOW
+seconds it turns hot and its restocks are added to one of HOT_COUNTER_SLOTS
+HotCounter rows picked at random instead, so that many of them commit in
+parallel. A hot product turns back once its rate drops under half of
+HOT_WRITE_RATE, or after a quiet window.
+
+Point reads, multi-gets and lists add the counters of hot products to their
+quantities, so they see a restock as soon as it commits. Every
+HOT_FOLD_INTERVAL seconds the folder thread, which run.py starts with the
+service, folds the counters into the product rows, one restock per product,
+and that is when the change feed, the query cache and the filters and sort
+orders of the lists catch up.
+Restocks only add to new_qty, so the automatic restock has nothing to do
+before the fold, where it runs as for any save. Updates, and restocks sent
+with If-Match, write the product row as before, folding in the counters
+they read.
+"""
+
+import logging
+import random
+import time
+from app.models import ProductInformation
+from app.workers import PeriodicWorker
+
+# Default hot product settings, overridden by the app config
+DEFAULT_WRITE_RATE = 50
+DEFAULT_WRITE_WINDOW = 1.0
+DEFAULT_COUNTER_SLOTS = 8
+DEFAULT_FOLD_INTERVAL = 1.0
+# Number of products whose restocks are counted before the quiet ones are dropped
+MAX_PRODUCTS = 10000
+
+class HotProducts(PeriodicWorker):
+    """ Spreads the restocks of the products written the most over counter rows """
+    logger = logging.getLogger(__name__)
+    thread_name = 'hot-counter-folder'
+    interval_key = 'HOT_FOLD_INTERVAL'
+    failure_msg = 'Folding the hot counters failed: {}'
+
+    def __init__(self, app):
+        super(HotProducts, self).__init__(app)
+        self.rates = {}     # prod_id -> [window start, restocks in the window, hot]
+        app.config.setdefault('HOT_WRITE_RATE', DEFAULT_WRITE_RATE)
+        app.config.setdefault('HOT_WRITE_WINDOW', DEFAULT_WRITE_WINDOW)
+        app.config.setdefault('HOT_COUNTER_SLOTS', DEFAULT_COUNTER_SLOTS)
+        app.config.setdefault('HOT_FOLD_INTERVAL', DEFAULT_FOLD_INTERVAL)
+
+    def record(self, prod_id):
+        """ Counts a restock of a product and returns whether the product is hot """
+        rate = self.app.config['HOT_WRITE_RATE']
+        if rate is None:
+            return False
+        window = self.app.config['HOT_WRITE_WINDOW']
+        now = time.time()
+        with self.lock:
+            entry = self.rates.get(prod_id)
+            if entry is None:
+                if len(self.rates) >= MAX_PRODUCTS:
+                    self.rates = dict((key, value) for key, value in self.rates.items()
+                                      if value[0] > now - window)
+                entry = self.rates[prod_id] = [now, 0, False]
+            elif now - entry[0] >= window:
+                if entry[2] and (entry[1] < rate / 2.0 or now - entry[0] >= 2 * window):
+                    HotProducts.logger.info("Id {} is no longer hot.".format(prod_id))
+                    entry[2] = False
+                entry[0], entry[1] = now, 0
+            entry[1] += 1
+            if not entry[2] and entry[1] >= rate:
+                HotProducts.logger.info("Id {} is hot.".format(prod_id))
+                entry[2] = True
+            return entry[2]
+
+    def restock(self, prod_info, amt):
+        """ Adds 'amt' new products to a HotCounter of prod_info picked at random """
+        if not prod_info.hot:
+            prod_info.mark_hot()
+        return prod_info.restock_counter(amt,
+                                         random.randrange(self.app.config['HOT_COUNTER_SLOTS']))
+
+    def fold(self):
+        """ Folds the HotCounters into the products and returns how many products """
+        return self.run_once()
+
+    def work(self):
+        return ProductInformation.fold_counters()
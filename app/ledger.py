@@ -0,0 +1,64 @@
+"""
+Stock Ledger Compaction
+
+Every write appends a StockMovement per changed quantity to the stock ledger,
+so the movements of a product add up to its quantities and its history can
+be read back with GET /inventory/<prod_id>/movements. LedgerCompactor keeps
+the ledger from growing without bound: every LEDGER_COMPACTION_INTERVAL
+seconds it folds the movements older than LEDGER_RETENTION_DAYS into one
+snapshot movement per product and condition. The sums, and so the
+quantities, stay the same; only the detail of the old movements is lost.
+
+Run one compaction from cron with:
+    python -m app.ledger [--retention-days DAYS]
+"""
+
+from __future__ import print_function
+import argparse
+import logging
+import sys
+from datetime import datetime, timedelta
+from app.models import ProductInformation
+from app.workers import PeriodicWorker
+
+# Default compactor settings, overridden by the app config
+DEFAULT_COMPACTION_INTERVAL = 3600.0
+DEFAULT_RETENTION_DAYS = 30
+
+class LedgerCompactor(PeriodicWorker):
+    """ Periodically folds the old stock movements into snapshots """
+    logger = logging.getLogger(__name__)
+    thread_name = 'ledger-compactor'
+    interval_key = 'LEDGER_COMPACTION_INTERVAL'
+    failure_msg = 'Compacting the stock ledger failed: {}'
+
+    def __init__(self, app):
+        super(LedgerCompactor, self).__init__(app)
+        app.config.setdefault('LEDGER_COMPACTION_INTERVAL', DEFAULT_COMPACTION_INTERVAL)
+        app.config.setdefault('LEDGER_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+
+    def compact(self):
+        """ Folds the movements older than LEDGER_RETENTION_DAYS and returns how many """
+        return self.run_once()
+
+    def work(self):
+        before = datetime.utcnow() - timedelta(days=self.app.config['LEDGER_RETENTION_DAYS'])
+        return ProductInformation.compact_ledger(before)
+
+def main(argv):
+    """ Compacts the stock ledger once """
+    parser = argparse.ArgumentParser(prog='python -m app.ledger',
+                                     description='Fold old stock movements into snapshots.')
+    parser.add_argument('--retention-days', type=float,
+                        help='the age of the movements to fold (default: LEDGER_RETENTION_DAYS)')
+    args = parser.parse_args(argv)
+
+    from app import app, register_routes
+    register_routes()
+    if args.retention_days is not None:
+        app.config['LEDGER_RETENTION_DAYS'] = args.retention_days
+    print("{} movements folded".format(LedgerCompactor(app).compact()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
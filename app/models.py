@@ -18,11 +18,44 @@ restock_level   (int)       - when the product total quantity reaches below this
                               an automatic restock will be trigger.
 restock_amt     (int)       - the amount of new products restocked
                               when the total quantity goes under restock_level
+change_seq      (int)       - sequence number of the last write to the product,
+                              used by the change feed
+change_type     (string)    - kind of the last write: create, update or restock
+version         (int)       - optimistic concurrency version, bumped by SQLAlchemy
+                              on every update
+total_qty       (int)       - new_qty + used_qty + open_boxed_qty, kept for sorting
+restock_distance (int)      - total_qty - restock_level, kept for sorting, or None
+                              if the product does not restock automatically
+hot             (bool)      - whether restocks may be waiting in the HotCounters
+                              of the product, see app/hot_products.py
+reserved_new_qty, reserved_used_qty, reserved_open_boxed_qty (int)
+                            - quantities of the conditions held by reservations,
+                              serialized as the available (to promise) quantities
+
+ProductTombstone - Marks a deleted product in the change feed
+ChangeCounter - Hands out change sequence numbers
+StockMovement - A change of the quantity of one condition of a product, appended
+                to the stock ledger by every write. The quantities of a product
+                are the sums of its movements per condition.
+HotCounter - One of the counter rows the restocks of a hot product are spread over
+Reservation - Stock of a product held for a checkout until it is confirmed,
+              released or expires, see app/reservations.py
+
+ProductInformation reads and writes the products through the Repository of
+the STORAGE_BACKEND setting, see app/repositories.py.
 """
 
 import logging
 import math
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
 from . import db
+from .schema import DEFAULT, ENUM, INTEGER, MINIMUM, NUMBER, REQUIRED, STRING, TYPE, \
+    UPDATABLE, compile_schema, defaults
+from .sharding import SHARDED
 
 # Default ProductInformation property value
 DEFAULT_NEW_QTY = 0
@@ -38,27 +71,273 @@ USED_QTY = 'used_qty'
 OPEN_BOXED_QTY = 'open_boxed_qty'
 RESTOCK_LEVEL = 'restock_level'
 RESTOCK_AMT = 'restock_amt'
-
+# Fields of a serialized ProductInformation, in column order
+FIELDS = [PROD_ID, PROD_NAME, NEW_QTY, USED_QTY, OPEN_BOXED_QTY, RESTOCK_LEVEL, RESTOCK_AMT]
+# Columns of the quantities held by reservations and the available quantities
+# serialized besides the FIELDS
+RESERVED_COLUMNS = {
+    NEW_QTY: 'reserved_new_qty',
+    USED_QTY: 'reserved_used_qty',
+    OPEN_BOXED_QTY: 'reserved_open_boxed_qty'
+}
+AVAILABLE_FIELDS = {
+    NEW_QTY: 'available_new_qty',
+    USED_QTY: 'available_used_qty',
+    OPEN_BOXED_QTY: 'available_open_boxed_qty'
+}
+# Sort keys of the product lists besides PROD_ID, PROD_NAME and NEW_QTY
+QUANTITY = 'quantity'
+RESTOCK_DISTANCE = 'restock_distance'
+# Columns behind the sort keys
+SORT_COLUMNS = {
+    PROD_ID: 'prod_id',
+    PROD_NAME: 'prod_name',
+    QUANTITY: 'total_qty',
+    NEW_QTY: 'new_qty',
+    RESTOCK_DISTANCE: 'restock_distance'
+}
+CHANGE_SEQ = 'change_seq'
+CHANGE_TYPE = 'change_type'
+DELETED = 'deleted'
+DATA = 'data'
+
+# Id of the single ChangeCounter row
+CHANGE_COUNTER_ID = 1
+# Change types
+CREATE = 'create'
+UPDATE = 'update'
+RESTOCK = 'restock'
+DELETE = 'delete'
+RESERVE = 'reserve'
+CONFIRM = 'confirm'
+# Reasons of stock movements besides the change types
+AUTOMATIC_RESTOCK = 'automatic_restock'
+SNAPSHOT = 'snapshot'
+MOVEMENT_ID = 'movement_id'
+CONDITION = 'condition'
+DELTA = 'delta'
+REASON = 'reason'
+CREATED_AT = 'created_at'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+# Reservation statuses and fields
+HELD = 'held'
+CONFIRMED = 'confirmed'
+RELEASED = 'released'
+EXPIRED = 'expired'
+RESERVATION_ID = 'reservation_id'
+STATUS = 'status'
+EXPIRES_AT = 'expires_at'
+TTL = 'ttl'
+# Kinds of the (kind, value) criteria the finders hand the repositories
+BY_IDS = 'ids'
+BY_NAME = 'name'
+BY_NAME_PREFIX = 'name_prefix'
+BY_QUANTITY = 'quantity'
+BY_CONDITION = 'condition'
+# Conditions of find_by_condition and the columns counting them
+NEW = 'new'
+CONDITIONS = {
+    NEW: NEW_QTY,
+    'used': USED_QTY,
+    'open-boxed': OPEN_BOXED_QTY
+}
+
+INVALID_MSG = 'Invalid ProductInformation: '
 BAD_DATA_MSG = 'Invalid ProductInformation: body of request contained bad or no data'
+INVALID_RESTOCK_MSG = "Please only give 'restock_amt' as input."
 BAD_PARAMETER_MSG = 'Invalid parameters in the request'
 RESTOCK_FAIL_MSG = 'Automatic restocking failed due to invalid ProductInformation.'
+BELOW_RESERVED_MSG = "Product with id '{}' cannot have {} {}, {} are held by reservations"
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
+class ReservedQuantityError(Exception):
+    """ Used when a write would leave fewer products than the reservations hold """
+    pass
+
+# The fields of a ProductInformation payload, see app/schema.py
+PRODUCT_SCHEMA = OrderedDict([
+    (PROD_ID, {TYPE: INTEGER, REQUIRED: True, UPDATABLE: False}),
+    (PROD_NAME, {TYPE: STRING, REQUIRED: True}),
+    (NEW_QTY, {TYPE: INTEGER, MINIMUM: 0, DEFAULT: DEFAULT_NEW_QTY}),
+    (USED_QTY, {TYPE: INTEGER, MINIMUM: 0, DEFAULT: DEFAULT_USED_QTY}),
+    (OPEN_BOXED_QTY, {TYPE: INTEGER, MINIMUM: 0, DEFAULT: DEFAULT_OPEN_BOXED_QTY}),
+    (RESTOCK_LEVEL, {TYPE: INTEGER, MINIMUM: DEFAULT_RESTOCK_LEVEL,
+                     DEFAULT: DEFAULT_RESTOCK_LEVEL}),
+    (RESTOCK_AMT, {TYPE: INTEGER, MINIMUM: 0, DEFAULT: DEFALUT_RESTOCK_AMT})
+])
+RESTOCK_SCHEMA = OrderedDict([
+    (RESTOCK_AMT, {TYPE: INTEGER, MINIMUM: 0, REQUIRED: True})
+])
+RESERVATION_SCHEMA = OrderedDict([
+    (QUANTITY, {TYPE: INTEGER, MINIMUM: 1, REQUIRED: True}),
+    (CONDITION, {TYPE: STRING, ENUM: sorted(CONDITIONS)}),
+    (TTL, {TYPE: NUMBER})
+])
+PRODUCT_DEFAULTS = defaults(PRODUCT_SCHEMA)
+# Validators of created products, updates, restocks and reservations, compiled once
+validate_product = compile_schema(PRODUCT_SCHEMA)
+validate_update = compile_schema(PRODUCT_SCHEMA, partial=True)
+validate_restock = compile_schema(RESTOCK_SCHEMA, closed=True)
+validate_reservation = compile_schema(RESERVATION_SCHEMA, closed=True)
+
+def validated(validate, data):
+    """ Returns the values of a payload, or raises a DataValidationError listing its errors """
+    values, errors = validate(data)
+    if errors:
+        raise DataValidationError(INVALID_MSG + ', '.join(errors))
+    return values
+
+class ChangeCounter(db.Model):
+    """
+    A single-row counter handing out change sequence numbers.
+
+    The row stays locked by the incrementing transaction until it commits, so
+    sequence numbers become visible in commit order and a change feed cursor
+    never skips over a write that commits late. Writers take their numbers
+    last, once their rows are flushed, so the lock is only held for the
+    commit. The row is inserted with the table.
+    """
+    counter_id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @staticmethod
+    def next_value(count=1):
+        """ Increments the counter by count in the current transaction and returns the new value """
+        table = ChangeCounter.__table__
+        db.session.execute(table.update().where(table.c.counter_id == CHANGE_COUNTER_ID)
+                           .values(value=table.c.value + count))
+        return ChangeCounter.current_value()
+
+    @staticmethod
+    def seed():
+        """ Inserts the counter row into a table created before it was inserted with it """
+        table = ChangeCounter.__table__
+        if db.session.execute(db.select([table.c.counter_id])
+                              .where(table.c.counter_id == CHANGE_COUNTER_ID)).first() is None:
+            db.session.execute(table.insert().values(counter_id=CHANGE_COUNTER_ID, value=0))
+        db.session.commit()
+
+    @staticmethod
+    def current_value():
+        """ Returns the last handed out change sequence number """
+        table = ChangeCounter.__table__
+        value = db.session.execute(
+            db.select([table.c.value]).where(table.c.counter_id == CHANGE_COUNTER_ID)).scalar()
+        return value or 0
+
+@event.listens_for(ChangeCounter.__table__, 'after_create')
+def seed_change_counter(table, connection, **kwargs):
+    """ Inserts the counter row with the table, so writers only ever update it """
+    connection.execute(table.insert().values(counter_id=CHANGE_COUNTER_ID, value=0))
+
+class ProductTombstone(db.Model):
+    """ Records the deletion of a ProductInformation for the change feed """
+    __table_args__ = {'info': {SHARDED: True}}
+
+    prod_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    change_seq = db.Column(db.BigInteger, index=True)
+
+    def serialize_change(self):
+        """ Serialize a ProductTombstone into a change feed entry """
+        return {
+            CHANGE_SEQ: self.change_seq,
+            CHANGE_TYPE: DELETE,
+            PROD_ID: self.prod_id,
+            DELETED: True,
+            DATA: None
+        }
+
+class StockMovement(db.Model):
+    """ A change of the quantity of one condition of a product in the stock ledger """
+    __table_args__ = (db.Index('ix_stock_movement_prod_id_movement_id', 'prod_id', 'movement_id'),
+                      {'info': {SHARDED: True}})
+
+    movement_id = db.Column(db.Integer, primary_key=True)
+    prod_id = db.Column(db.Integer, nullable=False)
+    condition = db.Column(db.String(16), nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(24), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+    change_seq = db.Column(db.BigInteger)
+
+    def serialize(self):
+        """ Serialize a StockMovement into a dictionary """
+        return {
+            MOVEMENT_ID: self.movement_id,
+            PROD_ID: self.prod_id,
+            CONDITION: self.condition,
+            DELTA: self.delta,
+            REASON: self.reason,
+            CREATED_AT: self.created_at.strftime(TIMESTAMP_FORMAT),
+            CHANGE_SEQ: self.change_seq
+        }
+
+class HotCounter(db.Model):
+    """ Restocks of a hot product added to one counter slot, not yet folded into its row """
+    __table_args__ = {'info': {SHARDED: True}}
+
+    prod_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    delta = db.Column(db.Integer, nullable=False, default=0)
+
+class Reservation(db.Model):
+    """ A quantity of one condition of a product held for a checkout until it expires """
+    __table_args__ = {'info': {SHARDED: True}}
+
+    reservation_id = db.Column(db.Integer, primary_key=True)
+    prod_id = db.Column(db.Integer, nullable=False)
+    condition = db.Column(db.String(16), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(16), nullable=False)
+    # the sweeper walks the held reservations in expiry order
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def serialize(self):
+        """ Serialize a Reservation into a dictionary """
+        return {
+            RESERVATION_ID: self.reservation_id,
+            PROD_ID: self.prod_id,
+            CONDITION: self.condition,
+            QUANTITY: self.quantity,
+            STATUS: self.status,
+            EXPIRES_AT: self.expires_at.strftime(TIMESTAMP_FORMAT)
+        }
+
 class ProductInformation(db.Model):
     """ A class representing an Inventory entry"""
     logger = logging.getLogger(__name__)
 
     # Table Schema
+    __table_args__ = {'info': {SHARDED: True}}
     prod_id = db.Column(db.Integer, primary_key=True)
-    prod_name = db.Column(db.String(80))
-    new_qty = db.Column(db.Integer)
-    used_qty = db.Column(db.Integer)
-    open_boxed_qty = db.Column(db.Integer)
+    prod_name = db.Column(db.String(80), index=True)
+    # the stock ledger needs the previous quantities, even of expired instances
+    new_qty = db.column_property(db.Column(db.Integer, index=True), active_history=True)
+    used_qty = db.column_property(db.Column(db.Integer), active_history=True)
+    open_boxed_qty = db.column_property(db.Column(db.Integer), active_history=True)
     restock_level = db.Column(db.Integer)
     restock_amt = db.Column(db.Integer)
+    change_seq = db.Column(db.BigInteger, index=True)
+    change_type = db.Column(db.String(16))
+    version = db.Column(db.Integer, nullable=False)
+    total_qty = db.Column(db.Integer, index=True)
+    restock_distance = db.Column(db.Integer, index=True)
+    hot = db.Column(db.Boolean, default=False)
+    reserved_new_qty = db.Column(db.Integer, default=0)
+    reserved_used_qty = db.Column(db.Integer, default=0)
+    reserved_open_boxed_qty = db.Column(db.Integer, default=0)
+
+    # restocks waiting in the HotCounters by slot, added to the quantities on load
+    pending = None
+    # new products the automatic restock added since the last save
+    restocked = 0
+
+    # Updates and deletes only match the row version they were loaded with
+    # and raise StaleDataError when another writer got there first.
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return repr(self.serialize())
@@ -69,25 +348,117 @@ class ProductInformation(db.Model):
         currently no duplicate detection is supported.
         """
         ProductInformation.logger.info("Save/update for id {}.".format(self.prod_id))
-        if self.restock_level is not None and self.restock_level > 0:
-            self.automatic_restock()
+        ProductInformation.repository().save_all([self])
 
-        db.session.add(self)
-        db.session.commit()
+    def prepare_save(self, change_seq=None):
+        """
+        Restocks the ProductInformation if needed, records it as change change_seq
+        and returns the StockMovements of the write. Without change_seq the
+        number is stamped on the row and the movements once they are flushed.
+        """
+        stored = self.stored_quantities()
+        self.restock_if_needed()
+        # the automatic restocks of a batch ran before the later operations
+        restocked_from = self.new_qty - self.restocked if self.restocked else self.new_qty
+        self.restocked = 0
+
+        # restock() already recorded its change type
+        if not db.inspect(self).attrs.change_type.history.has_changes():
+            self.change_type = UPDATE if self.version is not None else CREATE
+        if change_seq is not None:
+            self.change_seq = change_seq
+        self.update_sort_columns()
+
+        movements = []
+        for condition, column in sorted(CONDITIONS.items()):
+            previous = stored[column] or 0
+            written = (restocked_from or 0) if column == NEW_QTY else getattr(self, column) or 0
+            if written != previous:
+                movements.append(self.movement(condition, written - previous, self.change_type,
+                                               change_seq))
+        if self.new_qty != restocked_from:
+            movements.append(self.movement(NEW, self.new_qty - (restocked_from or 0),
+                                           AUTOMATIC_RESTOCK, change_seq))
+        return movements
+
+    def prepare_delete(self, change_seq=None):
+        """ Returns the StockMovements taking the stored quantities out of the ledger """
+        stored = self.stored_quantities()
+        return [self.movement(condition, -stored[column], DELETE, change_seq)
+                for condition, column in sorted(CONDITIONS.items()) if stored[column]]
+
+    def stored_quantities(self):
+        """ Returns the quantities the ProductInformation was loaded with, None if it is new """
+        quantities = {}
+        for column in CONDITIONS.values():
+            history = db.inspect(self).attrs[column].load_history()
+            stored = list(history.deleted or history.unchanged)
+            quantities[column] = stored[0] if stored else None
+        return quantities
+
+    def movement(self, condition, delta, reason, change_seq):
+        """ Returns a StockMovement of the ProductInformation written as change change_seq """
+        return StockMovement(prod_id=self.prod_id, condition=condition, delta=delta,
+                             reason=reason, created_at=datetime.utcnow(), change_seq=change_seq)
+
+    def update_sort_columns(self):
+        """
+        Computes the total quantity and the distance to the restock level the lists sort by.
+        """
+        self.total_qty, self.restock_distance = ProductInformation.sort_columns(
+            self.new_qty, self.used_qty, self.open_boxed_qty, self.restock_level)
+
+    @staticmethod
+    def sort_columns(new_qty, used_qty, open_boxed_qty, restock_level):
+        """ Returns the total_qty and restock_distance of a product with the given quantities """
+        if new_qty is None or used_qty is None or open_boxed_qty is None:
+            return None, None
+        total_qty = new_qty + used_qty + open_boxed_qty
+        if restock_level is None or restock_level <= 0:
+            return total_qty, None
+        return total_qty, total_qty - restock_level
 
     def delete(self):
         """
         Delete an ProductInformation from database.
         """
         ProductInformation.logger.info("Delete for id {}.".format(self.prod_id))
-        db.session.delete(self)
-        db.session.commit()
+        ProductInformation.repository().delete(self)
 
-    def serialize(self):
+    def add_pending(self, pending):
+        """
+        Adds the restocks waiting in the HotCounters, by slot, to the loaded quantities.
+
+        The sums count as stored, so saving the ProductInformation writes
+        them to its row, and the repository takes them out of the counters.
+        """
+        # an instance found again in the session already holds the previous ones
+        amount = sum(pending.values()) - sum((self.pending or {}).values())
+        self.pending = pending
+        unloaded = db.inspect(self).unloaded
+        for column in [NEW_QTY, 'total_qty', RESTOCK_DISTANCE]:
+            value = None if column in unloaded else getattr(self, column)
+            if amount and value is not None:
+                set_committed_value(self, column, value + amount)
+
+    def etag(self):
+        """
+        Returns the entity tag of the saved ProductInformation for If-Match checks.
+        """
+        if self.pending:
+            return '{}.{}'.format(self.version, sum(self.pending.values()))
+        return str(self.version)
+
+    def serialize(self, fields=None):
         """
         Serialize an ProductInformation into a dictionary.
+
+        Args:
+            fields (list): the FIELDS to include, or None for all of them
         """
-        return {
+        if fields is not None:
+            return dict((field, getattr(self, field)) for field in fields)
+        data = {
             PROD_ID: self.prod_id,
             PROD_NAME: self.prod_name,
             NEW_QTY: self.new_qty,
@@ -96,6 +467,28 @@ class ProductInformation(db.Model):
             RESTOCK_LEVEL: self.restock_level,
             RESTOCK_AMT: self.restock_amt
         }
+        for column, field in AVAILABLE_FIELDS.items():
+            data[field] = self.available(column)
+        return data
+
+    def available(self, column):
+        """ Returns the quantity of a condition column not held by reservations, or None """
+        quantity = getattr(self, column)
+        if quantity is None:
+            return None
+        return quantity - (getattr(self, RESERVED_COLUMNS[column]) or 0)
+
+    def serialize_change(self):
+        """
+        Serialize an ProductInformation into a change feed entry.
+        """
+        return {
+            CHANGE_SEQ: self.change_seq,
+            CHANGE_TYPE: self.change_type,
+            PROD_ID: self.prod_id,
+            DELETED: False,
+            DATA: self.serialize()
+        }
 
     def deserialize(self, data, initialize_property=True):
         """
@@ -106,50 +499,18 @@ class ProductInformation(db.Model):
             initialize_property (bool): A boolean indicating whether to
                 initialize the ProductInformation properties to default value.
         """
-        if not isinstance(data, dict):
-            raise DataValidationError(BAD_DATA_MSG)
-        # only prod_id & prod_name is a must-have property
-        try:
-            self.prod_id = data[PROD_ID]
-            self.prod_name = data[PROD_NAME]
-        except KeyError as error:
-            raise DataValidationError('Invalid ProductInformation: missing ' + error.args[0])
-        except TypeError as error:
-            raise DataValidationError(BAD_DATA_MSG)
-
-        data_new_qty = data.get(NEW_QTY)
-        data_used_qty = data.get(USED_QTY)
-        data_open_boxed_qty = data.get(OPEN_BOXED_QTY)
-        data_restock_level = data.get(RESTOCK_LEVEL)
-        data_restock_amt = data.get(RESTOCK_AMT)
-
-        # Ensure optional fields are not smaller than default values.
-        if (data_new_qty is not None and data_new_qty < 0) or \
-                (data_used_qty is not None and data_used_qty < 0) or \
-                (data_open_boxed_qty is not None and data_open_boxed_qty < 0) or \
-                (data_restock_level is not None and data_restock_level < DEFAULT_RESTOCK_LEVEL) or \
-                (data_restock_amt is not None and data_restock_amt < 0):
-            raise DataValidationError(BAD_DATA_MSG)
-
-        # populate ProductInformation with given data or None
-        self.new_qty = int(data_new_qty) if data_new_qty else None
-        self.used_qty = int(data_used_qty) if data_used_qty else None
-        self.open_boxed_qty = int(data_open_boxed_qty) if data_open_boxed_qty else None
-        self.restock_level = int(data_restock_level) if data_restock_level else None
-        self.restock_amt = int(data_restock_amt) if data_restock_amt else None
-
-        if initialize_property:
-            if self.new_qty is None:
-                self.new_qty = DEFAULT_NEW_QTY
-            if self.used_qty is None:
-                self.used_qty = DEFAULT_USED_QTY
-            if self.open_boxed_qty is None:
-                self.open_boxed_qty = DEFAULT_OPEN_BOXED_QTY
-            if self.restock_level is None:
-                self.restock_level = DEFAULT_RESTOCK_LEVEL
-            if self.restock_amt is None:
-                self.restock_amt = DEFALUT_RESTOCK_AMT
+        return self.assign(validated(validate_product, data), initialize_property)
 
+    def assign(self, values, initialize_property=True):
+        """
+        Sets every field of this ProductInformation from the values validate_product
+        returned, leaving the fields they do not give at their default or None.
+        """
+        for field in FIELDS:
+            value = values.get(field)
+            if value is None and initialize_property:
+                value = PRODUCT_DEFAULTS.get(field)
+            setattr(self, field, value)
         return self
 
     def restock(self, amt):
@@ -161,8 +522,79 @@ class ProductInformation(db.Model):
         if self.new_qty is None:
             raise DataValidationError(BAD_DATA_MSG)
         self.new_qty += amt
+        self.record_change(RESTOCK)
         return self
 
+    def record_change(self, change_type):
+        """ Records the change type of the next save, even if the last write had the same """
+        self.change_type = change_type
+        flag_modified(self, CHANGE_TYPE)
+
+    def hold(self, condition, quantity):
+        """
+        Reserves 'quantity' of the 'condition' products of this ProductInfo,
+        assuming that many are available.
+        """
+        reserved = RESERVED_COLUMNS[CONDITIONS[condition]]
+        setattr(self, reserved, (getattr(self, reserved) or 0) + quantity)
+        self.record_change(RESERVE)
+        return self
+
+    def release(self, condition, quantity):
+        """
+        Makes 'quantity' reserved 'condition' products of this ProductInfo available again.
+        """
+        reserved = RESERVED_COLUMNS[CONDITIONS[condition]]
+        setattr(self, reserved, getattr(self, reserved) - quantity)
+        self.record_change(RESERVE)
+        return self
+
+    def confirm(self, condition, quantity):
+        """
+        Takes 'quantity' reserved 'condition' products out of this ProductInfo for good.
+        """
+        column = CONDITIONS[condition]
+        setattr(self, column, getattr(self, column) - quantity)
+        setattr(self, RESERVED_COLUMNS[column], getattr(self, RESERVED_COLUMNS[column]) - quantity)
+        self.record_change(CONFIRM)
+        return self
+
+    def check_reserved(self):
+        """ Raises a ReservedQuantityError if a quantity is below the quantity reserved of it """
+        for column, reserved in sorted(RESERVED_COLUMNS.items()):
+            available = self.available(column)
+            if available is not None and available < 0:
+                raise ReservedQuantityError(BELOW_RESERVED_MSG.format(
+                    self.prod_id, getattr(self, column), column, getattr(self, reserved)))
+
+    def restock_counter(self, amt, slot):
+        """
+        Add 'amt' of products to the HotCounter 'slot' instead of the row of this
+        ProductInfo, so concurrent restocks of a hot product do not queue up.
+        """
+        ProductInformation.logger.info("Restock id {} with amount {} in slot {}.".format(
+            self.prod_id, amt, slot))
+        if self.new_qty is None:
+            raise DataValidationError(BAD_DATA_MSG)
+        ProductInformation.repository().increment(self, amt, slot)
+        return self
+
+    def mark_hot(self):
+        """
+        Flags the ProductInformation as hot, so reads add up its HotCounters.
+        """
+        ProductInformation.logger.info("Mark id {} as hot.".format(self.prod_id))
+        ProductInformation.repository().mark_hot(self)
+
+    def restock_if_needed(self):
+        """
+        Runs the automatic restock if the ProductInformation has a restock level.
+        """
+        if self.restock_level is not None and self.restock_level > 0:
+            new_qty = self.new_qty
+            self.automatic_restock()
+            self.restocked += self.new_qty - new_qty
+
     def automatic_restock(self):
         """
         Adds new products if product quantity drops below 'restock_level'
@@ -186,98 +618,282 @@ class ProductInformation(db.Model):
         Args:
             data (dict): A dictionary containing the ProductInformation data
         """
-        if not isinstance(data, dict):
-            raise DataValidationError(BAD_DATA_MSG)
-        #retrive all the data
-        data_prod_id = data.get(PROD_ID)
-        if data_prod_id is not None:
-            raise DataValidationError(BAD_DATA_MSG)
-        data_prod_name = data.get(PROD_NAME)
-        data_new_qty = data.get(NEW_QTY)
-        data_used_qty = data.get(USED_QTY)
-        data_open_boxed_qty = data.get(OPEN_BOXED_QTY)
-        data_restock_level = data.get(RESTOCK_LEVEL)
-        data_restock_amt = data.get(RESTOCK_AMT)
-
-        # Ensure optional fields are not smaller than default values.
-        if (data_new_qty is not None and data_new_qty < 0) or \
-                (data_used_qty is not None and data_used_qty < 0) or \
-                (data_open_boxed_qty is not None and data_open_boxed_qty < 0) \
-                or \
-                (data_restock_level is not None and data_restock_level < DEFAULT_RESTOCK_LEVEL) or \
-                (data_restock_amt is not None and data_restock_amt < 0):
-            raise DataValidationError(BAD_DATA_MSG)
-
-        # update ProductInformation only if necessary data is provided
-
-        if data_prod_name is not None:
-            self.prod_name = data_prod_name
-        if data_new_qty is not None:
-            self.new_qty = int(data_new_qty)
-        if data_used_qty is not None:
-            self.used_qty = int(data_used_qty)
-        if data_open_boxed_qty is not None:
-            self.open_boxed_qty = int(data_open_boxed_qty)
-        if data_restock_level is not None:
-            self.restock_level = int(data_restock_level)
-        if data_restock_amt is not None:
-            self.restock_amt = int(data_restock_amt)
+        return self.assign_update(validated(validate_update, data))
 
+    def assign_update(self, values):
+        """ Sets the fields of this ProductInformation the values validate_update returned give """
+        for field, value in values.items():
+            setattr(self, field, value)
         return self
 
+    @staticmethod
+    def deserialize_restock(data):
+        """ Returns the amount of a restock request, or raises a DataValidationError """
+        values, errors = validate_restock(data)
+        if errors:
+            raise DataValidationError(INVALID_RESTOCK_MSG)
+        return values[RESTOCK_AMT]
+
+    @staticmethod
+    def repository():
+        """ Returns the Repository of the configured STORAGE_BACKEND """
+        from app import storage
+        return storage.get_repository()
+
+    @staticmethod
+    def save_all(prod_infos):
+        """
+        Saves ProductInformations in one transaction per database, or at once in memory.
+
+        The change sequence numbers of all of them are taken from the counter
+        with a single increment.
+        """
+        if not prod_infos:
+            return
+        ProductInformation.logger.info("Save/update {} products.".format(len(prod_infos)))
+        ProductInformation.repository().save_all(prod_infos)
+
+    @staticmethod
+    def commit(*sessions):
+        """
+        Commits the sessions ProductInformations were written with.
+
+        With sharding the change counter lives on the primary database. It is
+        committed after the shards, so change_seq values still become visible
+        in commit order.
+        """
+        for session in sessions:
+            if session is not db.session:
+                session.commit()
+        db.session.commit()
+
+    @staticmethod
+    def rollback(*sessions):
+        """ Rolls back the sessions ProductInformations were written with """
+        for session in sessions:
+            if session is not db.session:
+                session.rollback()
+        db.session.rollback()
+
     @staticmethod
     def init_db():
         """ Initialize database """
         ProductInformation.logger.info('Initializing database')
-        db.create_all()
+        ProductInformation.repository().create_all()
 
     @staticmethod
-    def find(prod_id):
-        """ Find an ProductInformation by the prod_id """
+    def find(prod_id, fields=None):
+        """ Find an ProductInformation by the prod_id, loading only the given FIELDS and version """
         ProductInformation.logger.info("Look for id {}.".format(prod_id))
-        return ProductInformation.query.get(prod_id)
+        return ProductInformation.repository().find(prod_id, fields)
+
+    @staticmethod
+    def find_many(prod_ids, fields=None):
+        """ Returns the ProductInformation with the given prod_ids in prod_id order """
+        ProductInformation.logger.info("Look for {} ids.".format(len(prod_ids)))
+        if not prod_ids:
+            return []
+        return ProductInformation.find_all((BY_IDS, prod_ids), fields=fields)
 
     @staticmethod
-    def find_by_name(name):
+    def check_fields(fields):
+        """ Raises DataValidationError unless fields is a non-empty list of FIELDS """
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown or not fields:
+            raise DataValidationError(BAD_PARAMETER_MSG)
+
+    @staticmethod
+    def load_fields(fields, *columns):
+        """
+        Returns the query option loading only the columns of fields and columns.
+
+        The other columns are loaded on access while the instance is attached
+        to a session; serialize(fields) does not access them.
+        """
+        ProductInformation.check_fields(fields)
+        return load_only(*(list(fields) + list(columns)))
+
+    @staticmethod
+    def find_all(criterion=None, after=None, limit=None, sort=PROD_ID, descending=False,
+                 fields=None):
+        """ Returns the ProductInformation matching a criterion in the given order
+
+        With sharding every shard is queried in parallel and the results are merged.
+        Products without a restock level are left out when sorting by RESTOCK_DISTANCE.
+
+        Args:
+            criterion (tuple): the (kind, value) to filter by, or None to match everything
+            after (int): only products after this prod_id are returned (sorting by prod_id only)
+            limit (int): the maximum number of products to return
+            sort (string): the key of SORT_COLUMNS to sort by, ties are broken by prod_id
+            descending (bool): whether to sort in descending order
+            fields (list): the FIELDS to load, or None for all the columns
+        """
+        if sort not in SORT_COLUMNS or (after is not None and sort != PROD_ID):
+            raise DataValidationError(BAD_PARAMETER_MSG)
+        return ProductInformation.repository().find_all(criterion, after, limit, sort,
+                                                        descending, fields)
+
+    @staticmethod
+    def find_by_name(name, after=None, limit=None, **options):
         """ Returns all inventories with the given name
 
         Args:
             name (string): the name of the inventory you want to match
+            options: the sort, descending and fields arguments of find_all()
         """
         ProductInformation.logger.info("Look for name {}.".format(name))
-        return ProductInformation.query.filter(ProductInformation.prod_name == name).all()
+        return ProductInformation.find_all((BY_NAME, name), after, limit, **options)
+
+    @staticmethod
+    def find_by_name_prefix(prefix, after=None, limit=None, **options):
+        """ Returns all inventories whose name starts with the given prefix
+
+        Args:
+            prefix (string): the start of the names you want to match
+            options: the sort, descending and fields arguments of find_all()
+        """
+        ProductInformation.logger.info("Look for names starting with {}.".format(prefix))
+        return ProductInformation.find_all((BY_NAME_PREFIX, prefix), after, limit, **options)
 
     @staticmethod
-    def find_by_quantity(quantity):
+    def find_by_quantity(quantity, after=None, limit=None, **options):
         """ Returns all inventories with the given quantity
 
         Args:
             quantity (int): the quantity of the inventory you want to match
+            options: the sort, descending and fields arguments of find_all()
         """
         ProductInformation.logger.info("Look for product with quantity {}.".format(quantity))
-        return ProductInformation.query.filter(
-            ProductInformation.new_qty + ProductInformation.used_qty
-            + ProductInformation.open_boxed_qty == quantity).all()
+        return ProductInformation.find_all((BY_QUANTITY, quantity), after, limit, **options)
 
     @staticmethod
-    def find_by_condition(condition):
+    def find_by_condition(condition, after=None, limit=None, **options):
         """ Returns all inventories with the given condition
 
         Args:
             condition (string): the condition of the inventory you want to match
+            options: the sort, descending and fields arguments of find_all()
         """
         ProductInformation.logger.info("Look for product of condition {}.".format(condition))
-        if condition == "new":
-            return ProductInformation.query.filter(ProductInformation.new_qty > 0).all()
-        elif condition == "used":
-            return ProductInformation.query.filter(ProductInformation.used_qty > 0).all()
-        elif condition == "open-boxed":
-            return ProductInformation.query.filter(ProductInformation.open_boxed_qty > 0).all()
-        else:
+        if condition not in CONDITIONS:
             raise DataValidationError(BAD_PARAMETER_MSG)
+        return ProductInformation.find_all((BY_CONDITION, CONDITIONS[condition]), after, limit,
+                                           **options)
 
     @staticmethod
-    def list_all():
+    def list_all(after=None, limit=None, **options):
         """ Returns all ProductInformation in the database """
         ProductInformation.logger.info("List all products.")
-        return ProductInformation.query.all()
+        return ProductInformation.find_all(None, after, limit, **options)
+
+    @staticmethod
+    def find_changes(since, limit):
+        """ Returns the latest change of every product written after a sequence number
+
+        Updated products and tombstones of deleted products are merged in
+        change_seq order, so each product shows up at most once.
+
+        Args:
+            since (int): only changes with a greater change_seq are returned
+            limit (int): the maximum number of changes to return
+        """
+        ProductInformation.logger.info("Look for changes since {}.".format(since))
+        return ProductInformation.repository().find_changes(since, limit)
+
+    @staticmethod
+    def find_movements(prod_id, since, limit):
+        """ Returns the StockMovements of a product after a movement_id, oldest first
+
+        Args:
+            prod_id (int): the product, which may have been deleted since
+            since (int): only movements with a greater movement_id are returned
+            limit (int): the maximum number of movements to return
+        """
+        ProductInformation.logger.info("Look for movements of id {} since {}.".format(prod_id,
+                                                                                     since))
+        return ProductInformation.repository().find_movements(prod_id, since, limit)
+
+    @staticmethod
+    def compact_ledger(before):
+        """ Folds the StockMovements of every product and condition older than a time
+
+        The movements are replaced by one snapshot movement holding their sum,
+        so the ledger still adds up to the quantities. Returns the number of
+        movements folded.
+
+        Args:
+            before (datetime): only movements created before this UTC time are folded
+        """
+        ProductInformation.logger.info("Compact the stock ledger before {}.".format(before))
+        return ProductInformation.repository().compact_ledger(before)
+
+    @staticmethod
+    def reserve(prod_id, condition, quantity, ttl):
+        """ Holds products of a condition for a checkout
+
+        The quantity is only reserved if that many are available, checked and
+        taken in one step, so concurrent reservations never hold more than
+        there is. Returns the Reservation, or None if the product does not
+        exist or has too few available.
+
+        Args:
+            prod_id (int): the product to reserve
+            condition (string): the condition of the products, a key of CONDITIONS
+            quantity (int): the number of products to hold
+            ttl (float): the seconds until the reservation expires
+        """
+        ProductInformation.logger.info("Reserve {} {} of id {}.".format(quantity, condition,
+                                                                        prod_id))
+        if condition not in CONDITIONS:
+            raise DataValidationError(BAD_PARAMETER_MSG)
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+        return ProductInformation.repository().reserve(prod_id, condition, quantity, expires_at)
+
+    @staticmethod
+    def find_reservation(prod_id, reservation_id):
+        """ Returns the Reservation of a product with the reservation_id, or None """
+        return ProductInformation.repository().find_reservation(prod_id, reservation_id)
+
+    @staticmethod
+    def confirm_reservation(prod_id, reservation_id):
+        """ Sells the products of a held Reservation and returns it, None if it is not held """
+        ProductInformation.logger.info("Confirm reservation {} of id {}.".format(reservation_id,
+                                                                                 prod_id))
+        return ProductInformation.repository().confirm_reservation(prod_id, reservation_id)
+
+    @staticmethod
+    def release_reservation(prod_id, reservation_id):
+        """ Makes the products of a held Reservation available again and returns it, or None """
+        ProductInformation.logger.info("Release reservation {} of id {}.".format(reservation_id,
+                                                                                 prod_id))
+        return ProductInformation.repository().release_reservation(prod_id, reservation_id)
+
+    @staticmethod
+    def expire_reservations(limit):
+        """ Releases up to limit held Reservations past their expiry, the oldest first
+
+        Returns the number of reservations expired.
+        """
+        return ProductInformation.repository().expire_reservations(datetime.utcnow(), limit)
+
+    @staticmethod
+    def fold_counters():
+        """ Folds the restocks waiting in the HotCounters into the product rows
+
+        Every product is saved as one restock, which also runs its automatic
+        restock. Products left without restocks to fold stop being hot.
+        Returns the number of products folded.
+        """
+        return ProductInformation.repository().fold_counters()
+
+    @staticmethod
+    def current_change_seq():
+        """ Returns the change sequence number of the last write """
+        return ProductInformation.repository().current_change_seq()
+
+@event.listens_for(ProductInformation, 'refresh')
+def forget_pending(prod_info, context, attrs):
+    """ Drops the HotCounter restocks of a ProductInformation whose quantities are reloaded """
+    if attrs is None or NEW_QTY in attrs:
+        prod_info.pending = None
@@ -0,0 +1,102 @@
+"""
+Query Result Cache
+
+QueryCache keeps the encoded responses of the product list in memory, keyed
+by the path, sorted query arguments and Accept header of the request. The
+entries belong to one write generation, the value of the change counter
+that save(), save_all() and delete() increment. A request reads the
+counter first and the cache is emptied as soon as it has moved, so a
+cached response is never older than the last write, whichever process
+wrote it. A hit costs the read of the one counter row instead of the query
+and the encoding.
+
+Under @read_only the counter and the list are read from the one replica the
+session picked, so a response is cached under the generation of the rows it
+holds. A generation older than the cached one comes from a replica further
+behind: the request misses and its response is not cached, so replicas at
+different lags do not keep emptying each other's entries.
+
+The entries are evicted least recently used first to keep the cached bodies
+under QUERY_CACHE_MAX_BYTES (0 disables the cache).
+"""
+
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, make_response
+from flask_api import status
+from app.coalescing import request_key
+from app.models import ProductInformation
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+class QueryCache(object):
+    """ An LRU cache of encoded responses, emptied whenever the write generation moves """
+
+    def __init__(self, app):
+        self.app = app
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        app.config.setdefault('QUERY_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)
+
+    def clear(self, generation=None):
+        """ Drops every entry, starts a generation and zeroes the counters """
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+            self.generation = generation
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, generation, key):
+        """ Returns the (status, headers, body) cached for key in generation, or None """
+        with self.lock:
+            if self.generation is None or generation > self.generation:
+                self.entries = OrderedDict()
+                self.size = 0
+                self.generation = generation
+            entry = self.entries.pop(key, None) if generation == self.generation else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, generation, key, entry):
+        """ Caches the (status, headers, body) of key, evicting the least recently used entries """
+        max_bytes = self.app.config['QUERY_CACHE_MAX_BYTES']
+        size = len(entry[2])
+        with self.lock:
+            if generation != self.generation or size > max_bytes:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[2])
+            self.entries[key] = entry
+            self.size += size
+            while self.size > max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+
+    def cached(self, function):
+        """ Decorator answering repeated requests of a read handler from the cache """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.app.config['QUERY_CACHE_MAX_BYTES']:
+                return function(*args, **kwargs)
+            generation = ProductInformation.current_change_seq()
+            key = request_key()
+            entry = self.get(generation, key)
+            if entry is not None:
+                return Response(entry[2], status=entry[0], headers=entry[1])
+            response = make_response(function(*args, **kwargs))
+            if response.status_code == status.HTTP_200_OK and not response.is_streamed:
+                self.put(generation, key, (response.status_code, list(response.headers.items()),
+                                           response.get_data()))
+            return response
+        return wrapper
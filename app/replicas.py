@@ -0,0 +1,149 @@
+"""
+Read Replica Routing
+
+RoutingSQLAlchemy is a drop-in SQLAlchemy extension whose sessions send the
+reads of handlers decorated with @read_only to one of the read replicas in
+SQLALCHEMY_REPLICA_URIS. Everything else goes to the primary database:
+
+  - writes, and every read of a session after it has written
+  - reads of a client for REPLICA_STICKY_SECONDS after one of its requests
+    wrote, so clients always read their own writes
+
+A session picks the least busy replica on its first read and keeps it until
+it is closed, so the reads of a request see one replica, on one connection,
+however far behind it is.
+"""
+
+import itertools
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+import sqlalchemy
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.dml import UpdateBase
+from app.vcap_services import get_database_uri, get_replica_uris
+
+# Cookie keeping a client on the primary right after it wrote
+PRIMARY_COOKIE = 'inventory_read_primary'
+DEFAULT_STICKY_SECONDS = 5
+# Session.info keys marking sessions that have written and holding the replica a session reads
+WROTE = 'wrote'
+REPLICA = 'replica'
+
+def read_only(function):
+    """ Lets a request handler read from a replica """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        g.use_replica = PRIMARY_COOKIE not in request.cookies
+        return function(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def on_primary():
+    """ Sends the reads of the block to the primary database, even in @read_only handlers """
+    if not has_request_context():
+        yield
+        return
+    use_replica = g.get('use_replica')
+    g.use_replica = False
+    try:
+        yield
+    finally:
+        g.use_replica = use_replica
+
+class RoutingSession(SignallingSession):
+    """ A session that reads from a replica inside @read_only handlers """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or self.info.get(WROTE) or isinstance(clause, UpdateBase):
+            return SignallingSession.get_bind(self, mapper, clause)
+        if has_request_context() and g.get('use_replica'):
+            engine = self.info.get(REPLICA)
+            if engine is None:
+                engine = self.info[REPLICA] = self.db.get_replica_engine(self.app)
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def close(self):
+        """ Closes the session, letting its next read pick a replica again """
+        self.info.pop(REPLICA, None)
+        SignallingSession.close(self)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy extension creating RoutingSessions """
+
+    def __init__(self, app=None, **kwargs):
+        self._uri_engines = {}
+        self._uri_lock = Lock()
+        self._round_robin = itertools.count()
+        SQLAlchemy.__init__(self, app, **kwargs)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_DATABASE_URI', None)
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', None)
+        app.config.setdefault('REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+        SQLAlchemy.init_app(self, app)
+
+        @app.after_request
+        def stick_to_primary(response):
+            """ Keeps a client that just wrote on the primary for a while """
+            if g.get(WROTE):
+                response.set_cookie(PRIMARY_COOKIE, '1',
+                                    max_age=app.config['REPLICA_STICKY_SECONDS'])
+            return response
+
+    def get_engine(self, app, bind=None):
+        if app.config['SQLALCHEMY_DATABASE_URI'] is None:
+            app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+        return SQLAlchemy.get_engine(self, app, bind)
+
+    def get_uri_engine(self, app, uri):
+        """ Returns an engine for a database URI outside of SQLALCHEMY_BINDS """
+        with self._uri_lock:
+            engine = self._uri_engines.get(uri)
+            if engine is None:
+                info = make_url(uri)
+                options = {'convert_unicode': True}
+                self.apply_pool_defaults(app, options)
+                self.apply_driver_hacks(app, info, options)
+                engine = self._uri_engines[uri] = sqlalchemy.create_engine(info, **options)
+            return engine
+
+    def get_replica_engines(self, app):
+        """ Returns the engines of the configured read replicas """
+        if app.config['SQLALCHEMY_REPLICA_URIS'] is None:
+            app.config['SQLALCHEMY_REPLICA_URIS'] = get_replica_uris()
+        return [self.get_uri_engine(app, uri) for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
+
+    def get_replica_engine(self, app):
+        """
+        Returns the least busy read replica engine, taking turns among equally busy ones,
+        or None if no replica is configured.
+        """
+        engines = self.get_replica_engines(app)
+        if not engines:
+            return None
+        start = next(self._round_robin) % len(engines)
+        return min(engines[start:] + engines[:start], key=connections_in_use)
+
+def connections_in_use(engine):
+    """ Returns the number of connections an engine has checked out """
+    checkedout = getattr(engine.pool, 'checkedout', None)
+    return checkedout() if checkedout else 0
+
+@sqlalchemy.event.listens_for(RoutingSession, 'after_flush')
+def mark_written(session, flush_context):
+    """ Keeps a session, and the client of the request, on the primary once it has written """
+    session.info[WROTE] = True
+    if has_request_context():
+        g.wrote = True
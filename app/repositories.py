@@ -0,0 +1,1008 @@
+"""
+Product Storage
+
+ProductInformation keeps the domain logic (deserialize, restock,
+automatic_restock) and reads and writes the products through the Repository
+of the STORAGE_BACKEND setting:
+
+    sql     SqlRepository, the SQL database sharded by SQLALCHEMY_SHARD_URIS (default)
+    memory  MemoryRepository, an in-memory engine local to the process
+
+The in-memory engine is meant for edge nodes and test rigs without a
+database server. It keeps every column of the products in an array of its
+own, finds the row of a prod_id with one dictionary lookup and indexes the
+names, conditions and total quantities as well as the order of every sort
+key, so lookups take microseconds. Rows become ProductInformation instances
+when they are read. Like the identity map of a SQL session, the instances
+read or saved with the thread's db.session are kept until the session is
+removed at the end of the request: reading a product again returns the same
+instance, with the changes that are not saved yet, and one without changes
+is refreshed from the store. Criteria match the saved values. Names are
+compared case-sensitively. With STORAGE_SNAPSHOT_PATH set the
+products, their stock ledger and reservations are loaded from that file on
+first use and written back to it by storage.snapshot() and when the process
+exits.
+
+Finders hand the repositories (kind, value) criteria, see the BY_ constants
+of app.models, so that every backend can answer them its own way.
+"""
+
+import atexit
+import heapq
+import json
+import os
+import threading
+from datetime import datetime
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import bindparam, event, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import flag_modified, instance_state, set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+from app import db, shards
+from app.models import BY_IDS, BY_NAME, BY_NAME_PREFIX, BY_QUANTITY, CHANGE_SEQ, CONDITIONS, \
+    CONFIRMED, CREATED_AT, DELETE, EXPIRED, EXPIRES_AT, HELD, MOVEMENT_ID, NEW, NEW_QTY, \
+    OPEN_BOXED_QTY, PROD_ID, RELEASED, RESERVE, RESERVED_COLUMNS, RESTOCK, RESTOCK_DISTANCE, \
+    SNAPSHOT, SORT_COLUMNS, TIMESTAMP_FORMAT, USED_QTY, ChangeCounter, HotCounter, \
+    ProductInformation, ProductTombstone, Reservation, StockMovement
+from app.sharding import Descending
+
+# Backends of the STORAGE_BACKEND setting
+SQL = 'sql'
+MEMORY = 'memory'
+# Columns of a stored product, in table order
+COLUMNS = [column.key for column in ProductInformation.__table__.columns]
+CONDITION_COLUMNS = [NEW_QTY, USED_QTY, OPEN_BOXED_QTY]
+# Columns holding the restocks taken out of the HotCounters
+PENDING_COLUMNS = [NEW_QTY, 'total_qty', RESTOCK_DISTANCE]
+# Keys of a snapshot
+SNAPSHOT_COLUMNS = 'columns'
+SNAPSHOT_ROWS = 'rows'
+SNAPSHOT_TOMBSTONES = 'tombstones'
+SNAPSHOT_MOVEMENTS = 'movements'
+SNAPSHOT_RESERVATIONS = 'reservations'
+# Key of the in-memory identity map in the info of the thread's db.session
+IDENTITIES = 'memory_identities'
+
+UNKNOWN_BACKEND_MSG = "Unknown STORAGE_BACKEND '{}', use 'sql' or 'memory'"
+STALE_MSG = "Product with id '{}' was modified concurrently"
+
+class Repository(object):
+    """ Reads and writes the products, see the ProductInformation methods of the same names """
+
+    def create_all(self):
+        """ Creates the storage of the products """
+        raise NotImplementedError
+
+    def find(self, prod_id, fields=None):
+        """ Returns the product with the prod_id, or None """
+        raise NotImplementedError
+
+    def find_all(self, criterion, after, limit, sort, descending, fields):
+        """ Returns the products matching a criterion in the order of the sort key """
+        raise NotImplementedError
+
+    def save_all(self, prod_infos):
+        """
+        Saves the products, raising StaleDataError if one was written since it was read
+        and ReservedQuantityError if one has fewer products than its reservations hold
+        """
+        raise NotImplementedError
+
+    def delete(self, prod_info):
+        """ Deletes a product, leaving a tombstone for the change feed """
+        raise NotImplementedError
+
+    def find_changes(self, since, limit):
+        """ Returns the products and tombstones written after a change_seq in change_seq order """
+        raise NotImplementedError
+
+    def current_change_seq(self):
+        """ Returns the change_seq of the last write """
+        raise NotImplementedError
+
+    def find_movements(self, prod_id, since, limit):
+        """ Returns the StockMovements of a product after a movement_id, oldest first """
+        raise NotImplementedError
+
+    def compact_ledger(self, before):
+        """ Folds the StockMovements older than before into snapshots, returns how many """
+        raise NotImplementedError
+
+    def increment(self, prod_info, amt, slot):
+        """ Adds a restock of a hot product to one of its HotCounters """
+        raise NotImplementedError
+
+    def mark_hot(self, prod_info):
+        """ Flags a product as hot without changing its version """
+        raise NotImplementedError
+
+    def fold_counters(self):
+        """ Folds the HotCounters into the products, returns how many products """
+        raise NotImplementedError
+
+    def reserve(self, prod_id, condition, quantity, expires_at):
+        """ Holds a quantity if it is available and returns the Reservation, or None """
+        raise NotImplementedError
+
+    def find_reservation(self, prod_id, reservation_id):
+        """ Returns the Reservation of a product with the reservation_id, or None """
+        raise NotImplementedError
+
+    def confirm_reservation(self, prod_id, reservation_id):
+        """ Sells a held Reservation and returns it, or None if it is not held """
+        raise NotImplementedError
+
+    def release_reservation(self, prod_id, reservation_id):
+        """ Releases a held Reservation and returns it, or None if it is not held """
+        raise NotImplementedError
+
+    def expire_reservations(self, now, limit):
+        """ Releases up to limit held Reservations expired by now, returns how many """
+        raise NotImplementedError
+
+class SqlRepository(Repository):
+    """ Stores the products in the SQL database, on the shards if there are any """
+
+    def create_all(self):
+        db.create_all()
+        shards.create_all()
+        ChangeCounter.seed()
+
+    def find(self, prod_id, fields=None):
+        query = shards.session_for(prod_id).query(ProductInformation)
+        if fields is not None:
+            query = query.options(ProductInformation.load_fields(fields, 'version', 'hot'))
+        prod_info = query.get(prod_id)
+        if prod_info is not None and prod_info.hot:
+            SqlRepository.load_pending(query.session, [prod_info])
+        return prod_info
+
+    @staticmethod
+    def load_pending(session, prod_infos):
+        """ Adds the restocks waiting in the HotCounters to the quantities of products """
+        if not prod_infos:
+            return
+        pending = dict((prod_info.prod_id, {}) for prod_info in prod_infos)
+        counters = session.query(HotCounter.prod_id, HotCounter.slot, HotCounter.delta) \
+            .filter(HotCounter.prod_id.in_(list(pending)), HotCounter.delta != 0)
+        for prod_id, slot, delta in counters:
+            pending[prod_id][slot] = delta
+        for prod_info in prod_infos:
+            prod_info.add_pending(pending[prod_info.prod_id])
+
+    @staticmethod
+    def take_pending(session, prod_info):
+        """
+        Writes the restocks a product was loaded with to its row and takes them
+        out of its HotCounters, in the transaction of the save
+        """
+        for column in PENDING_COLUMNS:
+            flag_modified(prod_info, column)
+        table = HotCounter.__table__
+        for slot, delta in prod_info.pending.items():
+            session.execute(table.update()
+                            .where((table.c.prod_id == prod_info.prod_id) & (table.c.slot == slot))
+                            .values(delta=table.c.delta - delta))
+
+    @staticmethod
+    def expression(criterion):
+        """ Returns the SQL expression of a criterion """
+        kind, value = criterion
+        if kind == BY_IDS:
+            return ProductInformation.prod_id.in_(value)
+        if kind == BY_NAME:
+            return ProductInformation.prod_name == value
+        if kind == BY_NAME_PREFIX:
+            pattern = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            return ProductInformation.prod_name.like(pattern, escape='\\')
+        if kind == BY_QUANTITY:
+            return ProductInformation.new_qty + ProductInformation.used_qty \
+                + ProductInformation.open_boxed_qty == value
+        return getattr(ProductInformation, value) > 0
+
+    def find_all(self, criterion, after, limit, sort, descending, fields):
+        column = getattr(ProductInformation, SORT_COLUMNS[sort])
+        if fields is not None:
+            columns = ProductInformation.load_fields(fields, SORT_COLUMNS[sort], 'hot')
+        if criterion is not None:
+            criterion = SqlRepository.expression(criterion)
+
+        def query(session):
+            """ Runs the query on one shard """
+            query = session.query(ProductInformation)
+            if fields is not None:
+                query = query.options(columns)
+            if criterion is not None:
+                query = query.filter(criterion)
+            if after is not None:
+                query = query.filter(column < after if descending else column > after)
+            if sort == RESTOCK_DISTANCE:
+                query = query.filter(column.isnot(None))
+            order = [column.desc() if descending else column]
+            if sort != PROD_ID:
+                order.append(ProductInformation.prod_id)
+            prod_infos = query.order_by(*order).limit(limit).all()
+            SqlRepository.load_pending(session, [prod_info for prod_info in prod_infos
+                                                 if prod_info.hot])
+            return prod_infos
+
+        def key(prod_info):
+            """ Returns the merge key of a product """
+            value = getattr(prod_info, SORT_COLUMNS[sort])
+            return (Descending(value) if descending else value, prod_info.prod_id)
+
+        results = shards.scatter(query)
+        return shards.merge(results, key)[:limit]
+
+    def save_all(self, prod_infos):
+        by_session = {}
+        movements = []
+        for prod_info in prod_infos:
+            # the version check catches reservations held since the product was read
+            prod_info.check_reserved()
+        for prod_info in prod_infos:
+            movements.append(prod_info.prepare_save())
+            by_session.setdefault(shards.session_for(prod_info.prod_id), []).append(prod_info)
+        for session, group in by_session.items():
+            # before the tombstone query autoflushes the products
+            for prod_info in group:
+                if prod_info.pending:
+                    SqlRepository.take_pending(session, prod_info)
+            prod_ids = [prod_info.prod_id for prod_info in group]
+            session.query(ProductTombstone).filter(ProductTombstone.prod_id.in_(prod_ids)) \
+                .delete(synchronize_session=False)
+            session.add_all(group)
+            # waits for the row locks and checks the versions before the counter is locked
+            session.flush()
+        first_seq = ChangeCounter.next_value(len(prod_infos)) - len(prod_infos) + 1
+        change_seqs = {}
+        for offset, (prod_info, changes) in enumerate(zip(prod_infos, movements)):
+            change_seqs[prod_info.prod_id] = first_seq + offset
+            set_committed_value(prod_info, CHANGE_SEQ, first_seq + offset)
+            for movement in changes:
+                movement.change_seq = first_seq + offset
+            shards.session_for(prod_info.prod_id).add_all(changes)
+        for session, group in by_session.items():
+            SqlRepository.stamp(session, dict((prod_info.prod_id, change_seqs[prod_info.prod_id])
+                                              for prod_info in group))
+        ProductInformation.commit(*by_session)
+        for prod_info in prod_infos:
+            prod_info.pending = None
+
+    def delete(self, prod_info):
+        session = shards.session_for(prod_info.prod_id)
+        movements = prod_info.prepare_delete()
+        session.query(HotCounter).filter(HotCounter.prod_id == prod_info.prod_id) \
+            .delete(synchronize_session=False)
+        session.delete(prod_info)
+        session.flush()
+        change_seq = ChangeCounter.next_value()
+        session.merge(ProductTombstone(prod_id=prod_info.prod_id, change_seq=change_seq))
+        for movement in movements:
+            movement.change_seq = change_seq
+        session.add_all(movements)
+        ProductInformation.commit(session)
+
+    @staticmethod
+    def stamp(session, change_seqs):
+        """ Sets the change_seq of flushed products, by prod_id, without bumping their version """
+        table = ProductInformation.__table__
+        session.execute(table.update().where(table.c.prod_id == bindparam('stamp_prod_id'))
+                        .values(change_seq=bindparam('stamp_change_seq')),
+                        [{'stamp_prod_id': prod_id, 'stamp_change_seq': change_seq}
+                         for prod_id, change_seq in change_seqs.items()])
+
+    def find_changes(self, since, limit):
+        def query(session):
+            """ Runs the query on one shard """
+            prod_infos = session.query(ProductInformation) \
+                .filter(ProductInformation.change_seq > since) \
+                .order_by(ProductInformation.change_seq).limit(limit).all()
+            tombstones = session.query(ProductTombstone) \
+                .filter(ProductTombstone.change_seq > since) \
+                .order_by(ProductTombstone.change_seq).limit(limit).all()
+            return sorted(prod_infos + tombstones, key=lambda change: change.change_seq)
+
+        results = shards.scatter(query)
+        return shards.merge(results, lambda change: change.change_seq)[:limit]
+
+    def current_change_seq(self):
+        return ChangeCounter.current_value()
+
+    def find_movements(self, prod_id, since, limit):
+        return shards.session_for(prod_id).query(StockMovement) \
+            .filter(StockMovement.prod_id == prod_id, StockMovement.movement_id > since) \
+            .order_by(StockMovement.movement_id).limit(limit).all()
+
+    def compact_ledger(self, before):
+        def compact(session):
+            """ Folds the movements on one shard, one product and condition per transaction """
+            groups = session.query(StockMovement.prod_id, StockMovement.condition, func.count(),
+                                   func.sum(StockMovement.delta),
+                                   func.max(StockMovement.movement_id),
+                                   func.max(StockMovement.created_at),
+                                   func.max(StockMovement.change_seq)) \
+                .filter(StockMovement.created_at < before) \
+                .group_by(StockMovement.prod_id, StockMovement.condition) \
+                .having(func.count() > 1).all()
+            session.commit()
+            folded = 0
+            for prod_id, condition, count, delta, movement_id, created_at, change_seq in groups:
+                deleted = session.query(StockMovement) \
+                    .filter(StockMovement.prod_id == prod_id, StockMovement.condition == condition,
+                            StockMovement.created_at < before,
+                            StockMovement.movement_id <= movement_id) \
+                    .delete(synchronize_session=False)
+                if deleted != count:
+                    # another compactor folded them first
+                    session.rollback()
+                    continue
+                if delta:
+                    session.add(StockMovement(movement_id=movement_id, prod_id=prod_id,
+                                              condition=condition, delta=int(delta),
+                                              reason=SNAPSHOT, created_at=created_at,
+                                              change_seq=change_seq))
+                session.commit()
+                folded += count
+            return folded
+
+        return sum(shards.scatter(compact))
+
+    def increment(self, prod_info, amt, slot):
+        session = shards.session_for(prod_info.prod_id)
+        table = HotCounter.__table__
+        counter = (table.c.prod_id == prod_info.prod_id) & (table.c.slot == slot)
+        increment = table.update().where(counter).values(delta=table.c.delta + amt)
+        try:
+            if session.execute(increment).rowcount == 0:
+                session.execute(table.insert().values(prod_id=prod_info.prod_id, slot=slot,
+                                                      delta=amt))
+        except IntegrityError:
+            # another writer created the counter first
+            session.rollback()
+            session.execute(increment)
+        session.add(prod_info.movement(NEW, amt, RESTOCK, None))
+        session.commit()
+        session.refresh(prod_info)
+        SqlRepository.load_pending(session, [prod_info])
+
+    def mark_hot(self, prod_info):
+        session = shards.session_for(prod_info.prod_id)
+        table = ProductInformation.__table__
+        session.execute(table.update().where(table.c.prod_id == prod_info.prod_id)
+                        .values(hot=True))
+        session.commit()
+
+    def fold_counters(self):
+        def find_pending(session):
+            """ Returns the prod_ids with restocks in their counters on one shard """
+            return [prod_id for prod_id, in session.query(HotCounter.prod_id)
+                    .filter(HotCounter.delta != 0).distinct().order_by(HotCounter.prod_id)]
+
+        folded = []
+        for prod_ids in shards.scatter(find_pending):
+            for prod_id in prod_ids:
+                session = shards.session_for(prod_id)
+                prod_info = session.query(ProductInformation).get(prod_id)
+                if prod_info is None:
+                    SqlRepository.drop_counters(session, prod_id)
+                    continue
+                # the flag may have been cleared while the counters were written
+                SqlRepository.load_pending(session, [prod_info])
+                prod_info.hot = True
+                # saved as a restock of what the counters held
+                prod_info.restock(0)
+                try:
+                    self.save_all([prod_info])
+                except StaleDataError:
+                    # written concurrently, the next round folds what is left
+                    ProductInformation.rollback(session)
+                    continue
+                folded.append(prod_id)
+
+        def cool_down(session):
+            """ Clears the flag of the hot products on one shard that had nothing to fold """
+            counters = HotCounter.__table__
+            table = ProductInformation.__table__
+            session.execute(counters.delete().where(counters.c.delta == 0))
+            cooled = table.update().where(table.c.hot.is_(True)) \
+                .where(~table.c.prod_id.in_(db.select([counters.c.prod_id])))
+            if folded:
+                cooled = cooled.where(~table.c.prod_id.in_(folded))
+            session.execute(cooled.values(hot=False))
+            session.commit()
+
+        shards.scatter(cool_down)
+        return len(folded)
+
+    @staticmethod
+    def drop_counters(session, prod_id):
+        """ Drops the counters of a product restocked while it was deleted """
+        counters = session.query(HotCounter).filter(HotCounter.prod_id == prod_id)
+        delta = sum(counter.delta for counter in counters)
+        counters.delete(synchronize_session=False)
+        if delta:
+            # keeps the ledger of the deleted product at zero
+            session.add(StockMovement(prod_id=prod_id, condition=NEW, delta=-delta,
+                                      reason=DELETE, created_at=datetime.utcnow()))
+        session.commit()
+
+    def reserve(self, prod_id, condition, quantity, expires_at):
+        session = shards.session_for(prod_id)
+        column = CONDITIONS[condition]
+        table = ProductInformation.__table__
+        reserved = func.coalesce(table.c[RESERVED_COLUMNS[column]], 0)
+        # the check and the hold are one statement, so two checkouts cannot both pass
+        held = session.execute(
+            table.update()
+            .where((table.c.prod_id == prod_id) & (table.c[column] - reserved >= quantity))
+            .values({RESERVED_COLUMNS[column]: reserved + quantity,
+                     'version': table.c.version + 1, 'change_type': RESERVE}))
+        if held.rowcount == 0:
+            ProductInformation.rollback(session)
+            return None
+        # only a hold that passed takes a change sequence number
+        SqlRepository.stamp(session, {prod_id: ChangeCounter.next_value()})
+        reservation = Reservation(prod_id=prod_id, condition=condition, quantity=quantity,
+                                  status=HELD, expires_at=expires_at)
+        session.add(reservation)
+        ProductInformation.commit(session)
+        return reservation
+
+    def find_reservation(self, prod_id, reservation_id):
+        reservation = shards.session_for(prod_id).query(Reservation).get(reservation_id)
+        if reservation is None or reservation.prod_id != prod_id:
+            return None
+        return reservation
+
+    @staticmethod
+    def settle(session, reservation, status):
+        """ Moves a held Reservation to status in the transaction, False if it is not held """
+        table = Reservation.__table__
+        return session.execute(
+            table.update()
+            .where((table.c.reservation_id == reservation.reservation_id) &
+                   (table.c.status == HELD))
+            .values(status=status)).rowcount == 1
+
+    @staticmethod
+    def release_holds(session, reservations):
+        """ Makes the quantities of settled Reservations available again in the transaction """
+        released = {}
+        for reservation in reservations:
+            counts = released.setdefault(reservation.prod_id, {})
+            column = RESERVED_COLUMNS[CONDITIONS[reservation.condition]]
+            counts[column] = counts.get(column, 0) + reservation.quantity
+        if not released:
+            return
+        table = ProductInformation.__table__
+        for prod_id, counts in sorted(released.items()):
+            values = dict((column, table.c[column] - quantity)
+                          for column, quantity in counts.items())
+            values.update(version=table.c.version + 1, change_type=RESERVE)
+            session.execute(table.update().where(table.c.prod_id == prod_id).values(values))
+        first_seq = ChangeCounter.next_value(len(released)) - len(released) + 1
+        SqlRepository.stamp(session, dict((prod_id, first_seq + offset) for offset, prod_id
+                                          in enumerate(sorted(released))))
+
+    def confirm_reservation(self, prod_id, reservation_id):
+        session = shards.session_for(prod_id)
+        reservation = self.find_reservation(prod_id, reservation_id)
+        if reservation is None or not SqlRepository.settle(session, reservation, CONFIRMED):
+            ProductInformation.rollback(session)
+            return None
+        prod_info = self.find(prod_id)
+        if prod_info is None:
+            ProductInformation.rollback(session)
+            return None
+        # saved with the status, so a lost version race leaves the reservation held
+        self.save_all([prod_info.confirm(reservation.condition, reservation.quantity)])
+        return reservation
+
+    def release_reservation(self, prod_id, reservation_id):
+        session = shards.session_for(prod_id)
+        reservation = self.find_reservation(prod_id, reservation_id)
+        if reservation is None or not SqlRepository.settle(session, reservation, RELEASED):
+            ProductInformation.rollback(session)
+            return None
+        SqlRepository.release_holds(session, [reservation])
+        ProductInformation.commit(session)
+        return reservation
+
+    def expire_reservations(self, now, limit):
+        def find_lapsed(session):
+            """ Returns the held reservations past their expiry on one shard, oldest first """
+            return session.query(Reservation) \
+                .filter(Reservation.status == HELD, Reservation.expires_at <= now) \
+                .order_by(Reservation.expires_at).limit(limit).all()
+
+        lapsed = shards.merge(shards.scatter(find_lapsed),
+                              lambda reservation: reservation.expires_at)[:limit]
+        by_session = {}
+        for reservation in lapsed:
+            by_session.setdefault(shards.session_for(reservation.prod_id), []).append(reservation)
+        expired = 0
+        for session, group in by_session.items():
+            # confirmed or released since they were read
+            group = [reservation for reservation in group
+                     if SqlRepository.settle(session, reservation, EXPIRED)]
+            SqlRepository.release_holds(session, group)
+            ProductInformation.commit(session)
+            expired += len(group)
+        return expired
+
+@event.listens_for(SignallingSession, 'after_soft_rollback')
+def forget_identities(session, previous_transaction):
+    """ Drops the in-memory products of a session rolled back, like SQL expires its instances """
+    session.info.pop(IDENTITIES, None)
+
+class MemoryRepository(Repository):
+    """ Stores the products in parallel arrays in memory, optionally snapshotted to a file """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.loaded = False
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """ Drops every product """
+        self.columns = dict((column, []) for column in COLUMNS)
+        self.rows = {}          # prod_id -> index into the columns
+        self.free = []          # rows of deleted products
+        self.names = {}         # prod_name -> prod_ids
+        self.totals = {}        # total_qty -> prod_ids
+        self.conditions = dict((column, set()) for column in CONDITION_COLUMNS)
+        # sort key -> sorted (has value, value, prod_id) entries
+        self.sorted = dict((sort, []) for sort in SORT_COLUMNS)
+        self.tombstones = {}    # prod_id -> change_seq
+        self.log = []           # (change_seq, prod_id) of every write, in change_seq order
+        self.change_seq = 0
+        self.movements = {}     # prod_id -> StockMovements in movement_id order
+        self.movement_id = 0
+        self.reservations = {}  # reservation_id -> Reservation
+        self.expiries = []      # heap of the (expires_at, reservation_id) of held reservations
+        self.reservation_id = 0
+
+    def load(self):
+        """ Loads the snapshot on first use """
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        for row in snapshot[SNAPSHOT_ROWS]:
+            values = dict(zip(snapshot[SNAPSHOT_COLUMNS], row))
+            self.put([values.get(column) for column in COLUMNS])
+        self.tombstones = dict((prod_id, change_seq)
+                               for prod_id, change_seq in snapshot[SNAPSHOT_TOMBSTONES])
+        self.log = sorted([(self.columns[CHANGE_SEQ][row], prod_id)
+                           for prod_id, row in self.rows.items()] +
+                          [(change_seq, prod_id) for prod_id, change_seq in self.tombstones.items()])
+        self.change_seq = snapshot[CHANGE_SEQ]
+        for values in snapshot.get(SNAPSHOT_MOVEMENTS, []):
+            values[CREATED_AT] = datetime.strptime(values[CREATED_AT], TIMESTAMP_FORMAT)
+            self.movements.setdefault(values[PROD_ID], []).append(StockMovement(**values))
+            self.movement_id = max(self.movement_id, values[MOVEMENT_ID])
+        for values in snapshot.get(SNAPSHOT_RESERVATIONS, []):
+            values[EXPIRES_AT] = datetime.strptime(values[EXPIRES_AT], TIMESTAMP_FORMAT)
+            self.add_reservation(Reservation(**values))
+
+    def snapshot(self):
+        """ Writes the products to the snapshot file, replacing the previous one atomically """
+        with self.lock:
+            if self.path is None or not self.loaded:
+                return
+            snapshot = {
+                SNAPSHOT_COLUMNS: COLUMNS,
+                SNAPSHOT_ROWS: [[self.columns[column][row] for column in COLUMNS]
+                                for row in self.rows.values()],
+                SNAPSHOT_TOMBSTONES: sorted(self.tombstones.items()),
+                SNAPSHOT_MOVEMENTS: [movement.serialize() for movements in self.movements.values()
+                                     for movement in movements],
+                SNAPSHOT_RESERVATIONS: [reservation.serialize()
+                                        for reservation in self.reservations.values()],
+                CHANGE_SEQ: self.change_seq
+            }
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.rename(temporary, self.path)
+
+    def entry(self, sort, prod_id):
+        """ Returns the sort index entry of a product, or None if it is left out of the sort """
+        value = self.columns[SORT_COLUMNS[sort]][self.rows[prod_id]]
+        if value is None and sort == RESTOCK_DISTANCE:
+            return None
+        return (value is not None, value, prod_id)
+
+    def put(self, values):
+        """ Stores the column values of a product, replacing its previous row """
+        prod_id = values[0]  # prod_id is the first column
+        row = self.rows.get(prod_id)
+        if row is not None:
+            self.unindex(prod_id)
+        elif self.free:
+            row = self.free.pop()
+        else:
+            row = len(self.columns[PROD_ID])
+            for column in COLUMNS:
+                self.columns[column].append(None)
+        for column, value in zip(COLUMNS, values):
+            self.columns[column][row] = value
+        self.rows[prod_id] = row
+        self.index(prod_id)
+
+    def index(self, prod_id):
+        """ Adds a stored product to the indexes """
+        row = self.rows[prod_id]
+        self.names.setdefault(self.columns['prod_name'][row], set()).add(prod_id)
+        self.totals.setdefault(self.columns['total_qty'][row], set()).add(prod_id)
+        for column in CONDITION_COLUMNS:
+            if (self.columns[column][row] or 0) > 0:
+                self.conditions[column].add(prod_id)
+        for sort, entries in self.sorted.items():
+            entry = self.entry(sort, prod_id)
+            if entry is not None:
+                insort(entries, entry)
+
+    def unindex(self, prod_id):
+        """ Removes a stored product from the indexes """
+        row = self.rows[prod_id]
+        for index, column in [(self.names, 'prod_name'), (self.totals, 'total_qty')]:
+            prod_ids = index[self.columns[column][row]]
+            prod_ids.discard(prod_id)
+            if not prod_ids:
+                del index[self.columns[column][row]]
+        for column in CONDITION_COLUMNS:
+            self.conditions[column].discard(prod_id)
+        for sort, entries in self.sorted.items():
+            entry = self.entry(sort, prod_id)
+            if entry is not None:
+                del entries[bisect_left(entries, entry)]
+
+    def instance(self, prod_id):
+        """ Returns a ProductInformation holding the stored columns of a product """
+        row = self.rows[prod_id]
+        prod_info = ProductInformation()
+        # values in the instance dictionary count as loaded and unchanged
+        prod_info.__dict__.update((column, self.columns[column][row]) for column in COLUMNS)
+        return prod_info
+
+    @staticmethod
+    def identities():
+        """ Returns the products read or saved with the thread's db.session, by prod_id """
+        return db.session().info.setdefault(IDENTITIES, {})
+
+    def read(self, prod_id):
+        """ Returns the thread's instance of a stored product, refreshed unless it was changed """
+        identities = MemoryRepository.identities()
+        prod_info = identities.get(prod_id)
+        if prod_info is None:
+            prod_info = identities[prod_id] = self.instance(prod_id)
+        elif not instance_state(prod_info).committed_state:
+            # reloaded like an instance expired by a commit
+            row = self.rows[prod_id]
+            prod_info.__dict__.update((column, self.columns[column][row]) for column in COLUMNS)
+        return prod_info
+
+    def matches(self, criterion):
+        """ Returns the prod_ids matching a criterion """
+        kind, value = criterion
+        if kind == BY_IDS:
+            return set(prod_id for prod_id in value if prod_id in self.rows)
+        if kind == BY_NAME:
+            return self.names.get(value, set())
+        if kind == BY_NAME_PREFIX:
+            names = self.sorted['prod_name']
+            prod_ids = set()
+            for _, name, prod_id in islice(names, bisect_left(names, (True, value)), None):
+                if not name.startswith(value):
+                    break
+                prod_ids.add(prod_id)
+            return prod_ids
+        if kind == BY_QUANTITY:
+            return self.totals.get(value, set())
+        return self.conditions[value]
+
+    def scan(self, sort, after, descending):
+        """ Yields the prod_ids in the order of a sort key, walking its index """
+        entries = self.sorted[sort]
+        bound = (True, after, after)
+        if not descending:
+            start = 0 if after is None else bisect_right(entries, bound)
+            for _, _, prod_id in islice(entries, start, None):
+                yield prod_id
+            return
+        # walks the runs of equal values backwards, each in ascending prod_id
+        # order like ORDER BY value DESC, prod_id
+        stop = len(entries) if after is None else bisect_left(entries, bound)
+        while stop > 0:
+            start = bisect_left(entries, entries[stop - 1][:2])
+            for _, _, prod_id in islice(entries, start, stop):
+                yield prod_id
+            stop = start
+
+    def create_all(self):
+        with self.lock:
+            self.load()
+
+    def find(self, prod_id, fields=None):
+        if fields is not None:
+            ProductInformation.check_fields(fields)
+        with self.lock:
+            self.load()
+            if prod_id not in self.rows:
+                return None
+            return self.read(prod_id)
+
+    def find_all(self, criterion, after, limit, sort, descending, fields):
+        if fields is not None:
+            ProductInformation.check_fields(fields)
+        with self.lock:
+            self.load()
+            if criterion is None:
+                prod_ids = list(islice(self.scan(sort, after, descending), limit))
+            else:
+                entries = [self.entry(sort, prod_id) for prod_id in self.matches(criterion)
+                           if after is None or
+                           (prod_id < after if descending else prod_id > after)]
+                entries = [entry for entry in entries if entry is not None]
+                key = (lambda entry: (Descending(entry[:2]), entry[2])) if descending else None
+                if limit is None:
+                    entries = sorted(entries, key=key)
+                else:
+                    entries = heapq.nsmallest(limit, entries, key=key)
+                prod_ids = [prod_id for _, _, prod_id in entries]
+            return [self.read(prod_id) for prod_id in prod_ids]
+
+    def save_all(self, prod_infos):
+        with self.lock:
+            self.load()
+            for prod_info in prod_infos:
+                if prod_info.prod_id is None:
+                    entries = self.sorted[PROD_ID]
+                    prod_info.prod_id = entries[-1][2] + 1 if entries else 1
+                row = self.rows.get(prod_info.prod_id)
+                version = None if row is None else self.columns['version'][row]
+                if prod_info.version != version:
+                    raise StaleDataError(STALE_MSG.format(prod_info.prod_id))
+                prod_info.check_reserved()
+            movements = []
+            for offset, prod_info in enumerate(prod_infos):
+                movements.extend(prod_info.prepare_save(self.change_seq + offset + 1))
+            self.append_movements(movements)
+            for prod_info in prod_infos:
+                prod_info.version = (prod_info.version or 0) + 1
+                values = [getattr(prod_info, column) for column in COLUMNS]
+                self.put(values)
+                # the instance now matches the store, like after a commit
+                for column, value in zip(COLUMNS, values):
+                    set_committed_value(prod_info, column, value)
+                MemoryRepository.identities()[prod_info.prod_id] = prod_info
+                self.tombstones.pop(prod_info.prod_id, None)
+                self.log.append((prod_info.change_seq, prod_info.prod_id))
+            self.change_seq += len(prod_infos)
+            self.compact_log()
+
+    def delete(self, prod_info):
+        with self.lock:
+            self.load()
+            row = self.rows.get(prod_info.prod_id)
+            if row is None or self.columns['version'][row] != prod_info.version:
+                raise StaleDataError(STALE_MSG.format(prod_info.prod_id))
+            self.append_movements(prod_info.prepare_delete(self.change_seq + 1))
+            self.unindex(prod_info.prod_id)
+            MemoryRepository.identities().pop(prod_info.prod_id, None)
+            del self.rows[prod_info.prod_id]
+            for column in COLUMNS:
+                self.columns[column][row] = None
+            self.free.append(row)
+            self.change_seq += 1
+            self.tombstones[prod_info.prod_id] = self.change_seq
+            self.log.append((self.change_seq, prod_info.prod_id))
+            self.compact_log()
+
+    def change_seq_of(self, prod_id):
+        """ Returns the change_seq of the last write to a product """
+        row = self.rows.get(prod_id)
+        if row is None:
+            return self.tombstones.get(prod_id)
+        return self.columns[CHANGE_SEQ][row]
+
+    def compact_log(self):
+        """ Drops the log entries of the writes overwritten since, once they are the majority """
+        if len(self.log) > 2 * (len(self.rows) + len(self.tombstones)):
+            self.log = [(change_seq, prod_id) for change_seq, prod_id in self.log
+                        if self.change_seq_of(prod_id) == change_seq]
+
+    def find_changes(self, since, limit):
+        with self.lock:
+            self.load()
+            changes = []
+            for change_seq, prod_id in islice(self.log, bisect_left(self.log, (since + 1,)), None):
+                if len(changes) == limit:
+                    break
+                if self.change_seq_of(prod_id) != change_seq:
+                    continue
+                if prod_id in self.rows:
+                    changes.append(self.read(prod_id))
+                else:
+                    changes.append(ProductTombstone(prod_id=prod_id, change_seq=change_seq))
+            return changes
+
+    def current_change_seq(self):
+        with self.lock:
+            self.load()
+            return self.change_seq
+
+    def append_movements(self, movements):
+        """ Numbers StockMovements and appends them to the ledger """
+        for movement in movements:
+            self.movement_id += 1
+            movement.movement_id = self.movement_id
+            self.movements.setdefault(movement.prod_id, []).append(movement)
+
+    def find_movements(self, prod_id, since, limit):
+        with self.lock:
+            self.load()
+            movements = self.movements.get(prod_id, [])
+            ids = [movement.movement_id for movement in movements]
+            start = bisect_right(ids, since)
+            return movements[start:start + limit]
+
+    def compact_ledger(self, before):
+        with self.lock:
+            self.load()
+            folded = 0
+            for prod_id, movements in list(self.movements.items()):
+                groups = {}
+                for movement in movements:
+                    if movement.created_at < before:
+                        groups.setdefault(movement.condition, []).append(movement)
+                kept = [movement for movement in movements if movement.created_at >= before]
+                for condition, group in groups.items():
+                    delta = sum(movement.delta for movement in group)
+                    if len(group) == 1:
+                        kept.extend(group)
+                        continue
+                    folded += len(group)
+                    if delta:
+                        last = group[-1]
+                        kept.append(StockMovement(
+                            movement_id=last.movement_id, prod_id=prod_id, condition=condition,
+                            delta=delta, reason=SNAPSHOT, created_at=last.created_at,
+                            change_seq=max(movement.change_seq for movement in group)))
+                if kept:
+                    self.movements[prod_id] = sorted(kept, key=lambda movement: movement.movement_id)
+                else:
+                    del self.movements[prod_id]
+            return folded
+
+    def increment(self, prod_info, amt, slot):
+        # without row locks there is nothing to spread the restocks over
+        self.save_all([prod_info.restock(amt)])
+
+    def mark_hot(self, prod_info):
+        pass
+
+    def fold_counters(self):
+        return 0
+
+    def add_reservation(self, reservation):
+        """ Numbers a Reservation if it is new and keeps it, with its expiry if it is held """
+        if reservation.reservation_id is None:
+            reservation.reservation_id = self.reservation_id + 1
+        self.reservation_id = max(self.reservation_id, reservation.reservation_id)
+        self.reservations[reservation.reservation_id] = reservation
+        if reservation.status == HELD:
+            heapq.heappush(self.expiries, (reservation.expires_at, reservation.reservation_id))
+
+    def reserve(self, prod_id, condition, quantity, expires_at):
+        with self.lock:
+            self.load()
+            if prod_id not in self.rows:
+                return None
+            prod_info = self.instance(prod_id)
+            available = prod_info.available(CONDITIONS[condition])
+            if available is None or available < quantity:
+                return None
+            self.save_all([prod_info.hold(condition, quantity)])
+            reservation = Reservation(prod_id=prod_id, condition=condition, quantity=quantity,
+                                      status=HELD, expires_at=expires_at)
+            self.add_reservation(reservation)
+            return reservation
+
+    def find_reservation(self, prod_id, reservation_id):
+        with self.lock:
+            self.load()
+            reservation = self.reservations.get(reservation_id)
+            if reservation is None or reservation.prod_id != prod_id:
+                return None
+            return reservation
+
+    def release_holds(self, reservations, status):
+        """ Settles held Reservations with status and makes their quantities available again """
+        prod_infos = {}
+        for reservation in reservations:
+            reservation.status = status
+            if reservation.prod_id not in self.rows:
+                continue
+            if reservation.prod_id not in prod_infos:
+                prod_infos[reservation.prod_id] = self.instance(reservation.prod_id)
+            prod_infos[reservation.prod_id].release(reservation.condition, reservation.quantity)
+        self.save_all([prod_infos[prod_id] for prod_id in sorted(prod_infos)])
+
+    def confirm_reservation(self, prod_id, reservation_id):
+        with self.lock:
+            reservation = self.find_reservation(prod_id, reservation_id)
+            if reservation is None or reservation.status != HELD or prod_id not in self.rows:
+                return None
+            self.save_all([self.instance(prod_id).confirm(reservation.condition,
+                                                          reservation.quantity)])
+            reservation.status = CONFIRMED
+            return reservation
+
+    def release_reservation(self, prod_id, reservation_id):
+        with self.lock:
+            reservation = self.find_reservation(prod_id, reservation_id)
+            if reservation is None or reservation.status != HELD:
+                return None
+            self.release_holds([reservation], RELEASED)
+            return reservation
+
+    def expire_reservations(self, now, limit):
+        with self.lock:
+            self.load()
+            lapsed = []
+            while self.expiries and self.expiries[0][0] <= now and len(lapsed) < limit:
+                _, reservation_id = heapq.heappop(self.expiries)
+                reservation = self.reservations[reservation_id]
+                # confirmed and released reservations stay in the heap until they lapse
+                if reservation.status == HELD:
+                    lapsed.append(reservation)
+            self.release_holds(lapsed, EXPIRED)
+            return len(lapsed)
+
+class Storage(object):
+    """ Hands out the Repository of the STORAGE_BACKEND setting """
+
+    def __init__(self, app):
+        self.app = app
+        self.repositories = {}
+        self.lock = threading.Lock()
+        app.config.setdefault('STORAGE_BACKEND', SQL)
+        app.config.setdefault('STORAGE_SNAPSHOT_PATH', None)
+        atexit.register(self.snapshot)
+
+    def get_repository(self):
+        """ Returns the Repository of the configured backend, creating it on first use """
+        backend = self.app.config['STORAGE_BACKEND']
+        repository = self.repositories.get(backend)
+        if repository is not None:
+            return repository
+        with self.lock:
+            if backend not in self.repositories:
+                if backend == SQL:
+                    self.repositories[backend] = SqlRepository()
+                elif backend == MEMORY:
+                    self.repositories[backend] = MemoryRepository(
+                        self.app.config['STORAGE_SNAPSHOT_PATH'])
+                else:
+                    raise ValueError(UNKNOWN_BACKEND_MSG.format(backend))
+            return self.repositories[backend]
+
+    def snapshot(self):
+        """ Writes the in-memory products to STORAGE_SNAPSHOT_PATH, if they were used """
+        repository = self.repositories.get(MEMORY)
+        if repository is not None:
+            repository.snapshot()
+
+    def reset(self):
+        """ Drops the repositories, and with them the in-memory products """
+        with self.lock:
+            self.repositories = {}
@@ -0,0 +1,54 @@
+"""
+Stock Reservations
+
+POST /inventory/<prod_id>/reservations holds products of one condition for a
+checkout until the reservation is confirmed, released or expires. The hold
+raises the reserved quantity of the product in one conditional statement
+that only matches while enough products are available, so concurrent
+checkouts never hold more than there is. Products serialize the available
+quantities next to the quantities; a confirmation takes the held products
+out of the quantity for good, like a write recorded in the stock ledger.
+
+ReservationSweeper releases the holds past their expiry every
+RESERVATION_SWEEP_INTERVAL seconds, up to RESERVATION_SWEEP_BATCH per
+transaction, the oldest first: the SQL database walks the expires_at index
+of the held reservations and the in-memory engine pops a heap ordered by
+expiry. run.py starts the sweeper with the service.
+"""
+
+import logging
+from app.models import ProductInformation
+from app.workers import PeriodicWorker
+
+# Default reservation settings, overridden by the app config
+DEFAULT_TTL = 900
+DEFAULT_MAX_TTL = 86400
+DEFAULT_SWEEP_INTERVAL = 1.0
+DEFAULT_SWEEP_BATCH = 500
+
+class ReservationSweeper(PeriodicWorker):
+    """ Periodically releases the reservations past their expiry """
+    logger = logging.getLogger(__name__)
+    thread_name = 'reservation-sweeper'
+    interval_key = 'RESERVATION_SWEEP_INTERVAL'
+    failure_msg = 'Expiring reservations failed: {}'
+
+    def __init__(self, app):
+        super(ReservationSweeper, self).__init__(app)
+        app.config.setdefault('RESERVATION_TTL', DEFAULT_TTL)
+        app.config.setdefault('RESERVATION_MAX_TTL', DEFAULT_MAX_TTL)
+        app.config.setdefault('RESERVATION_SWEEP_INTERVAL', DEFAULT_SWEEP_INTERVAL)
+        app.config.setdefault('RESERVATION_SWEEP_BATCH', DEFAULT_SWEEP_BATCH)
+
+    def sweep(self):
+        """ Expires the lapsed reservations a batch at a time and returns how many """
+        return self.run_once()
+
+    def work(self):
+        batch = self.app.config['RESERVATION_SWEEP_BATCH']
+        expired = 0
+        while True:
+            count = ProductInformation.expire_reservations(batch)
+            expired += count
+            if count < batch:
+                return expired
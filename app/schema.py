@@ -0,0 +1,146 @@
+"""
+Payload Schemas
+
+A schema declares the fields of a request payload once, as an ordered dict of
+field name to spec:
+    TYPE        INTEGER, NUMBER (an integer or a float) or STRING
+    MINIMUM     the smallest number accepted
+    ENUM        the strings accepted, if not any
+    REQUIRED    whether a full payload must give the field
+    UPDATABLE   False if a partial payload (an update) must not give the field
+    DEFAULT     the value of a field a full payload leaves out
+A missing field and a null one are the same.
+
+compile_schema() turns a schema into a validator function ahead of time: the
+type and range check of every field is bound into a closure and the error
+message formatted, so validating a payload is one pass over the fields that
+does not look anything up. A validator returns the values it accepted and
+every error, not just the first. validate_all() runs a validator over a list
+of payloads in one pass and returns the errors of every item, so a large
+batch or import chunk is accepted or rejected as a whole before anything is
+written.
+"""
+
+import numbers
+
+TYPE = 'type'
+MINIMUM = 'minimum'
+REQUIRED = 'required'
+UPDATABLE = 'updatable'
+DEFAULT = 'default'
+ENUM = 'enum'
+# Types of the fields
+INTEGER = 'integer'
+NUMBER = 'number'
+STRING = 'string'
+
+# str and unicode on Python 2, str on Python 3
+TEXT_TYPES = (str, type(u''))
+
+NOT_AN_OBJECT_MSG = 'body of request contained bad or no data'
+MISSING_MSG = 'missing {}'
+NOT_UPDATABLE_MSG = '{} cannot be updated'
+NOT_AN_INTEGER_MSG = '{} must be an integer'
+TOO_SMALL_MSG = '{} must be an integer of at least {}'
+NOT_A_NUMBER_MSG = '{} must be a number'
+NUMBER_TOO_SMALL_MSG = '{} must be a number of at least {}'
+NOT_A_STRING_MSG = '{} must be a string'
+NOT_ONE_OF_MSG = '{} must be one of {}'
+UNKNOWN_FIELDS_MSG = 'unknown fields {}'
+
+def is_integer(value):
+    """ Returns whether a decoded value is an integer, which a bool is not """
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+def is_number(value):
+    """ Returns whether a decoded value is an integer or a float, which a bool is not """
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+def compile_check(name, spec):
+    """ Returns a function returning the error of a given value of a field, or None """
+    if spec[TYPE] == STRING:
+        choices = spec.get(ENUM)
+        if choices is None:
+            message = NOT_A_STRING_MSG.format(name)
+            return lambda value: None if isinstance(value, TEXT_TYPES) else message
+        message = NOT_ONE_OF_MSG.format(name, ', '.join(choices))
+        choices = frozenset(choices)
+        return lambda value: None if isinstance(value, TEXT_TYPES) and value in choices \
+            else message
+    if spec[TYPE] == NUMBER:
+        is_valid, invalid_msg, too_small_msg = is_number, NOT_A_NUMBER_MSG, NUMBER_TOO_SMALL_MSG
+    else:
+        is_valid, invalid_msg, too_small_msg = is_integer, NOT_AN_INTEGER_MSG, TOO_SMALL_MSG
+    minimum = spec.get(MINIMUM)
+    if minimum is None:
+        message = invalid_msg.format(name)
+        return lambda value: None if is_valid(value) else message
+    message = too_small_msg.format(name, minimum)
+    return lambda value: None if is_valid(value) and value >= minimum else message
+
+def compile_schema(schema, partial=False, closed=False):
+    """
+    Compiles a schema into a validator function.
+
+    Args:
+        schema (OrderedDict): field name -> spec
+        partial (bool): whether the payloads are updates, which may leave out
+            the required fields but must not give the fields that are not UPDATABLE
+        closed (bool): whether fields besides those of the schema are an error
+    Returns validate(data), which returns (the given values, the errors) of a payload.
+    """
+    fields = []
+    for name, spec in schema.items():
+        if partial and not spec.get(UPDATABLE, True):
+            fields.append((name, None, NOT_UPDATABLE_MSG.format(name)))
+        else:
+            missing = MISSING_MSG.format(name) if spec.get(REQUIRED) and not partial else None
+            fields.append((name, compile_check(name, spec), missing))
+    known = frozenset(schema)
+
+    def validate(data):
+        """ Returns the values of the fields a payload gives and the errors of the payload """
+        if not isinstance(data, dict):
+            return {}, [NOT_AN_OBJECT_MSG]
+        values = {}
+        errors = []
+        for name, check, message in fields:
+            value = data.get(name)
+            if value is None:
+                if message is not None and check is not None:
+                    errors.append(message)
+            elif check is None:
+                errors.append(message)
+            else:
+                error = check(value)
+                if error is None:
+                    values[name] = value
+                else:
+                    errors.append(error)
+        if closed and len(data) > len(values):
+            unknown = sorted(str(key) for key in data if key not in known)
+            if unknown:
+                errors.append(UNKNOWN_FIELDS_MSG.format(', '.join(unknown)))
+        return values, errors
+
+    return validate
+
+def validate_all(validate, items):
+    """
+    Validates a list of payloads in one pass.
+
+    Returns the values of every payload, in order, and the (index, errors)
+    of the invalid ones.
+    """
+    results = []
+    invalid = []
+    for index, data in enumerate(items):
+        values, errors = validate(data)
+        results.append(values)
+        if errors:
+            invalid.append((index, errors))
+    return results, invalid
+
+def defaults(schema):
+    """ Returns the DEFAULT values of the fields of a schema that have one """
+    return dict((name, spec[DEFAULT]) for name, spec in schema.items() if DEFAULT in spec)
@@ -0,0 +1,116 @@
+"""
+Product Name Search
+
+NameIndex answers substring searches on product names from memory. It maps
+every substring of up to three characters of the lowercased names to the
+prod_ids containing it, so a search only checks the names holding all the
+trigrams of the query instead of the whole catalog, and a query of one or
+two characters is answered by its own entry.
+
+The index is loaded from the database on the first search. Before every
+search it applies the writes recorded in the change feed since then, so it
+also sees the writes of other processes. It reads the counter and the
+changes from the primary database, as a replica behind the index would look
+like a reset database. It takes memory in proportion to the total length of
+the names.
+"""
+
+import heapq
+from threading import Lock
+from app.models import PROD_ID, PROD_NAME, ProductInformation, ProductTombstone
+from app.replicas import on_primary
+
+GRAM_SIZE = 3
+# Changes read from the change feed at a time when catching up
+CATCH_UP_BATCH_SIZE = 1000
+# Names read at a time when loading the index
+LOAD_BATCH_SIZE = 10000
+
+def trigrams(text):
+    """ Returns the set of trigrams of a lowercased text """
+    return set(text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1))
+
+def grams(text):
+    """ Returns the set of substrings of up to GRAM_SIZE characters of a lowercased text """
+    return set(text[i:i + size] for size in range(1, GRAM_SIZE + 1)
+               for i in range(len(text) - size + 1))
+
+class NameIndex(object):
+    """ An in-memory index of the short substrings of the product names """
+
+    def __init__(self):
+        self.names = {}
+        self.grams = {}
+        self.change_seq = None
+        self.lock = Lock()
+
+    def add(self, prod_id, name):
+        """ Indexes the name of a product, replacing its previous name """
+        self.remove(prod_id)
+        name = (name or u'').lower()
+        self.names[prod_id] = name
+        for gram in grams(name):
+            self.grams.setdefault(gram, set()).add(prod_id)
+
+    def remove(self, prod_id):
+        """ Removes a product from the index """
+        name = self.names.pop(prod_id, None)
+        if name is None:
+            return
+        for gram in grams(name):
+            prod_ids = self.grams[gram]
+            prod_ids.discard(prod_id)
+            if not prod_ids:
+                del self.grams[gram]
+
+    def load(self):
+        """ Indexes the names of all the products """
+        change_seq = ProductInformation.current_change_seq()
+        self.names = {}
+        self.grams = {}
+        after = None
+        while True:
+            prod_infos = ProductInformation.list_all(after, LOAD_BATCH_SIZE,
+                                                     fields=[PROD_ID, PROD_NAME])
+            for prod_info in prod_infos:
+                self.add(prod_info.prod_id, prod_info.prod_name)
+            if len(prod_infos) < LOAD_BATCH_SIZE:
+                break
+            after = prod_infos[-1].prod_id
+        self.change_seq = change_seq
+
+    def refresh(self):
+        """ Applies the changes written since the last refresh, loading the index on first use """
+        change_seq = ProductInformation.current_change_seq()
+        # A counter behind the index means the database was reset
+        if self.change_seq is None or change_seq < self.change_seq:
+            self.load()
+        while self.change_seq < change_seq:
+            changes = ProductInformation.find_changes(self.change_seq, CATCH_UP_BATCH_SIZE)
+            for change in changes:
+                if isinstance(change, ProductTombstone):
+                    self.remove(change.prod_id)
+                else:
+                    self.add(change.prod_id, change.prod_name)
+                self.change_seq = change.change_seq
+            if len(changes) < CATCH_UP_BATCH_SIZE:
+                return
+
+    def search(self, text, limit):
+        """
+        Returns the prod_ids of up to limit products whose name contains text, ignoring case.
+
+        Names matching closer to their start rank first, then shorter names.
+        """
+        text = text.lower()
+        with self.lock:
+            with on_primary():
+                self.refresh()
+            if len(text) < GRAM_SIZE:
+                candidates = self.grams.get(text, ())
+            else:
+                sets = sorted((self.grams.get(gram, set()) for gram in trigrams(text)), key=len)
+                candidates = sets[0].intersection(*sets[1:])
+            matches = ((self.names[prod_id].find(text), len(self.names[prod_id]), prod_id)
+                       for prod_id in candidates if text in self.names[prod_id])
+            return [prod_id for _, _, prod_id in heapq.nsmallest(limit, matches)]
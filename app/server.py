@@ -3,16 +3,31 @@ Inverntory Management System Service
 """
 
 from __future__ import print_function
+import json
 import logging
 import sys
-from app import app
+from functools import partial
+from app import admission, app
 # Error handlers require app to be initialized so we must import
 # then only after we have initialized the Flask app instance
-from app import error_handlers
-from app.models import ProductInformation
-from flask import abort, jsonify, make_response, request, url_for
+from app import assets, batch, bulk_import, error_handlers, formats
+from app.coalescing import coalesce
+from app.events import ChangeBroker
+from app.hot_products import HotProducts
+from app.ledger import LedgerCompactor
+from app.models import CHANGE_SEQ, CONDITION, FIELDS, MOVEMENT_ID, NEW, PROD_ID, QUANTITY, \
+    SORT_COLUMNS, TTL, ProductInformation, validate_reservation
+from app.query_cache import QueryCache
+from app.replicas import read_only
+from app.reservations import ReservationSweeper
+from app.schema import is_integer
+from app.search import NameIndex
+from flask import Response, abort, jsonify, make_response, request, stream_with_context, url_for
 from flask_api import status
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
 from werkzeug.exceptions import BadRequest, NotFound
+from werkzeug.http import quote_etag
 
 ######################################################################
 #  Fixed Global Variables
@@ -31,19 +46,82 @@ INVALID_CONTENT_TYPE_MSG = 'Content-Type must be {}'
 METHOD_NOT_ALLOWED_MSG = 'Your request method is not supported.' \
         ' Check your HTTP method and try again.'
 NOT_FOUND_MSG = "Product with id '{}' was not found in Inventory"
+PRECONDITION_FAILED_MSG = "Product with id '{}' does not match If-Match. " \
+        "Retrieve it again and retry."
+RESERVATION_NOT_FOUND_MSG = "Reservation with id '{}' of product with id '{}' was not found"
+NOT_AVAILABLE_MSG = "Product with id '{}' has fewer than {} {} products available"
+NOT_HELD_MSG = "Reservation with id '{}' is no longer held"
+INVALID_RESERVATION_MSG = 'Invalid reservation: '
+TTL_RANGE_MSG = 'ttl must be more than 0 and at most {} seconds'
 INVALID_PARAMETER_MSG = 'Your request contains invalid parameters. ' \
         'Please check your request and try again.'
+# Paging and sorting query parameters of the product list
+PAGE_ARGS = ['after', 'limit', 'sort', 'order', 'fields']
+ASCENDING = 'asc'
+DESCENDING = 'desc'
+# Query parameters of the export besides the filters
+EXPORT_ARGS = ['format', 'after']
+# Number of name_contains results without a limit
+DEFAULT_SEARCH_LIMIT = 50
+# Products fetched at once by ids
+MAX_MULTI_GET_IDS = 1000
+# Rows written per transaction by /inventory/import
+MAX_IMPORT_CHUNK_SIZE = 10000
+# Change feed paging
+DEFAULT_CHANGES_LIMIT = 100
+MAX_CHANGES_LIMIT = 1000
 # Content type
 CONTENT_TYPE = 'Content-Type'
 JSON = 'application/json'
+EVENT_STREAM = 'text/event-stream'
+CSV = 'csv'
+NDJSON = 'ndjson'
+MSGPACK = 'msgpack'
+COLUMNAR = 'columnar'
+COLUMNAR_MSGPACK = 'columnar-msgpack'
+EXPORT_FORMATS = {
+    CSV: 'text/csv',
+    NDJSON: 'application/x-ndjson',
+    MSGPACK: formats.MSGPACK,
+    COLUMNAR: formats.COLUMNAR_JSON,
+    COLUMNAR_MSGPACK: formats.COLUMNAR_MSGPACK
+}
+# Export formats picked from the Accept header without a format parameter, CSV by default
+EXPORT_PREFERENCE = [CSV, NDJSON, MSGPACK, COLUMNAR, COLUMNAR_MSGPACK]
+# Headers
+CACHE_CONTROL = 'Cache-Control'
+CONTENT_DISPOSITION = 'Content-Disposition'
+VARY = 'Vary'
+LAST_EVENT_ID = 'Last-Event-ID'
 # Locations
 GET_PROD_INFO = 'get_prod_info'
 LOCATION = 'Location'
+ETAG = 'ETag'
+# Keys of multi-get responses
+IDS = 'ids'
+PRODUCTS = 'products'
+MISSING = 'missing'
+# Key of the operations of a batch request
+OPERATIONS = 'operations'
+
+# Publishes committed changes to the /inventory/events subscribers
+broker = ChangeBroker(app)
+# Folds old stock movements into snapshots (started by run.py)
+compactor = LedgerCompactor(app)
+# Releases the lapsed reservations (started by run.py)
+sweeper = ReservationSweeper(app)
+# Spreads the restocks of hot products over counter rows (folded by run.py)
+hot_products = HotProducts(app)
+# Answers name_contains searches
+name_index = NameIndex()
+# Keeps the encoded product lists until the next write
+query_cache = QueryCache(app)
 
 ######################################################################
 # API placeholder
 ######################################################################
 @app.route('/')
+@admission.unlimited
 def index():
     """
     Returns the homepage of the Inventory Management System
@@ -55,9 +133,52 @@ def index():
         200:
             description: the homepage is successfully returned.
     """
-    return app.send_static_file('index.html')
+    return assets.send_index()
+
+@app.route('/assets/<path:filename>', methods=[GET])
+@admission.unlimited
+def get_asset(filename):
+    """
+    Retrieve a fingerprinted static asset of the homepage
+    This endpoint returns a built asset in the best precompressed encoding the client accepts, cacheable forever.
+    ---
+    tags:
+      -     Inventory
+    parameters:
+      -     name: filename
+            in: path
+            description: fingerprinted path of the asset
+            type: string
+            required: true
+    responses:
+        200:
+            description: the asset is successfully returned.
+        404:
+            description: no asset is built under this path.
+    """
+    return assets.send_asset(filename)
+
+@app.route('/admission', methods=[GET])
+@admission.unlimited
+def get_admission_stats():
+    """
+    Return the admission control counters
+    This endpoint returns, for reads and writes, the concurrency limit, the requests running and
+    waiting for a slot, and how many requests were admitted, queued or shed since the start, along
+    with the requests rejected by the per client rate limit and cancelled by their deadline.
+    ---
+    tags:
+      -     Inventory
+    responses:
+        200:
+            description: The admission control counters
+    """
+    return jsonify(admission.serialize()), status.HTTP_200_OK
 
 @app.route('/inventory', methods=[GET])
+@read_only
+@query_cache.cached
+@coalesce
 def query_prod_info():
     """
     Retrieve a list of all the products in the inventory & query specific entries in the Inventory system
@@ -66,12 +187,35 @@ def query_prod_info():
     tags:
       -     Inventory
     description: The inventory endpoint allows you to query the inventory
+    produces:
+      -     application/json
+      -     application/msgpack
+      -     application/vnd.inventory.columnar+json
+      -     application/vnd.inventory.columnar+msgpack
     parameters:
+      -     name: ids
+            in: query
+            description: comma separated prod_ids of up to 1000 products to fetch at once (only combines
+                with fields); returns an object of the found products in the requested order and the
+                missing prod_ids
+            required: false
+            type: string
       -     name: prod_name
             in: query
             description: the name of the product you are looking for
             required: false
             type: string
+      -     name: name_prefix
+            in: query
+            description: find the products whose name starts with this text
+            required: false
+            type: string
+      -     name: name_contains
+            in: query
+            description: find the products whose name contains this text, ignoring case, best matches
+                first (at most limit, 50 by default; cannot be combined with other parameters but limit)
+            required: false
+            type: string
       -     name: quantity
             in: query
             description: if you want to check how many products have a specfic quantity
@@ -86,6 +230,45 @@ def query_prod_info():
                 - new
                 - used
                 - open_boxed
+      -     name: after
+            in: query
+            description: only return products with a greater prod_id (the last prod_id of the previous page)
+            required: false
+            type: integer
+      -     name: limit
+            in: query
+            description: the maximum number of products to return
+            required: false
+            type: integer
+      -     name: sort
+            in: query
+            description: sort the products by prod_id, prod_name, total quantity, new_qty or the distance
+                of the total quantity to the restock level (leaving out products that do not restock);
+                only prod_id can be combined with after
+            required: false
+            type: string
+            default: prod_id
+            enum:
+                - prod_id
+                - prod_name
+                - quantity
+                - new_qty
+                - restock_distance
+      -     name: order
+            in: query
+            description: the sort order
+            required: false
+            type: string
+            default: asc
+            enum:
+                - asc
+                - desc
+      -     name: fields
+            in: query
+            description: a comma separated list of the fields to return (e.g. prod_id,new_qty), only
+                those columns are read from the database
+            required: false
+            type: string
 
     responses:
       400:
@@ -103,32 +286,198 @@ def query_prod_info():
     else:
         app.logger.info("GET received, List all.")
 
-    all_prod_info = []
-    if request.args.get('prod_name'):
-        prod_name = request.args.get('prod_name')
-        all_prod_info = ProductInformation.find_by_name(prod_name)
-    elif request.args.get('quantity'):
-        quantity = request.args.get('quantity')
-        try:
-            quantity = int(quantity)
-            all_prod_info = ProductInformation.find_by_quantity(quantity)
-        except ValueError:
-            abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
-    elif request.args.get('condition'):
-        condition = request.args.get('condition')
-        if condition in ['new', 'used', 'open-boxed']:
-            all_prod_info = ProductInformation.find_by_condition(condition)
-        else:
+    after = get_int_arg('after')
+    limit = get_int_arg('limit', minimum=1)
+    sort = request.args.get('sort')
+    order = request.args.get('order', ASCENDING)
+    if (sort is not None and sort not in SORT_COLUMNS) or order not in [ASCENDING, DESCENDING]:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    if after is not None and sort not in [None, PROD_ID]:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    fields = get_fields_arg()
+    args = dict((key, value) for key, value in request.args.items() if key not in PAGE_ARGS)
+
+    if IDS in args:
+        if len(args) > 1 or after is not None or limit is not None or sort is not None:
             abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
-    elif not request.args:
-        all_prod_info = ProductInformation.list_all()
+        return multi_get(parse_ids(args[IDS]), fields)
+    if args.get('name_contains') and len(args) == 1 and after is None and sort is None:
+        prod_ids = name_index.search(args['name_contains'], limit or DEFAULT_SEARCH_LIMIT)
+        found = dict((prod_info.prod_id, prod_info)
+                     for prod_info in ProductInformation.find_many(prod_ids, fields))
+        all_prod_info = [found[prod_id] for prod_id in prod_ids if prod_id in found]
     else:
+        all_prod_info = get_finder(args)(after, limit, sort=sort or PROD_ID,
+                                         descending=order == DESCENDING, fields=fields)
+    results = [prod_info.serialize(fields) for prod_info in all_prod_info]
+    return make_products_response(results, status.HTTP_200_OK, fields=fields)
+
+@app.route('/inventory/lookup', methods=[POST])
+@read_only
+def lookup_prod_info():
+    """
+    Retrieve many products by prod_id at once
+    This endpoint is the POST variant of `GET /inventory?ids=` for lists too long for a URL. The
+    products are read with one query and returned in the requested order; the prod_ids that were
+    not found are listed separately.
+    ---
+    tags:
+      -     Inventory
+    consumes:
+      -     application/json
+      -     application/msgpack
+    produces:
+      -     application/json
+      -     application/msgpack
+      -     application/vnd.inventory.columnar+json
+      -     application/vnd.inventory.columnar+msgpack
+    parameters:
+      -     in: body
+            name: body
+            required: true
+            schema:
+                type: object
+                required:
+                    - ids
+                properties:
+                    ids:
+                        type: array
+                        description: the prod_ids of up to 1000 products
+                        items:
+                            type: integer
+      -     name: fields
+            in: query
+            description: a comma separated list of the fields to return (e.g. prod_id,new_qty)
+            required: false
+            type: string
+    responses:
+      400:
+          description: Bad Request (invalid or too many ids)
+      200:
+          description: The found products and the missing prod_ids
+          schema:
+            type: object
+            properties:
+                products:
+                    type: array
+                    items:
+                        $ref: '#/definitions/Product'
+                missing:
+                    type: array
+                    items:
+                        type: integer
+    """
+    data = get_payload()
+    app.logger.info("POST received, look up {}.".format(data))
+    prod_ids = data.get(IDS) if isinstance(data, dict) else None
+    if not isinstance(prod_ids, list) or \
+            any(not is_integer(prod_id) for prod_id in prod_ids):
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    return multi_get(prod_ids, get_fields_arg())
+
+@app.route('/inventory/export', methods=[GET])
+@read_only
+def export_prod_info():
+    """
+    Export all the products in the inventory as CSV or newline delimited JSON
+    This endpoint streams the products in prod_id order, reading them from the database a batch at
+    a time. It takes the filters of the inventory endpoint; if a download is interrupted, pass the
+    last prod_id received as `after` to resume it.
+    ---
+    tags:
+      -     Inventory
+    produces:
+      -     text/csv
+      -     application/x-ndjson
+      -     application/msgpack
+      -     application/vnd.inventory.columnar+json
+      -     application/vnd.inventory.columnar+msgpack
+    parameters:
+      -     name: format
+            in: query
+            description: the format of the export, picked from the Accept header if omitted (MessagePack
+                is a stream of products, the columnar formats a stream of one object per batch)
+            required: false
+            type: string
+            default: csv
+            enum:
+                - csv
+                - ndjson
+                - msgpack
+                - columnar
+                - columnar-msgpack
+      -     name: prod_name
+            in: query
+            description: only export the products with this name
+            required: false
+            type: string
+      -     name: name_prefix
+            in: query
+            description: only export the products whose name starts with this text
+            required: false
+            type: string
+      -     name: quantity
+            in: query
+            description: only export the products with this total quantity
+            required: false
+            type: integer
+      -     name: condition
+            in: query
+            description: only export the products of a certain condition (e.g. new, used, open_boxed)
+            required: false
+            type: string
+      -     name: after
+            in: query
+            description: only export products with a greater prod_id (the last prod_id received)
+            required: false
+            type: integer
+    responses:
+      400:
+          description: Bad Request (invalid format or filter)
+      200:
+          description: A CSV file with a header row, one JSON product per line, or a MessagePack stream
+    """
+    app.logger.info("GET received, export with {}.".format(request.args.to_dict()))
+    export_format = request.args.get('format')
+    if export_format is None:
+        media_types = [EXPORT_FORMATS[name] for name in EXPORT_PREFERENCE]
+        media_type = formats.negotiate(request.accept_mimetypes, media_types)
+        export_format = EXPORT_PREFERENCE[media_types.index(media_type)]
+    if export_format not in EXPORT_FORMATS:
         abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    after = get_int_arg('after')
+    args = dict((key, value) for key, value in request.args.items() if key not in EXPORT_ARGS)
+    find = get_finder(args)
+    batch_size = app.config['EXPORT_BATCH_SIZE']
 
-    results = [prod_info.serialize() for prod_info in all_prod_info]
-    return jsonify(results), status.HTTP_200_OK
+    def generate():
+        """ Yields the export a batch of products at a time """
+        last_prod_id = after
+        if export_format == CSV:
+            yield csv_row(FIELDS)
+        while True:
+            batch = find(last_prod_id, batch_size)
+            rows = [prod_info.serialize() for prod_info in batch]
+            if export_format == CSV:
+                yield ''.join(csv_row(row[field] for field in FIELDS) for row in rows)
+            elif export_format == NDJSON:
+                yield ''.join(json.dumps(row, sort_keys=True) + '\n' for row in rows)
+            elif export_format == MSGPACK:
+                yield b''.join(formats.encode(row, formats.MSGPACK) for row in rows)
+            elif rows:
+                document = formats.encode_products(rows, EXPORT_FORMATS[export_format])
+                yield document + '\n' if export_format == COLUMNAR else document
+            if len(batch) < batch_size:
+                return
+            last_prod_id = batch[-1].prod_id
+
+    filename = 'inventory.{}'.format(export_format)
+    return Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[export_format],
+                    headers={CONTENT_DISPOSITION: 'attachment; filename=' + filename})
 
 @app.route('/inventory/<int:prod_id>', methods=[GET])
+@read_only
+@coalesce
 def get_prod_info(prod_id):
     """
     Return ProductInformation identified by prod_id.
@@ -137,25 +486,230 @@ def get_prod_info(prod_id):
       -     Inventory
     produces:
       -     application/json
+      -     application/msgpack
+      -     application/vnd.inventory.columnar+json
+      -     application/vnd.inventory.columnar+msgpack
     parameters:
       -     name: prod_id
             in: path
             description: ID of Inventory entry to retrieve
             type: integer
             required: true
+      -     name: fields
+            in: query
+            description: a comma separated list of the fields to return (e.g. prod_id,new_qty)
+            required: false
+            type: string
     responses:
         200:
             description: Inventory entry returned
             schema:
                 $ref: '#/definitions/Product'
+            headers:
+                ETag:
+                    type: string
+                    description: version of the entry, to be sent back in If-Match
         404:
             description: Inventory entry not found
     """
     app.logger.info("GET received, retrieve id {}.".format(prod_id))
-    prod_info = ProductInformation.find(prod_id)
+    fields = get_fields_arg()
+    prod_info = ProductInformation.find(prod_id, fields)
     if not prod_info:
         raise NotFound(NOT_FOUND_MSG.format(prod_id))
-    return jsonify(prod_info.serialize()), status.HTTP_200_OK
+    return make_products_response(prod_info.serialize(fields), status.HTTP_200_OK,
+                                  {
+                                      ETAG: quote_etag(prod_info.etag())
+                                  }, fields)
+
+@app.route('/inventory/changes', methods=[GET])
+def query_changes():
+    """
+    Retrieve the products changed after a given change sequence number
+    This endpoint returns the latest change of every product written after `since`, in change
+    sequence order. Deleted products are returned as tombstones. Pass `next_since` of the
+    response as `since` of the next request to resume.
+    ---
+    tags:
+      -     Inventory
+    parameters:
+      -     name: since
+            in: query
+            description: the change sequence number to resume from (0 for everything)
+            required: false
+            type: integer
+            default: 0
+      -     name: limit
+            in: query
+            description: the maximum number of changes to return (at most 1000)
+            required: false
+            type: integer
+            default: 100
+    responses:
+      400:
+          description: Bad Request (invalid since or limit)
+      200:
+          description: A page of changes
+          schema:
+            type: object
+            properties:
+                changes:
+                    type: array
+                    items:
+                        type: object
+                        properties:
+                            change_seq:
+                                type: integer
+                            prod_id:
+                                type: integer
+                            deleted:
+                                type: boolean
+                            data:
+                                $ref: '#/definitions/Product'
+                next_since:
+                    type: integer
+                has_more:
+                    type: boolean
+    """
+    app.logger.info("GET received, list changes with {}.".format(request.args.to_dict()))
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', DEFAULT_CHANGES_LIMIT))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    if since < 0 or limit < 1 or limit > MAX_CHANGES_LIMIT:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+
+    changes = ProductInformation.find_changes(since, limit + 1)
+    has_more = len(changes) > limit
+    changes = [change.serialize_change() for change in changes[:limit]]
+    next_since = changes[-1][CHANGE_SEQ] if changes else since
+    return jsonify(changes=changes, next_since=next_since, has_more=has_more), status.HTTP_200_OK
+
+@app.route('/inventory/<int:prod_id>/movements', methods=[GET])
+@read_only
+def query_movements(prod_id):
+    """
+    Retrieve the stock movements of a product
+    This endpoint returns the stock ledger of a product, oldest first: one movement per change
+    of the quantity of a condition, with the reason (create, update, restock, automatic_restock,
+    confirm, delete, or snapshot for old movements folded together). The deltas of a condition add up to
+    its quantity. Pass `next_since` of the response as `since` of the next request to resume.
+    ---
+    tags:
+      -     Inventory
+    parameters:
+      -     name: prod_id
+            in: path
+            description: ID of the product, which may have been deleted
+            type: integer
+            required: true
+      -     name: since
+            in: query
+            description: the movement_id to resume from (0 for everything)
+            required: false
+            type: integer
+            default: 0
+      -     name: limit
+            in: query
+            description: the maximum number of movements to return (at most 1000)
+            required: false
+            type: integer
+            default: 100
+    responses:
+      400:
+          description: Bad Request (invalid since or limit)
+      200:
+          description: A page of movements
+          schema:
+            type: object
+            properties:
+                movements:
+                    type: array
+                    items:
+                        type: object
+                        properties:
+                            movement_id:
+                                type: integer
+                            prod_id:
+                                type: integer
+                            condition:
+                                type: string
+                                enum: [new, used, open-boxed]
+                            delta:
+                                type: integer
+                            reason:
+                                type: string
+                            created_at:
+                                type: string
+                                format: date-time
+                            change_seq:
+                                type: integer
+                next_since:
+                    type: integer
+                has_more:
+                    type: boolean
+    """
+    app.logger.info("GET received, list movements of id {} with {}.".format(
+        prod_id, request.args.to_dict()))
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', DEFAULT_CHANGES_LIMIT))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    if since < 0 or limit < 1 or limit > MAX_CHANGES_LIMIT:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+
+    movements = ProductInformation.find_movements(prod_id, since, limit + 1)
+    has_more = len(movements) > limit
+    movements = [movement.serialize() for movement in movements[:limit]]
+    next_since = movements[-1][MOVEMENT_ID] if movements else since
+    return jsonify(movements=movements, next_since=next_since, has_more=has_more), \
+           status.HTTP_200_OK
+
+@app.route('/inventory/events', methods=[GET])
+@admission.unlimited
+def stream_events():
+    """
+    Stream live inventory changes as Server-Sent Events
+    This endpoint keeps the connection open and sends a create, update, restock, reserve,
+    confirm or delete event for every committed change. The id of each event is its change_seq; reconnecting
+    with the Last-Event-ID header resumes right after that event.
+    ---
+    tags:
+      -     Inventory
+    produces:
+      -     text/event-stream
+    parameters:
+      -     name: ids
+            in: query
+            description: comma separated prod_ids to receive events for (all products if omitted)
+            required: false
+            type: string
+      -     name: Last-Event-ID
+            in: header
+            description: the id of the last event received, to resume from
+            required: false
+            type: integer
+    responses:
+      400:
+          description: Bad Request (invalid ids or Last-Event-ID)
+      200:
+          description: A stream of change events
+    """
+    app.logger.info("GET received, stream events with {}.".format(request.args.to_dict()))
+    prod_ids = None
+    if request.args.get('ids') is not None:
+        prod_ids = set(parse_ids(request.args.get('ids')))
+    last_event_id = request.headers.get(LAST_EVENT_ID, request.args.get('last_event_id'))
+    if last_event_id is not None:
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+
+    events = stream_with_context(broker.subscribe(last_event_id, prod_ids))
+    return Response(events, mimetype=EVENT_STREAM, headers={CACHE_CONTROL: 'no-cache'})
 
 @app.route('/inventory', methods=[POST])
 def create_prod_info():
@@ -167,8 +721,10 @@ def create_prod_info():
         -   Inventory
     consumes:
         -   application/json
+        -   application/msgpack
     produces:
         -   application/json
+        -   application/msgpack
     definitions:
         Product:
             type: object
@@ -195,6 +751,18 @@ def create_prod_info():
                 restock_amt:
                     type: integer
                     description: Quantity to be added to a product's quantity with condition "new".
+                available_new_qty:
+                    type: integer
+                    readOnly: true
+                    description: Quantity of condition "new" not held by reservations.
+                available_used_qty:
+                    type: integer
+                    readOnly: true
+                    description: Quantity of condition "used" not held by reservations.
+                available_open_boxed_qty:
+                    type: integer
+                    readOnly: true
+                    description: Quantity of condition "open boxed" not held by reservations.
     parameters:
         -   in: body
             name: body
@@ -214,10 +782,10 @@ def create_prod_info():
         400:
             description: Bad Request (invalid posted data)
     """
-    check_content_type(JSON)
-    app.logger.info("POST received, create with payload {}.".format(request.get_json()))
+    data = get_payload()
+    app.logger.info("POST received, create with payload {}.".format(data))
     prod_info = ProductInformation()
-    prod_info.deserialize(request.get_json())
+    prod_info.deserialize(data)
 
     if ProductInformation.find(prod_info.prod_id):
         raise BadRequest(CANNOT_CREATE_MSG.format(prod_info.prod_id))
@@ -225,10 +793,193 @@ def create_prod_info():
     prod_info.save()
     message = prod_info.serialize()
     location_url = url_for(GET_PROD_INFO, prod_id=prod_info.prod_id, _external=True)
-    return make_response(jsonify(message), status.HTTP_201_CREATED,
-                         {
-                             LOCATION: location_url
-                         })
+    return make_products_response(message, status.HTTP_201_CREATED,
+                                  {
+                                      LOCATION: location_url,
+                                      ETAG: quote_etag(prod_info.etag())
+                                  })
+
+@app.route('/inventory/batch', methods=[POST])
+def batch_prod_info():
+    """
+    Apply a list of create, update and restock operations in one transaction
+    This endpoint runs the operations in order with the validation of the single product endpoints
+    and commits them together. If one fails, none is applied and its index is returned. The data
+    of all the operations is validated first, and every invalid operation is listed in errors.
+    ---
+    tags:
+      -     Inventory
+    consumes:
+      -     application/json
+      -     application/msgpack
+    parameters:
+      -     in: body
+            name: body
+            required: true
+            schema:
+                type: object
+                required:
+                    - operations
+                properties:
+                    operations:
+                        type: array
+                        description: up to 1000 operations
+                        items:
+                            type: object
+                            properties:
+                                op:
+                                    type: string
+                                    enum:
+                                        - create
+                                        - update
+                                        - restock
+                                prod_id:
+                                    type: integer
+                                    description: the product to update or restock
+                                data:
+                                    type: object
+                                    description: the body of the single product request
+                                if_match:
+                                    type: string
+                                    description: ETag of the version the update or restock is based on
+    responses:
+      200:
+          description: All the operations were applied
+          schema:
+            type: object
+            properties:
+                results:
+                    type: array
+                    items:
+                        type: object
+                        properties:
+                            op:
+                                type: string
+                            prod_id:
+                                type: integer
+                            status:
+                                type: integer
+                            data:
+                                $ref: '#/definitions/Product'
+      400:
+          description: Bad Request (invalid operations, none were applied)
+          schema:
+            type: object
+            properties:
+                index:
+                    type: integer
+                message:
+                    type: string
+                errors:
+                    type: array
+                    items:
+                        type: object
+                        properties:
+                            index:
+                                type: integer
+                            message:
+                                type: string
+      404:
+          description: An operation refers to a product that was not found, none were applied
+      412:
+          description: An operation does not match its if_match version, none were applied
+    """
+    data = get_payload()
+    app.logger.info("POST received, batch with {}.".format(data))
+    operations = data.get(OPERATIONS) if isinstance(data, dict) else None
+    if not isinstance(operations, list) or len(operations) > batch.MAX_OPERATIONS:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    try:
+        results = batch.apply_batch(operations)
+    except batch.BatchError as error:
+        app.logger.error("Batch operation {} failed: {}".format(error.index, error.message))
+        return jsonify(status=error.status_code, message=error.message, index=error.index,
+                       errors=error.errors), error.status_code
+    return jsonify(results=results), status.HTTP_200_OK
+
+@app.route('/inventory/import', methods=[POST])
+@admission.long_running
+def import_prod_info():
+    """
+    Import products from an uploaded CSV or newline delimited JSON file
+    This endpoint reads the request body as a stream and writes the products a chunk of rows per
+    transaction. CSV files need a header row of product fields. Every row is validated like a
+    created product; invalid rows are skipped and reported with their line number.
+    ---
+    tags:
+      -     Inventory
+    consumes:
+      -     text/csv
+      -     application/x-ndjson
+    parameters:
+      -     name: mode
+            in: query
+            description: insert rejects rows of existing products, upsert replaces them
+            required: false
+            type: string
+            default: insert
+            enum:
+                - insert
+                - upsert
+      -     name: chunk_size
+            in: query
+            description: the number of rows written per transaction (at most 10000)
+            required: false
+            type: integer
+            default: 1000
+      -     name: body
+            in: body
+            description: the CSV or NDJSON file
+            required: true
+            schema:
+                type: string
+    responses:
+      400:
+          description: Bad Request (invalid mode, chunk_size or CSV header)
+      415:
+          description: Unsupported Media Type (neither text/csv nor application/x-ndjson)
+      200:
+          description: The import report
+          schema:
+            type: object
+            properties:
+                rows:
+                    type: integer
+                imported:
+                    type: integer
+                failed:
+                    type: integer
+                errors:
+                    type: array
+                    items:
+                        type: object
+                        properties:
+                            line:
+                                type: integer
+                            error:
+                                type: string
+    """
+    app.logger.info("POST received, import with {}.".format(request.args.to_dict()))
+    mode = request.args.get('mode', bulk_import.INSERT)
+    if mode not in [bulk_import.INSERT, bulk_import.UPSERT]:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    chunk_size = get_int_arg('chunk_size', minimum=1) or bulk_import.DEFAULT_CHUNK_SIZE
+    if chunk_size > MAX_IMPORT_CHUNK_SIZE:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    import_formats = dict((mimetype, name) for name, mimetype in EXPORT_FORMATS.items()
+                          if name in bulk_import.READERS)
+    if request.mimetype not in import_formats:
+        app.logger.error(INVALID_CONTENT_TYPE_ERROR, request.mimetype)
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+              INVALID_CONTENT_TYPE_MSG.format(' or '.join(sorted(import_formats))))
+
+    def progress(report):
+        """ Logs the progress of the import """
+        app.logger.info("Imported {} of {} rows.".format(report.imported, report.rows))
+
+    read = bulk_import.READERS[import_formats[request.mimetype]]
+    report = bulk_import.import_rows(read(request.stream), mode, chunk_size, progress)
+    return jsonify(report.serialize()), status.HTTP_200_OK
 
 @app.route('/inventory/<int:prod_id>', methods=[DELETE])
 def delete_prod_info(prod_id):
@@ -266,8 +1017,10 @@ def update_prod_info(prod_id):
         -   Inventory
     consumes:
         -   application/json
+        -   application/msgpack
     produces:
         -   application/json
+        -   application/msgpack
     parameters:
         -   name: prod_id
             in: path
@@ -279,6 +1032,11 @@ def update_prod_info(prod_id):
             schema:
                 id: data
                 $ref: '#/definitions/Product'
+        -   name: If-Match
+            in: header
+            description: ETag of the version the update is based on
+            required: false
+            type: string
     responses:
         200:
             description: Inventory information Updated
@@ -286,16 +1044,26 @@ def update_prod_info(prod_id):
                 $ref: '#/definitions/Product'
         400:
             description: Bad Request (the posted data was not valid)
+        409:
+            description: A quantity would be below the quantity held by reservations
+        412:
+            description: The product was modified since the If-Match version or concurrently
     """
-    check_content_type(JSON)
-    app.logger.info("PUT received, update id {} with payload {}.".format(prod_id, request.get_json()))
+    data = get_payload()
+    app.logger.info("PUT received, update id {} with payload {}.".format(prod_id, data))
     prod_info = ProductInformation.find(prod_id)
     if not prod_info:
         raise NotFound(NOT_FOUND_MSG.format(prod_id))
 
-    prod_info.deserialize_update(request.get_json())
+    check_if_match(prod_info)
+    prod_info.deserialize_update(data)
+    # answered with 409 Conflict by the ReservedQuantityError handler
+    prod_info.check_reserved()
     prod_info.save()
-    return make_response(jsonify(prod_info.serialize()), status.HTTP_200_OK)
+    return make_products_response(prod_info.serialize(), status.HTTP_200_OK,
+                                  {
+                                      ETAG: quote_etag(prod_info.etag())
+                                  })
 
 
 ######################################################################
@@ -312,6 +1080,10 @@ def restock_action(prod_id):
         -   Inventory
     consumes:
         -   application/json
+        -   application/msgpack
+    produces:
+        -   application/json
+        -   application/msgpack
     definitions:
         Restock_Amount:
             type: object
@@ -332,26 +1104,196 @@ def restock_action(prod_id):
             schema:
                 id: data
                 $ref: '#/definitions/Restock_Amount'
+        -   name: If-Match
+            in: header
+            description: ETag of the version the restock is based on
+            required: false
+            type: string
     responses:
         200:
             description: Product restocked successfully.
         400:
             description: Bad Request (invalid input data)
+        412:
+            description: The product was modified since the If-Match version or concurrently
     """
-    check_content_type(JSON)
-    app.logger.info("PUT received, restock id {} with {}.".format(prod_id, request.get_json()))
+    data = get_payload()
+    app.logger.info("PUT received, restock id {} with {}.".format(prod_id, data))
     prod_info = ProductInformation.find(prod_id)
     if not prod_info:
         raise NotFound(NOT_FOUND_MSG.format(prod_id))
 
-    data = request.get_json()
-    add_amt = data.get('restock_amt')
-    if (len(list(data.keys())) != 1) or (add_amt is None) or (add_amt < 0):
-        raise BadRequest("Please only give 'restock_amt' as input.")
+    add_amt = ProductInformation.deserialize_restock(data)
 
-    prod_info.restock(add_amt)
-    prod_info.save()
-    return make_response(jsonify(prod_info.serialize()), status.HTTP_200_OK)
+    check_if_match(prod_info)
+    # If-Match restocks need the version check of a row write
+    if hot_products.record(prod_id) and not request.if_match:
+        hot_products.restock(prod_info, add_amt)
+    else:
+        prod_info.restock(add_amt)
+        prod_info.save()
+    return make_products_response(prod_info.serialize(), status.HTTP_200_OK,
+                                  {
+                                      ETAG: quote_etag(prod_info.etag())
+                                  })
+
+@app.route('/inventory/<int:prod_id>/reservations', methods=[POST])
+def create_reservation(prod_id):
+    """
+    Reserve products for a checkout.
+
+    This endpoint holds a quantity of a condition of the product if that many are
+    available, until the reservation is confirmed, released or its ttl runs out.
+    ---
+    tags:
+        -   Inventory
+    consumes:
+        -   application/json
+        -   application/msgpack
+    definitions:
+        Reservation:
+            type: object
+            properties:
+                reservation_id:
+                    type: integer
+                prod_id:
+                    type: integer
+                condition:
+                    type: string
+                    enum: [new, used, open-boxed]
+                quantity:
+                    type: integer
+                status:
+                    type: string
+                    enum: [held, confirmed, released, expired]
+                expires_at:
+                    type: string
+                    format: date-time
+    parameters:
+        -   name: prod_id
+            in: path
+            description: ID of product.
+            type: integer
+            required: true
+        -   in: body
+            name: body
+            required: true
+            schema:
+                type: object
+                required:
+                    - quantity
+                properties:
+                    quantity:
+                        type: integer
+                        minimum: 1
+                        description: the number of products to hold
+                    condition:
+                        type: string
+                        enum: [new, used, open-boxed]
+                        default: new
+                    ttl:
+                        type: number
+                        description: seconds until the reservation expires (RESERVATION_TTL by default)
+    responses:
+        201:
+            description: Products reserved
+            schema:
+                $ref: '#/definitions/Reservation'
+        400:
+            description: Bad Request (invalid input data)
+        404:
+            description: Product not found
+        409:
+            description: Not enough products available
+    """
+    data = get_payload()
+    app.logger.info("POST received, reserve id {} with {}.".format(prod_id, data))
+    values, errors = validate_reservation(data)
+    max_ttl = app.config['RESERVATION_MAX_TTL']
+    if TTL in values and not 0 < values[TTL] <= max_ttl:
+        errors.append(TTL_RANGE_MSG.format(max_ttl))
+    if errors:
+        raise BadRequest(INVALID_RESERVATION_MSG + ', '.join(errors))
+    quantity = values[QUANTITY]
+    condition = values.get(CONDITION, NEW)
+    ttl = values.get(TTL, app.config['RESERVATION_TTL'])
+
+    reservation = ProductInformation.reserve(prod_id, condition, quantity, ttl)
+    if reservation is None:
+        if not ProductInformation.find(prod_id, [PROD_ID]):
+            raise NotFound(NOT_FOUND_MSG.format(prod_id))
+        abort(status.HTTP_409_CONFLICT, NOT_AVAILABLE_MSG.format(prod_id, quantity, condition))
+    return make_response(jsonify(reservation.serialize()), status.HTTP_201_CREATED)
+
+@app.route('/inventory/<int:prod_id>/reservations/<int:reservation_id>/confirm', methods=[POST])
+def confirm_reservation(prod_id, reservation_id):
+    """
+    Confirm a reservation.
+
+    This endpoint takes the held products out of the quantity of the product for good.
+    ---
+    tags:
+        -   Inventory
+    parameters:
+        -   name: prod_id
+            in: path
+            description: ID of product.
+            type: integer
+            required: true
+        -   name: reservation_id
+            in: path
+            description: ID of the reservation.
+            type: integer
+            required: true
+    responses:
+        200:
+            description: Reservation confirmed
+            schema:
+                $ref: '#/definitions/Reservation'
+        404:
+            description: Reservation not found
+        409:
+            description: The reservation was already confirmed, released or expired
+        412:
+            description: The product was modified concurrently
+    """
+    app.logger.info("POST received, confirm reservation {} of id {}.".format(reservation_id,
+                                                                            prod_id))
+    return settle_reservation(prod_id, reservation_id, ProductInformation.confirm_reservation)
+
+@app.route('/inventory/<int:prod_id>/reservations/<int:reservation_id>/release', methods=[POST])
+def release_reservation(prod_id, reservation_id):
+    """
+    Release a reservation.
+
+    This endpoint makes the held products available again.
+    ---
+    tags:
+        -   Inventory
+    parameters:
+        -   name: prod_id
+            in: path
+            description: ID of product.
+            type: integer
+            required: true
+        -   name: reservation_id
+            in: path
+            description: ID of the reservation.
+            type: integer
+            required: true
+    responses:
+        200:
+            description: Reservation released
+            schema:
+                $ref: '#/definitions/Reservation'
+        404:
+            description: Reservation not found
+        409:
+            description: The reservation was already confirmed, released or expired
+    """
+    app.logger.info("POST received, release reservation {} of id {}.".format(reservation_id,
+                                                                            prod_id))
+    return settle_reservation(prod_id, reservation_id, ProductInformation.release_reservation)
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
@@ -360,6 +1302,96 @@ def init_db():
     """ Initialies the SQLAlchemy app """
     ProductInformation.init_db()
 
+def get_finder(args):
+    """
+    Returns a find(after, limit, sort=PROD_ID, descending=False, fields=None) function listing
+    the products matching the filter query parameters
+    """
+    if args.get('prod_name'):
+        prod_name = args.get('prod_name')
+        return partial(ProductInformation.find_by_name, prod_name)
+    if args.get('name_prefix'):
+        prefix = args.get('name_prefix')
+        return partial(ProductInformation.find_by_name_prefix, prefix)
+    if args.get('quantity'):
+        try:
+            quantity = int(args.get('quantity'))
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+        return partial(ProductInformation.find_by_quantity, quantity)
+    if args.get('condition'):
+        condition = args.get('condition')
+        if condition not in ['new', 'used', 'open-boxed']:
+            abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+        return partial(ProductInformation.find_by_condition, condition)
+    if args:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    return ProductInformation.list_all
+
+def csv_row(values):
+    """ Formats a CSV record, quoting the values that need it """
+    fields = []
+    for value in values:
+        value = u'{}'.format(value)
+        if any(char in value for char in ',"\r\n'):
+            value = u'"{}"'.format(value.replace('"', '""'))
+        fields.append(value)
+    return u','.join(fields) + u'\r\n'
+
+def get_int_arg(name, minimum=None):
+    """ Returns an optional integer query parameter """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    if minimum is not None and value < minimum:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    return value
+
+def get_fields_arg():
+    """ Returns the FIELDS listed in the optional fields query parameter """
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    fields = []
+    for field in value.split(','):
+        field = field.strip()
+        if field not in FIELDS:
+            abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+def parse_ids(value):
+    """ Parses a comma separated list of prod_ids """
+    try:
+        return [int(prod_id) for prod_id in value.split(',')]
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+
+@event.listens_for(SignallingSession, 'after_commit')
+def notify_broker(session):
+    """ Lets the broker publish a commit without waiting for its next poll """
+    broker.notify()
+
+def settle_reservation(prod_id, reservation_id, settle):
+    """ Confirms or releases a held reservation with settle and returns it """
+    if not ProductInformation.find_reservation(prod_id, reservation_id):
+        raise NotFound(RESERVATION_NOT_FOUND_MSG.format(reservation_id, prod_id))
+    reservation = settle(prod_id, reservation_id)
+    if reservation is None:
+        abort(status.HTTP_409_CONFLICT, NOT_HELD_MSG.format(reservation_id))
+    return make_response(jsonify(reservation.serialize()), status.HTTP_200_OK)
+
+def check_if_match(prod_info):
+    """ Checks that the If-Match header, if any, matches the current version """
+    if request.if_match and not request.if_match.contains(prod_info.etag()):
+        app.logger.error(PRECONDITION_FAILED_MSG.format(prod_info.prod_id))
+        abort(status.HTTP_412_PRECONDITION_FAILED, PRECONDITION_FAILED_MSG.format(prod_info.prod_id))
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers[CONTENT_TYPE] == content_type:
@@ -367,6 +1399,48 @@ def check_content_type(content_type):
     app.logger.error(INVALID_CONTENT_TYPE_ERROR, request.headers[CONTENT_TYPE])
     abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, INVALID_CONTENT_TYPE_MSG.format(content_type))
 
+def get_payload():
+    """ Returns the decoded JSON or MessagePack request body """
+    if request.headers.get(CONTENT_TYPE) in [formats.MSGPACK, formats.X_MSGPACK]:
+        return formats.decode(request.get_data())
+    check_content_type(JSON)
+    return request.get_json()
+
+def make_products_response(data, status_code, headers=None, fields=None, missing=None):
+    """
+    Returns serialized products, a list or a single one, in the format of the Accept header
+
+    JSON is sent unless MessagePack or a columnar format is asked for. With
+    missing, the list is returned in an object next to the missing prod_ids.
+    """
+    media_type = formats.negotiate(request.accept_mimetypes)
+    headers = dict(headers or {}, **{VARY: 'Accept'})
+    if media_type in formats.COLUMNAR_TYPES and not isinstance(data, list):
+        data = [data]
+    data = formats.layout(data, media_type, fields)
+    if missing is not None:
+        data = {PRODUCTS: data, MISSING: missing}
+    if media_type == formats.JSON:
+        return make_response(jsonify(data), status_code, headers)
+    return Response(formats.encode(data, media_type), status=status_code, headers=headers,
+                    mimetype=media_type)
+
+def multi_get(prod_ids, fields):
+    """ Returns the products with the given prod_ids in the requested order and the missing ids """
+    requested = []
+    seen = set()
+    for prod_id in prod_ids:
+        if prod_id not in seen:
+            seen.add(prod_id)
+            requested.append(prod_id)
+    if len(requested) > MAX_MULTI_GET_IDS:
+        abort(status.HTTP_400_BAD_REQUEST, INVALID_PARAMETER_MSG)
+    found = dict((prod_info.prod_id, prod_info)
+                 for prod_info in ProductInformation.find_many(requested, fields))
+    results = [found[prod_id].serialize(fields) for prod_id in requested if prod_id in found]
+    missing = [prod_id for prod_id in requested if prod_id not in found]
+    return make_products_response(results, status.HTTP_200_OK, fields=fields, missing=missing)
+
 def initialize_logging(log_level=logging.INFO):
     """ Initialized the default logging to STDOUT """
     if not app.debug:
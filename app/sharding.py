@@ -0,0 +1,147 @@
+"""
+Horizontal Sharding
+
+ShardRouter hash-partitions the rows of the sharded tables by prod_id across the
+databases in SQLALCHEMY_SHARD_URIS. A table is sharded when its info contains
+'sharded': True; every other table, like the change counter, stays on the
+primary database.
+
+Point operations go to the single shard owning a prod_id. Filter and list
+queries run on every shard in parallel and their sorted results are merged.
+Without SQLALCHEMY_SHARD_URIS the router hands out db.session instead, so the
+models can go through it unconditionally.
+"""
+
+import heapq
+from threading import Lock
+from sqlalchemy import orm
+from app.vcap_services import get_shard_uris
+
+SHARDED = 'sharded'
+
+class Descending(object):
+    """ Wraps a merge key so that the rows are merged in descending order """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+class ShardRouter(object):
+    """ Routes the sharded tables to the shard databases """
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self._sessions = {}
+        self._pool = None
+        self._pool_size = 0
+        self._lock = Lock()
+        app.config.setdefault('SQLALCHEMY_SHARD_URIS', None)
+        app.teardown_appcontext(self.remove)
+
+    @property
+    def uris(self):
+        """ The database URIs of the shards """
+        if self.app.config['SQLALCHEMY_SHARD_URIS'] is None:
+            self.app.config['SQLALCHEMY_SHARD_URIS'] = get_shard_uris()
+        return self.app.config['SQLALCHEMY_SHARD_URIS']
+
+    def enabled(self):
+        """ Returns whether the sharded tables are spread over shard databases """
+        return bool(self.uris)
+
+    def shard_of(self, prod_id):
+        """ Returns the index of the shard owning prod_id """
+        return prod_id % len(self.uris)
+
+    def get_engine(self, index):
+        """ Returns the engine of the shard at index """
+        return self.db.get_uri_engine(self.app, self.uris[index])
+
+    def get_session(self, index):
+        """ Returns the thread's session of the shard at index """
+        uri = self.uris[index]
+        with self._lock:
+            session = self._sessions.get(uri)
+            if session is None:
+                factory = orm.sessionmaker(bind=self.get_engine(index))
+                session = self._sessions[uri] = orm.scoped_session(factory)
+        return session
+
+    def session_for(self, prod_id):
+        """ Returns the session to read and write the rows of prod_id with """
+        if not self.enabled():
+            return self.db.session
+        return self.get_session(self.shard_of(prod_id))
+
+    def scatter(self, query):
+        """
+        Runs query(session) on every shard in parallel and returns the list of results.
+
+        The returned instances are detached from the short-lived sessions
+        they were loaded with; saving one attaches it to session_for(prod_id).
+        """
+        if not self.enabled():
+            return [query(self.db.session)]
+
+        def run(engine):
+            session = orm.Session(bind=engine)
+            try:
+                result = query(session)
+                session.expunge_all()
+                return result
+            finally:
+                session.close()
+
+        engines = [self.get_engine(index) for index in range(len(self.uris))]
+        return self.get_pool(len(engines)).map(run, engines)
+
+    @staticmethod
+    def merge(results, key):
+        """ Merge-sorts the per shard results, each already sorted by key """
+        keyed = [[(key(row), row) for row in rows] for rows in results]
+        return [row for _, row in heapq.merge(*keyed)]
+
+    def get_pool(self, size):
+        """ Returns the thread pool running the per shard queries """
+        from multiprocessing.pool import ThreadPool
+        with self._lock:
+            if self._pool_size != size:
+                if self._pool is not None:
+                    self._pool.close()
+                self._pool = ThreadPool(size)
+                self._pool_size = size
+            return self._pool
+
+    def get_tables(self):
+        """ Returns the sharded tables """
+        return [table for table in self.db.metadata.sorted_tables if table.info.get(SHARDED)]
+
+    def create_all(self):
+        """ Creates the sharded tables on every shard """
+        for index in range(len(self.uris)):
+            self.db.metadata.create_all(self.get_engine(index), tables=self.get_tables())
+
+    def drop_all(self):
+        """ Drops the sharded tables on every shard """
+        for index in range(len(self.uris)):
+            self.db.metadata.drop_all(self.get_engine(index), tables=self.get_tables())
+
+    def rollback(self):
+        """ Rolls back the thread's open shard sessions and the primary session """
+        for session in list(self._sessions.values()):
+            if session.registry.has():
+                session.rollback()
+        self.db.session.rollback()
+
+    def remove(self, response_or_exc=None):
+        """ Closes the thread's shard sessions at the end of a request """
+        for session in list(self._sessions.values()):
+            session.remove()
+        return response_or_exc
@@ -2,7 +2,7 @@
 """
 VCAP Services module
 
-This module initializes the database connection String
+This module initializes the database connection Strings
 from VCAP_SERVICES in Bluemix if Found
 """
 import os
@@ -40,3 +40,39 @@ def get_database_uri():
     logging.info("Conecting to database on host %s port %s", hostname, port)
     connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'
     return connect_string.format(username, password, hostname, port, name)
+
+def get_replica_uris():
+    """
+    Initialized the read replica connection Strings
+
+    Read replicas are taken from:
+      1) In Bluemix, every cleardb service bound after the first one
+      2) Otherwise, the comma separated DATABASE_REPLICA_URIS environment variable
+    """
+    if 'VCAP_SERVICES' in os.environ:
+        services = json.loads(os.environ['VCAP_SERVICES'])
+        uris = []
+        for service in services['cleardb'][1:]:
+            creds = service['credentials']
+            logging.info("Using read replica on host %s port %s", creds["hostname"], creds["port"])
+            connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'
+            uris.append(connect_string.format(creds["username"], creds["password"],
+                                              creds["hostname"], creds["port"], creds["name"]))
+        return uris
+
+    return get_uris_from_env('DATABASE_REPLICA_URIS')
+
+def get_shard_uris():
+    """
+    Initialized the shard connection Strings
+
+    Shards are taken from the comma separated DATABASE_SHARD_URIS environment variable.
+    The order of the URIs decides which products each shard owns, so it must not change
+    once the shards hold data.
+    """
+    return get_uris_from_env('DATABASE_SHARD_URIS')
+
+def get_uris_from_env(name):
+    """ Splits a comma separated list of database URIs from the environment """
+    uris = os.getenv(name, '')
+    return [uri.strip() for uri in uris.split(',') if uri.strip()]
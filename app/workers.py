@@ -0,0 +1,82 @@
+"""
+Periodic Workers
+
+The background threads of the service share one loop: do a round of work,
+then sleep for an interval taken from the app config, until stopped. A
+PeriodicWorker runs each round in an app context and removes its db.session
+afterwards, so the next round sees the commits made meanwhile, and logs a
+failed round instead of dying, so a transient database error only costs one
+round. notify() starts the next round right away.
+
+The reservation sweeper, the hot counter folder, the ledger compactor and the
+change broker are PeriodicWorkers.
+"""
+
+import logging
+import threading
+from app import db
+
+class PeriodicWorker(object):
+    """ Runs work() on a daemon thread every interval until stopped """
+    logger = logging.getLogger(__name__)
+    # The name of the thread, the app config key of the interval in seconds
+    # (the worker does not start while it is None) and the failure log message
+    thread_name = None
+    interval_key = None
+    failure_msg = None
+
+    def __init__(self, app):
+        self.app = app
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Starts the worker thread unless it is running or the interval is None """
+        with self.lock:
+            if self.running or self.app.config[self.interval_key] is None:
+                return
+            self.starting()
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name=self.thread_name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def starting(self):
+        """ Prepares the worker before its thread starts """
+        pass
+
+    def stop(self):
+        """ Stops the worker thread """
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def notify(self):
+        """ Asks the worker thread to run its next round right away """
+        self.wakeup.set()
+
+    def run(self):
+        """ Worker loop: runs a round, then sleeps for the interval, until stopped """
+        while self.running:
+            try:
+                self.run_once()
+            except Exception as error:  # keep working after transient database errors
+                self.logger.error(self.failure_msg.format(error))
+            self.wakeup.wait(self.app.config[self.interval_key])
+            self.wakeup.clear()
+
+    def run_once(self):
+        """ Runs one round of work() in an app context and returns its result """
+        with self.app.app_context():
+            try:
+                return self.work()
+            finally:
+                db.session.remove()
+
+    def work(self):
+        """ Does one round of the work of the worker """
+        raise NotImplementedError
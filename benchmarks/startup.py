@@ -0,0 +1,63 @@
+"""
+Start-up Time Benchmark
+
+Measures what a freshly spawned instance or worker pays before it can answer:
+importing the app package, registering the routes and the first request.
+Every run happens in a new interpreter so nothing is cached.
+
+Run it with:
+    python benchmarks/startup.py [runs]
+"""
+
+from __future__ import print_function
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RUNS = 10
+
+# Runs in the spawned interpreter and prints its timings as JSON
+PROBE = """
+import json, sys, time
+start = time.time()
+from app import db, register_routes
+imported = time.time()
+app = register_routes()
+created = time.time()
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+client = app.test_client()
+with app.app_context():
+    db.create_all()
+    ready = time.time()
+    response = client.get('/inventory')
+assert response.status_code == 200
+done = time.time()
+print(json.dumps({'import': imported - start, 'register_routes': created - imported,
+                  'first_request': done - ready, 'total': done - start - (ready - created)}))
+"""
+
+def run_once():
+    """ Returns the timings of one cold start """
+    output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def median(values):
+    """ Returns the median of a list of numbers """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def main():
+    """ Runs the benchmark and prints the median timings in milliseconds """
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS
+    timings = [run_once() for _ in range(runs)]
+    print("Start-up time over {} runs (median):".format(runs))
+    for phase in ['import', 'register_routes', 'first_request', 'total']:
+        print("  {:<16} {:8.1f} ms".format(phase, 1000 * median([timing[phase] for timing in timings])))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,64 @@
 import logging
-from app.vcap_services import get_database_uri
+import os
 
 LOGGING_LEVEL = logging.INFO
-SQLALCHEMY_DATABASE_URI = get_database_uri()
+# The database URIs are read from VCAP_SERVICES or the environment
+# (see app/vcap_services.py) on first use when left as None.
+SQLALCHEMY_DATABASE_URI = None
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# Read replicas for @read_only handlers, and how long a client reads
+# from the primary after writing (seconds)
+SQLALCHEMY_REPLICA_URIS = None
+REPLICA_STICKY_SECONDS = 5
+# Databases the product tables are hash-partitioned over by prod_id
+SQLALCHEMY_SHARD_URIS = None
+# Change event streaming (seconds / number of events)
+EVENTS_POLL_INTERVAL = 1.0
+EVENTS_HEARTBEAT_INTERVAL = 15.0
+EVENTS_BUFFER_SIZE = 1000
+# Number of products /inventory/export reads from the database at a time
+EXPORT_BATCH_SIZE = 1000
+# Where python -m app.assets builds the fingerprinted admin UI assets
+# (app/assets when left as None)
+ASSET_DIR = None
+# Admission control (see app/admission_control.py): requests running at once per
+# route class, requests waiting for a slot and for how long (seconds),
+# requests per second and burst per client (None for no rate limit), and
+# the request deadline (seconds)
+ADMISSION_MAX_READS = 16
+ADMISSION_MAX_WRITES = 8
+ADMISSION_MAX_QUEUE = 32
+ADMISSION_QUEUE_TIMEOUT = 1.0
+ADMISSION_RATE = None
+ADMISSION_BURST = None
+ADMISSION_DEADLINE = 10.0
+ADMISSION_RETRY_AFTER = 1
+# Number of proxies in front of the service that append the client to
+# X-Forwarded-For (the rate limit keys on the peer address when 0)
+ADMISSION_TRUSTED_PROXIES = 0
+# Where the products are stored: 'sql' or 'memory' (see app/repositories.py), also
+# set by the STORAGE_BACKEND environment variable, and the file the in-memory
+# products are snapshotted to (None for no snapshot)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sql')
+STORAGE_SNAPSHOT_PATH = None
+# How often the stock ledger is compacted (seconds, None to never) and how
+# old movements are before they are folded into snapshots (days)
+LEDGER_COMPACTION_INTERVAL = 3600.0
+LEDGER_RETENTION_DAYS = 30
+# Restocks of one product within the window (seconds) that make it hot (None to never),
+# the counter rows its restocks are spread over and how often they are folded (seconds)
+HOT_WRITE_RATE = 50
+HOT_WRITE_WINDOW = 1.0
+HOT_COUNTER_SLOTS = 8
+HOT_FOLD_INTERVAL = 1.0
+# Seconds reservations are held by default and at most, how often the lapsed
+# ones are released (seconds, None to never) and how many per transaction
+RESERVATION_TTL = 900
+RESERVATION_MAX_TTL = 86400
+RESERVATION_SWEEP_INTERVAL = 1.0
+RESERVATION_SWEEP_BATCH = 500
+# Bytes of encoded product lists kept until the next write (0 disables the cache)
+QUERY_CACHE_MAX_BYTES = 16 * 1024 * 1024
 SWAGGER = {
     "swagger_version": "2.0",
     "specs": [
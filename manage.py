@@ -0,0 +1,302 @@
+"""
+Inventory Administration
+
+Creates the database and bulk loads products without going through the
+API or the ORM:
+    python manage.py create               creates the databases, tables and missing indexes
+    python manage.py load FILE.csv        loads products from a CSV file with a header row
+    python manage.py generate N           inserts N synthetic products
+
+Rows are inserted in transactions of BATCH_SIZE rows with executemany,
+which PyMySQL sends as multi-row INSERT statements and SQLite runs as one
+prepared statement. A CSV file is loaded into an unsharded MySQL database
+with LOAD DATA LOCAL INFILE instead. Each product gets an opening stock
+movement per non-zero condition in the same transaction, as if it was
+created through the API. Loaded rows are not validated like API writes;
+use python -m app.bulk_import for untrusted files.
+
+Runs on Python 3 as well as 2.7.
+"""
+
+from __future__ import print_function, division
+import argparse
+import csv
+import io
+import random
+import sys
+import time
+from datetime import datetime
+from sqlalchemy import and_, create_engine, func, inspect, literal, select, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from app import app, db, shards
+from app.models import ChangeCounter, CONDITIONS, CREATE, DEFAULT_NEW_QTY, DEFAULT_OPEN_BOXED_QTY, \
+    DEFAULT_RESTOCK_LEVEL, DEFAULT_USED_QTY, DEFALUT_RESTOCK_AMT, FIELDS, NEW_QTY, \
+    OPEN_BOXED_QTY, PROD_ID, PROD_NAME, RESERVED_COLUMNS, RESTOCK_AMT, RESTOCK_LEVEL, USED_QTY, \
+    ProductInformation, StockMovement
+
+# Rows inserted per transaction
+BATCH_SIZE = 10000
+# Rows between progress reports
+PROGRESS_INTERVAL = 100000
+# Database of the test suite, created next to the service database on MySQL
+TEST_DATABASE = 'test_inventory'
+DEFAULTS = {
+    NEW_QTY: DEFAULT_NEW_QTY,
+    USED_QTY: DEFAULT_USED_QTY,
+    OPEN_BOXED_QTY: DEFAULT_OPEN_BOXED_QTY,
+    RESTOCK_LEVEL: DEFAULT_RESTOCK_LEVEL,
+    RESTOCK_AMT: DEFALUT_RESTOCK_AMT
+}
+LOAD_DATA = """LOAD DATA LOCAL INFILE :path INTO TABLE {table}
+CHARACTER SET utf8
+FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+LINES TERMINATED BY :line_end
+IGNORE 1 LINES
+({columns})
+SET version = 1, change_type = :change_type, change_seq = (@seq := @seq + 1){defaults},
+    {reserved}, hot = 0,
+    total_qty = {total_qty},
+    restock_distance = IF({restock_level} > 0, {total_qty} - {restock_level}, NULL)"""
+
+class Progress(object):
+    """ Reports the number of rows written and the rate """
+
+    def __init__(self):
+        self.rows = 0
+        self.started = time.time()
+        self.reported = 0
+
+    def add(self, rows):
+        """ Counts written rows, reporting every PROGRESS_INTERVAL rows """
+        self.rows += rows
+        if self.rows - self.reported >= PROGRESS_INTERVAL:
+            self.report()
+
+    def report(self):
+        """ Prints the number of rows written and the rate """
+        self.reported = self.rows
+        elapsed = max(time.time() - self.started, 0.001)
+        print("{} rows in {:.1f}s ({:.0f} rows/s)".format(self.rows, elapsed, self.rows / elapsed))
+
+def get_database_uris():
+    """ Returns the URIs of the service database and the shards """
+    db.get_engine(app)
+    return [app.config['SQLALCHEMY_DATABASE_URI']] + list(shards.uris)
+
+def create_databases():
+    """ Creates the MySQL databases of the service, the shards and the test suite """
+    for uri in get_database_uris():
+        url = make_url(uri)
+        if url.get_backend_name() != 'mysql' or not url.database:
+            continue
+        names = [url.database, TEST_DATABASE]
+        if hasattr(url, 'set'):
+            url = url.set(database=None)
+        else:
+            url.database = None
+        engine = create_engine(url)
+        for name in names:
+            print("Creating database {}".format(name))
+            engine.execute('CREATE DATABASE IF NOT EXISTS `{}`'.format(name))
+        engine.dispose()
+
+def create_indexes(engine, tables):
+    """ Creates the indexes missing from tables that already existed """
+    inspector = inspect(engine)
+    for table in tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                print("Creating index {}".format(index.name))
+                index.create(engine)
+
+def create_schema():
+    """ Creates the tables and indexes, and the MySQL databases if they are missing """
+    print("Creating database tables")
+    try:
+        ProductInformation.init_db()
+    except OperationalError as error:
+        print("Got an error: {}".format(error))
+        db.session.rollback()
+        create_databases()
+        ProductInformation.init_db()
+    if shards.enabled():
+        for index in range(len(shards.uris)):
+            create_indexes(shards.get_engine(index), shards.get_tables())
+        create_indexes(db.engine, [table for table in db.metadata.sorted_tables
+                                   if table not in shards.get_tables()])
+    else:
+        create_indexes(db.engine, db.metadata.sorted_tables)
+
+def opening_movements(row, created_at):
+    """ Returns the StockMovement rows booking the quantities of a new product row """
+    return [dict(prod_id=row[PROD_ID], condition=condition, delta=row[column], reason=CREATE,
+                 created_at=created_at, change_seq=row['change_seq'])
+            for condition, column in sorted(CONDITIONS.items()) if row[column]]
+
+def insert_batch(table, rows):
+    """ Inserts rows as new products with their opening movements in one transaction per database """
+    first_seq = ChangeCounter.next_value(len(rows)) - len(rows) + 1
+    created_at = datetime.utcnow()
+    by_session = {}
+    for offset, row in enumerate(rows):
+        total_qty, restock_distance = ProductInformation.sort_columns(
+            row[NEW_QTY], row[USED_QTY], row[OPEN_BOXED_QTY], row[RESTOCK_LEVEL])
+        row.update(change_seq=first_seq + offset, change_type=CREATE, version=1,
+                   total_qty=total_qty, restock_distance=restock_distance)
+        by_session.setdefault(shards.session_for(row[PROD_ID]), []).append(row)
+    try:
+        for session, session_rows in by_session.items():
+            session.execute(table.insert(), session_rows)
+            movements = [movement for row in session_rows
+                         for movement in opening_movements(row, created_at)]
+            if movements:
+                session.execute(StockMovement.__table__.insert(), movements)
+        ProductInformation.commit(*by_session)
+    except Exception:
+        ProductInformation.rollback(*by_session)
+        raise
+
+def insert_rows(rows):
+    """ Inserts product rows in batches of BATCH_SIZE and returns the Progress """
+    table = ProductInformation.__table__
+    progress = Progress()
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            insert_batch(table, batch)
+            progress.add(len(batch))
+            batch = []
+    if batch:
+        insert_batch(table, batch)
+        progress.add(len(batch))
+    return progress
+
+def read_csv(path):
+    """ Yields the rows of a CSV file with a header row of product fields """
+    if sys.version_info[0] < 3:
+        csv_file = open(path, 'rb')
+    else:
+        csv_file = io.open(path, newline='', encoding='utf-8')
+    with csv_file:
+        reader = csv.DictReader(csv_file)
+        unknown = [column for column in reader.fieldnames or [] if column not in FIELDS]
+        if unknown:
+            raise ValueError("Unknown CSV columns: {}".format(', '.join(unknown)))
+        for record in reader:
+            row = dict(DEFAULTS)
+            for column, value in record.items():
+                if column == PROD_NAME:
+                    row[column] = value.decode('utf-8') if isinstance(value, bytes) else value
+                elif value:
+                    row[column] = int(value)
+            yield row
+
+def opening_movements_from(table, first_seq, last_seq, created_at):
+    """ Yields the INSERT ... SELECT statements booking the quantities of changes first_seq to last_seq """
+    movements = StockMovement.__table__
+    for condition, column in sorted(CONDITIONS.items()):
+        rows = select([table.c.prod_id, literal(condition), table.c[column], literal(CREATE),
+                       literal(created_at), table.c.change_seq]).where(
+                           and_(table.c.change_seq.between(first_seq, last_seq), table.c[column] != 0))
+        yield movements.insert().from_select(
+            ['prod_id', 'condition', 'delta', 'reason', 'created_at', 'change_seq'], rows)
+
+def load_data_infile(path):
+    """ Loads a CSV file into MySQL with LOAD DATA LOCAL INFILE and returns the Progress """
+    with io.open(path, newline='', encoding='utf-8') as csv_file:
+        header = csv_file.readline()
+        columns = next(csv.reader([header]))
+        rows = sum(1 for _ in csv.reader(csv_file))
+    unknown = [column for column in columns if column not in FIELDS]
+    if unknown:
+        raise ValueError("Unknown CSV columns: {}".format(', '.join(unknown)))
+
+    progress = Progress()
+    first_seq = ChangeCounter.next_value(rows) - rows + 1
+    defaults = ''.join(', {} = {}'.format(column, value) for column, value in sorted(DEFAULTS.items())
+                       if column not in columns)
+    values = dict((column, column if column in columns else str(value))
+                  for column, value in DEFAULTS.items())
+    total_qty = '({} + {} + {})'.format(values[NEW_QTY], values[USED_QTY], values[OPEN_BOXED_QTY])
+    statement = LOAD_DATA.format(table=ProductInformation.__tablename__,
+                                 columns=', '.join(columns), defaults=defaults,
+                                 reserved=', '.join('{} = 0'.format(column) for _, column
+                                                    in sorted(RESERVED_COLUMNS.items())),
+                                 total_qty=total_qty, restock_level=values[RESTOCK_LEVEL])
+    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'],
+                           connect_args={'local_infile': True})
+    try:
+        with engine.begin() as connection:
+            connection.execute(text('SET @seq = :seq'), seq=first_seq - 1)
+            connection.execute(text(statement), path=path, change_type=CREATE,
+                               line_end='\r\n' if header.endswith('\r\n') else '\n')
+            for statement in opening_movements_from(ProductInformation.__table__, first_seq,
+                                                    first_seq + rows - 1, datetime.utcnow()):
+                connection.execute(statement)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        engine.dispose()
+    db.session.commit()
+    progress.add(rows)
+    return progress
+
+def load(path):
+    """ Loads a CSV file with the fastest path the database offers """
+    if not shards.enabled() and db.engine.dialect.name == 'mysql':
+        return load_data_infile(path)
+    return insert_rows(read_csv(path))
+
+def generate(count, start=None, seed=None):
+    """ Inserts count synthetic products with consecutive prod_ids """
+    if start is None:
+        maxima = shards.scatter(
+            lambda session: session.query(func.max(ProductInformation.prod_id)).scalar())
+        start = max([maximum or 0 for maximum in maxima]) + 1
+    generator = random.Random(seed)
+
+    def rows():
+        """ Yields the synthetic products """
+        for prod_id in range(start, start + count):
+            restock_level = generator.choice([DEFAULT_RESTOCK_LEVEL, 10, 50])
+            yield {
+                PROD_ID: prod_id,
+                PROD_NAME: u'product-{}'.format(prod_id),
+                NEW_QTY: generator.randint(0, 100),
+                USED_QTY: generator.randint(0, 20),
+                OPEN_BOXED_QTY: generator.randint(0, 10),
+                RESTOCK_LEVEL: restock_level,
+                RESTOCK_AMT: 0 if restock_level == DEFAULT_RESTOCK_LEVEL else 100
+            }
+
+    return insert_rows(rows())
+
+def main(argv):
+    """ Runs an administration command """
+    parser = argparse.ArgumentParser(prog='python manage.py', description='Inventory administration.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('create', help='create the databases, tables and indexes')
+    load_parser = commands.add_parser('load', help='bulk load products from a CSV file')
+    load_parser.add_argument('file')
+    generate_parser = commands.add_parser('generate', help='insert synthetic products')
+    generate_parser.add_argument('count', type=int)
+    generate_parser.add_argument('--start', type=int, help='the first prod_id (default: after the last)')
+    generate_parser.add_argument('--seed', type=int, help='the random seed of the quantities')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    create_schema()
+    if args.command == 'load':
+        load(args.file).report()
+    elif args.command == 'generate':
+        generate(args.count, args.start, args.seed).report()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,6 @@
 from __future__ import print_function
 import os
-from app import app, server
+from app import server
 
 # Pull options from environment
 DEBUG = (os.getenv('DEBUG', 'False') == 'True')
@@ -15,4 +15,7 @@ if __name__ == "__main__":
     print("**********************************")
     server.initialize_logging()
     server.init_db()
-    app.run(host='0.0.0.0', port=int(PORT), debug=DEBUG)
+    server.compactor.start()
+    server.sweeper.start()
+    server.hot_products.start()
+    server.app.run(host='0.0.0.0', port=int(PORT), debug=DEBUG, threaded=True)
@@ -7,9 +7,16 @@ Test cases can be run with:
 """
 
 import os
+import shutil
+import tempfile
 import unittest
-from app import app, db
-from app.models import DataValidationError, ProductInformation
+from datetime import datetime, timedelta
+from app import app, batch, bulk_import, db, shards, storage
+from app.models import DataValidationError, ProductInformation, ReservedQuantityError, \
+    StockMovement, validate_product, validate_restock, validate_update
+from app.schema import validate_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
 # Default ProductInformation property value
 DEFAULT_NEW_QTY = 0
@@ -25,6 +32,12 @@ USED_QTY = 'used_qty'
 OPEN_BOXED_QTY = 'open_boxed_qty'
 RESTOCK_LEVEL = 'restock_level'
 RESTOCK_AMT = 'restock_amt'
+DELETED = 'deleted'
+# Sort keys
+QUANTITY = 'quantity'
+RESTOCK_DISTANCE = 'restock_distance'
+# Tests of the SQL engine itself, skipped when the suite runs with STORAGE_BACKEND=memory
+sql_only = unittest.skipIf(app.config['STORAGE_BACKEND'] == 'memory', 'needs the SQL database')
 
 ######################################################################
 #  T E S T   C A S E S
@@ -48,6 +61,8 @@ class TestProductInformation(unittest.TestCase):
         # ProductInformation.init_db()
         db.drop_all()
         db.create_all()
+        # and the in-memory products with STORAGE_BACKEND=memory
+        storage.reset()
 
     def tearDown(self):
         db.session.remove()
@@ -130,6 +145,42 @@ class TestProductInformation(unittest.TestCase):
                                        restock_level=-2, restock_amt=-1)
         self.assertRaises(DataValidationError, prod_info.deserialize, data)
 
+    def test_validate_payloads(self):
+        """ Validate payloads against the compiled schema, reporting every error """
+        values, errors = validate_product({PROD_ID: 1, PROD_NAME: 'a', NEW_QTY: 2,
+                                           RESTOCK_LEVEL: None, 'other': 'x'})
+        self.assertEqual({PROD_ID: 1, PROD_NAME: 'a', NEW_QTY: 2}, values)
+        self.assertEqual([], errors)
+        values, errors = validate_product({PROD_NAME: 5, NEW_QTY: -1, USED_QTY: 1.5,
+                                           RESTOCK_LEVEL: -2, RESTOCK_AMT: True})
+        self.assertEqual({}, values)
+        self.assertEqual(['missing prod_id', 'prod_name must be a string',
+                          'new_qty must be an integer of at least 0',
+                          'used_qty must be an integer of at least 0',
+                          'restock_level must be an integer of at least -1',
+                          'restock_amt must be an integer of at least 0'], errors)
+        with self.assertRaises(DataValidationError) as context:
+            ProductInformation().deserialize({PROD_ID: 'x', PROD_NAME: 'a', NEW_QTY: -1})
+        self.assertEqual('Invalid ProductInformation: prod_id must be an integer, '
+                         'new_qty must be an integer of at least 0', context.exception.args[0])
+
+        self.assertEqual(({NEW_QTY: 0}, []), validate_update({NEW_QTY: 0}))
+        self.assertEqual(['prod_id cannot be updated'], validate_update({PROD_ID: 1})[1])
+        self.assertEqual(5, ProductInformation.deserialize_restock({RESTOCK_AMT: 5}))
+        self.assertEqual(['unknown fields new_qty'],
+                         validate_restock({RESTOCK_AMT: 5, NEW_QTY: 1})[1])
+        for data in [{}, {RESTOCK_AMT: -1}, {RESTOCK_AMT: 1, NEW_QTY: 1}, [5]]:
+            self.assertRaises(DataValidationError, ProductInformation.deserialize_restock, data)
+
+        # a list is validated in one pass with the errors of every item
+        items = [{PROD_ID: i, PROD_NAME: str(i), NEW_QTY: i - 2} for i in range(5)] + ['x']
+        results, invalid = validate_all(validate_product, items)
+        self.assertEqual(6, len(results))
+        self.assertEqual({PROD_ID: 4, PROD_NAME: '4', NEW_QTY: 2}, results[4])
+        self.assertEqual([(0, ['new_qty must be an integer of at least 0']),
+                          (1, ['new_qty must be an integer of at least 0']),
+                          (5, ['body of request contained bad or no data'])], invalid)
+
     def test_restock(self):
         """ Test manual restocking function. """
         prod_info = ProductInformation()
@@ -259,6 +310,20 @@ class TestProductInformation(unittest.TestCase):
         result = ProductInformation.find_by_name("foo")
         self.assertEqual(2, len(result))
 
+    def test_find_by_name_prefix(self):
+        """ Test find by the start of the product name """
+        ProductInformation(prod_id=1, prod_name="foobar").save()
+        ProductInformation(prod_id=2, prod_name="foo_x").save()
+        ProductInformation(prod_id=3, prod_name="barfoo").save()
+        ProductInformation(prod_id=4, prod_name="fo%").save()
+
+        result = ProductInformation.find_by_name_prefix("foo")
+        self.assertEqual([1, 2], [prod_info.prod_id for prod_info in result])
+        result = ProductInformation.find_by_name_prefix("foo_")
+        self.assertEqual([2], [prod_info.prod_id for prod_info in result])
+        result = ProductInformation.find_by_name_prefix("fo%")
+        self.assertEqual([4], [prod_info.prod_id for prod_info in result])
+
     def test_find_by_quantity(self):
         """ Test find by the product quantity """
         ProductInformation(prod_id=1234, new_qty=1, used_qty=2, open_boxed_qty=3).save()
@@ -295,9 +360,399 @@ class TestProductInformation(unittest.TestCase):
         self.assertEqual(1, len(result))
         self.assertEqual(5678, result[0].prod_id)
 
+    def test_change_seq(self):
+        """ Test that every write bumps the change sequence and deletes leave tombstones """
+        prod_info = ProductInformation(prod_id=1, prod_name="foo")
+        prod_info.save()
+        first_seq = prod_info.change_seq
+        ProductInformation(prod_id=2, prod_name="bar").save()
+        prod_info.prod_name = "baz"
+        prod_info.save()
+        self.assertGreater(prod_info.change_seq, first_seq)
+        self.assertEqual((1, 3), (first_seq, ProductInformation.find(1).change_seq))
+        # initializing the database again keeps the counter
+        ProductInformation.init_db()
+        self.assertEqual(3, ProductInformation.current_change_seq())
+
+        changes = ProductInformation.find_changes(0, 10)
+        self.assertEqual([2, 1], [change.prod_id for change in changes])
+        changes = ProductInformation.find_changes(prod_info.change_seq, 10)
+        self.assertEqual([], changes)
+
+        prod_info.delete()
+        changes = ProductInformation.find_changes(0, 10)
+        self.assertEqual([2, 1], [change.prod_id for change in changes])
+        self.assertTrue(changes[1].serialize_change()[DELETED])
+        self.assertEqual(1, len(ProductInformation.find_changes(0, 1)))
+
+        # re-creating a deleted product removes its tombstone
+        ProductInformation(prod_id=1, prod_name="foo").save()
+        changes = ProductInformation.find_changes(0, 10)
+        self.assertEqual([2, 1], [change.prod_id for change in changes])
+        self.assertFalse(changes[1].serialize_change()[DELETED])
+
+    def test_save_all(self):
+        """ Test saving several products in one transaction with consecutive change sequences """
+        ProductInformation(prod_id=1, prod_name="foo").save()
+        ProductInformation.find(1).delete()
+        prod_infos = [ProductInformation(prod_id=prod_id, prod_name="foo", new_qty=1, used_qty=0,
+                                         open_boxed_qty=0, restock_level=5, restock_amt=10)
+                      for prod_id in [1, 2, 3]]
+        ProductInformation.save_all(prod_infos)
+        seqs = [prod_info.change_seq for prod_info in ProductInformation.find_many([3, 1, 2])]
+        self.assertEqual([seqs[0], seqs[0] + 1, seqs[0] + 2], seqs)
+        self.assertEqual(11, ProductInformation.find(2).new_qty)
+        changes = ProductInformation.find_changes(0, 10)
+        self.assertEqual([1, 2, 3], [change.prod_id for change in changes])
+        self.assertFalse(changes[0].serialize_change()[DELETED])
+
+    def test_sort(self):
+        """ Test sorting by the quantities and the distance to the restock level """
+        for prod_id, new_qty, used_qty, restock_level in [(1, 5, 5, 4), (2, 1, 20, -1),
+                                                          (3, 8, 0, 6), (4, 3, 0, 2)]:
+            ProductInformation(prod_id=prod_id, prod_name=str(5 - prod_id), new_qty=new_qty,
+                               used_qty=used_qty, open_boxed_qty=0, restock_level=restock_level,
+                               restock_amt=0).save()
+        def sorted_ids(sort, descending=False, limit=None):
+            """ Returns the prod_ids of all products in the given order """
+            return [prod_info.prod_id for prod_info in
+                    ProductInformation.list_all(limit=limit, sort=sort, descending=descending)]
+        self.assertEqual([4, 3, 2, 1], sorted_ids(PROD_NAME))
+        self.assertEqual([2, 1, 3, 4], sorted_ids(QUANTITY, descending=True))
+        self.assertEqual([2, 4], sorted_ids(NEW_QTY, limit=2))
+        # product 2 does not restock
+        self.assertEqual([4, 3], sorted_ids(RESTOCK_DISTANCE, limit=2))
+        self.assertEqual([1, 3, 4], sorted_ids(RESTOCK_DISTANCE, descending=True))
+        self.assertRaises(DataValidationError, ProductInformation.list_all, 1, sort=QUANTITY)
+        self.assertRaises(DataValidationError, ProductInformation.list_all, sort='version')
+
+    @sql_only
+    def test_load_fields(self):
+        """ Test loading and serializing only some of the fields """
+        ProductInformation(prod_id=1, prod_name="foo", new_qty=3, used_qty=2, open_boxed_qty=1,
+                           restock_level=-1, restock_amt=0).save()
+        result = ProductInformation.list_all(fields=[NEW_QTY], sort=QUANTITY)
+        self.assertEqual([{NEW_QTY: 3}], [prod_info.serialize([NEW_QTY]) for prod_info in result])
+        self.assertIn(USED_QTY, db.inspect(result[0]).unloaded)
+        self.assertNotIn('total_qty', db.inspect(result[0]).unloaded)
+        prod_info = ProductInformation.find(1, [PROD_ID, PROD_NAME])
+        self.assertEqual({PROD_ID: 1, PROD_NAME: "foo"}, prod_info.serialize([PROD_ID, PROD_NAME]))
+        self.assertEqual('1', prod_info.etag())
+        self.assertRaises(DataValidationError, ProductInformation.list_all, fields=['version'])
+        self.assertRaises(DataValidationError, ProductInformation.find, 1, [])
+
+    @sql_only
+    def test_concurrent_update(self):
+        """ Test that a write based on a stale version is rejected """
+        prod_info = ProductInformation(prod_id=1, prod_name="foo")
+        prod_info.save()
+        self.assertEqual('1', prod_info.etag())
+        prod_info.prod_name = "bar"
+        prod_info.save()
+        self.assertEqual('2', prod_info.etag())
+
+        # another writer updates the row behind our back
+        table = ProductInformation.__table__
+        db.session.execute(table.update().where(table.c.prod_id == 1).values(version=3))
+        prod_info.prod_name = "baz"
+        self.assertRaises(StaleDataError, prod_info.save)
+        db.session.rollback()
+        self.assertEqual("bar", ProductInformation.find(1).prod_name)
+
+    @sql_only
+    def test_sharding(self):
+        """ Test that products are spread over the shards and found on all of them """
+        shard_dir = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_SHARD_URIS'] = ['sqlite:///' + os.path.join(shard_dir, name)
+                                               for name in ['shard0.db', 'shard1.db', 'shard2.db']]
+        try:
+            shards.create_all()
+            for prod_id in range(1, 10):
+                ProductInformation(prod_id=prod_id, prod_name="even" if prod_id % 2 == 0 else "odd",
+                                   new_qty=prod_id, used_qty=0, open_boxed_qty=0).save()
+            for index in range(3):
+                prod_infos = shards.get_session(index).query(ProductInformation).all()
+                self.assertEqual([prod_id for prod_id in range(1, 10) if prod_id % 3 == index],
+                                 sorted(prod_info.prod_id for prod_info in prod_infos))
+
+            # scatter-gather queries come back merged in prod_id order
+            result = ProductInformation.list_all()
+            self.assertEqual(list(range(1, 10)), [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.find_by_name("even", after=2, limit=2)
+            self.assertEqual([4, 6], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.find_by_condition("new", after=7)
+            self.assertEqual([8, 9], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.list_all(limit=4, sort=QUANTITY, descending=True)
+            self.assertEqual([9, 8, 7, 6], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.find_by_name("odd", after=5, sort=PROD_ID, descending=True)
+            self.assertEqual([3, 1], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.list_all(limit=2, sort=QUANTITY, fields=[PROD_NAME])
+            self.assertEqual([{PROD_NAME: "odd"}, {PROD_NAME: "even"}],
+                             [prod_info.serialize([PROD_NAME]) for prod_info in result])
+
+            prod_info = ProductInformation.find(5)
+            prod_info.prod_name = "five"
+            prod_info.save()
+            self.assertEqual("five", ProductInformation.find(5).prod_name)
+            prod_info = ProductInformation.find_by_quantity(7)[0]
+            prod_info.restock(1)
+            prod_info.save()
+            self.assertEqual(8, ProductInformation.find(7).new_qty)
+            ProductInformation.find(9).delete()
+            self.assertIsNone(ProductInformation.find(9))
+
+            changes = ProductInformation.find_changes(0, 20)
+            self.assertEqual([1, 2, 3, 4, 6, 8, 5, 7, 9], [change.prod_id for change in changes])
+
+            # a batch is only all or nothing within one shard
+            operations = [{'op': 'update', PROD_ID: 1, 'data': {NEW_QTY: 0}},
+                          {'op': 'update', PROD_ID: 2, 'data': {NEW_QTY: 0}}]
+            self.assertRaises(batch.BatchError, batch.apply_batch, operations)
+            self.assertEqual(1, ProductInformation.find(1).new_qty)
+            # a failed import chunk rolls back the shards it wrote to
+            StockMovement.__table__.drop(shards.get_engine(1))
+            report = bulk_import.import_rows([(1, {PROD_ID: 10, PROD_NAME: "ten", NEW_QTY: 1})])
+            self.assertEqual(1, report.failed)
+            self.assertTrue(shards.get_session(1).is_active)
+            # a request failing on a shard leaves no transaction open for the next one
+            session = shards.get_session(2)
+            session.expunge_all()
+            session.add(ProductInformation(prod_id=2, prod_name="copy"))
+            self.assertRaises(IntegrityError, session.flush)
+            self.assertFalse(session.is_active)
+            shards.rollback()
+            self.assertTrue(session.is_active)
+        finally:
+            shards.remove()
+            shards.drop_all()
+            app.config['SQLALCHEMY_SHARD_URIS'] = []
+            shutil.rmtree(shard_dir)
+
+    def test_stock_ledger(self):
+        """ Test that writes append stock movements and compaction keeps their sums """
+        prod_info = ProductInformation(prod_id=1, prod_name="foo", new_qty=5, used_qty=2,
+                                       open_boxed_qty=0, restock_level=-1, restock_amt=0)
+        prod_info.save()
+        prod_info = ProductInformation.find(1)
+        prod_info.deserialize_update({USED_QTY: 1, RESTOCK_LEVEL: 10, RESTOCK_AMT: 4})
+        prod_info.save()
+        ProductInformation.find(1).restock(3).save()
+
+        movements = ProductInformation.find_movements(1, 0, 100)
+        self.assertEqual([('new', 5, 'create'), ('used', 2, 'create'), ('used', -1, 'update'),
+                          ('new', 4, 'automatic_restock'), ('new', 3, 'restock')],
+                         [(movement.condition, movement.delta, movement.reason)
+                          for movement in movements])
+        self.assertEqual([2], [movement.movement_id for movement in
+                               ProductInformation.find_movements(1, 1, 1)])
+
+        # folding everything leaves one snapshot per condition with the quantity
+        self.assertEqual(0, ProductInformation.compact_ledger(datetime.utcnow() - timedelta(days=1)))
+        self.assertEqual(5, ProductInformation.compact_ledger(datetime.utcnow() + timedelta(days=1)))
+        movements = ProductInformation.find_movements(1, 0, 100)
+        self.assertEqual([('used', 1, 'snapshot'), ('new', 12, 'snapshot')],
+                         [(movement.condition, movement.delta, movement.reason)
+                          for movement in movements])
+        prod_info = ProductInformation.find(1)
+        self.assertEqual((12, 1), (prod_info.new_qty, prod_info.used_qty))
+        prod_info.delete()
+        self.assertEqual(0, sum(movement.delta for movement in
+                                ProductInformation.find_movements(1, 0, 100)))
+
+    @sql_only
+    def test_hot_counters(self):
+        """ Test that restocks of a hot product go to its counters until they are folded """
+        ProductInformation(prod_id=1, prod_name="foo", new_qty=5, used_qty=1, open_boxed_qty=0,
+                           restock_level=-1, restock_amt=0).save()
+        prod_info = ProductInformation.find(1)
+        prod_info.mark_hot()
+        prod_info.restock_counter(3, 0)
+        self.assertEqual((8, '1.3'), (prod_info.new_qty, prod_info.etag()))
+        ProductInformation.find(1).restock_counter(4, 1)
+
+        # reads add the counters up while the row keeps its version
+        prod_info = ProductInformation.find(1)
+        self.assertEqual((12, '1.7'), (prod_info.new_qty, prod_info.etag()))
+        self.assertEqual({NEW_QTY: 12}, ProductInformation.find(1, [NEW_QTY]).serialize([NEW_QTY]))
+        self.assertEqual([12], [prod_info.new_qty for prod_info in ProductInformation.list_all()])
+        self.assertEqual([12], [prod_info.new_qty for prod_info in
+                                ProductInformation.find_many([1], fields=[NEW_QTY])])
+
+        self.assertEqual(1, ProductInformation.fold_counters())
+        prod_info = ProductInformation.find(1)
+        self.assertEqual((12, 13, '2', 'restock'), (prod_info.new_qty, prod_info.total_qty,
+                                                    prod_info.etag(), prod_info.change_type))
+        self.assertEqual([('new', 5, 'create'), ('used', 1, 'create'), ('new', 3, 'restock'),
+                          ('new', 4, 'restock')],
+                         [(movement.condition, movement.delta, movement.reason)
+                          for movement in ProductInformation.find_movements(1, 0, 100)])
+
+        # an update folds the counters it read, later restocks stay in them
+        prod_info.restock_counter(2, 0)
+        prod_info = ProductInformation.find(1)
+        # restocked by another request
+        db.session.expunge(prod_info)
+        ProductInformation.find(1).restock_counter(1, 0)
+        db.session.expunge_all()
+        prod_info.deserialize_update({NEW_QTY: 20})
+        prod_info.save()
+        self.assertEqual((21, '3.1'), (ProductInformation.find(1).new_qty,
+                                       ProductInformation.find(1).etag()))
+        self.assertEqual(1, ProductInformation.fold_counters())
+        # nothing left to fold, the product is no longer hot
+        self.assertEqual(0, ProductInformation.fold_counters())
+        self.assertFalse(ProductInformation.find(1).hot)
+        self.assertEqual(21, sum(movement.delta for movement in
+                                 ProductInformation.find_movements(1, 0, 100)
+                                 if movement.condition == 'new'))
+
+    def test_reservations(self):
+        """ Test holding, confirming, releasing and expiring reservations """
+        self.check_reservations()
+
+    def test_memory_reservations(self):
+        """ Test reservations of products stored in memory """
+        backend = app.config['STORAGE_BACKEND']
+        app.config['STORAGE_BACKEND'] = 'memory'
+        storage.reset()
+        try:
+            self.check_reservations()
+        finally:
+            storage.reset()
+            app.config['STORAGE_BACKEND'] = backend
+
+    def test_memory_storage(self):
+        """ Test storing products in memory and snapshotting them to a file """
+        snapshot_dir = tempfile.mkdtemp()
+        backend = app.config['STORAGE_BACKEND']
+        app.config['STORAGE_BACKEND'] = 'memory'
+        app.config['STORAGE_SNAPSHOT_PATH'] = os.path.join(snapshot_dir, 'products.json')
+        storage.reset()
+        try:
+            ProductInformation.init_db()
+            for prod_id in range(1, 7):
+                ProductInformation(prod_id=prod_id, prod_name="even" if prod_id % 2 == 0 else "odd",
+                                   new_qty=prod_id % 3, used_qty=1, open_boxed_qty=0,
+                                   restock_level=-1, restock_amt=0).save()
+            prod_info = ProductInformation.find(4)
+            self.assertEqual({PROD_ID: 4, PROD_NAME: "even"}, prod_info.serialize([PROD_ID, PROD_NAME]))
+            self.assertEqual('1', prod_info.etag())
+
+            # a found product stays the same instance until the session ends, and its
+            # changes are stored when it is saved
+            prod_info.prod_name = "four"
+            self.assertIs(prod_info, ProductInformation.find(4))
+            self.assertEqual([2, 4, 6], [prod_info.prod_id for prod_info in
+                                         ProductInformation.find_by_name("even")])
+            prod_info = ProductInformation.find(4)
+            prod_info.save()
+            self.assertEqual('2', prod_info.etag())
+            self.assertEqual("four", ProductInformation.find(4).prod_name)
+
+            result = ProductInformation.find_by_name("odd", after=1)
+            self.assertEqual([3, 5], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.find_by_name_prefix("ev")
+            self.assertEqual([2, 6], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.find_by_quantity(3)
+            self.assertEqual([2, 5], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.find_by_condition("new", sort=QUANTITY, descending=True)
+            self.assertEqual([2, 5, 1, 4], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.list_all(limit=3, sort=QUANTITY, descending=True)
+            self.assertEqual([2, 5, 1], [prod_info.prod_id for prod_info in result])
+            result = ProductInformation.list_all(after=4, limit=1, sort=PROD_ID, descending=True)
+            self.assertEqual([3], [prod_info.prod_id for prod_info in result])
+            self.assertEqual([4, 6], [prod_info.prod_id for prod_info in
+                                      ProductInformation.find_many([6, 4, 9])])
+            self.assertRaises(DataValidationError, ProductInformation.find, 1, ['version'])
+
+            # a stale write changes nothing
+            stale = ProductInformation.find(1)
+            db.session.remove()
+            ProductInformation.find(1).restock(5).save()
+            stale.prod_name = "one"
+            self.assertRaises(StaleDataError, stale.save)
+            self.assertEqual(6, ProductInformation.find(1).new_qty)
+            ProductInformation.find(6).delete()
+            self.assertIsNone(ProductInformation.find(6))
+            changes = ProductInformation.find_changes(6, 10)
+            self.assertEqual([(7, 4), (8, 1), (9, 6)],
+                             [(change.change_seq, change.prod_id) for change in changes])
+            self.assertEqual(9, ProductInformation.current_change_seq())
+
+            # a new process picks up where the snapshot left off
+            storage.snapshot()
+            storage.reset()
+            self.assertEqual([1, 2, 3, 4, 5], [prod_info.prod_id for prod_info in
+                                               ProductInformation.list_all()])
+            self.assertEqual(6, ProductInformation.find(1).new_qty)
+            self.assertEqual([9], [change.change_seq for change in
+                                   ProductInformation.find_changes(8, 10)])
+            self.assertEqual([('new', 1, 'create'), ('used', 1, 'create'), ('new', 5, 'restock')],
+                             [(movement.condition, movement.delta, movement.reason) for movement in
+                              ProductInformation.find_movements(1, 0, 10)])
+            # product 1 and the deleted product 6 have movements to fold
+            self.assertEqual(4, ProductInformation.compact_ledger(datetime.utcnow()))
+            self.assertEqual([('used', 1), ('new', 6)],
+                             [(movement.condition, movement.delta) for movement in
+                              ProductInformation.find_movements(1, 0, 10)])
+        finally:
+            storage.reset()
+            app.config['STORAGE_BACKEND'] = backend
+            app.config['STORAGE_SNAPSHOT_PATH'] = None
+            shutil.rmtree(snapshot_dir)
+
 ######################################################################
 # Utility functions
 ######################################################################
+    def check_reservations(self):
+        """ Holds, confirms, releases and expires reservations of the configured storage """
+        ProductInformation(prod_id=1, prod_name="foo", new_qty=5, used_qty=1, open_boxed_qty=0,
+                           restock_level=-1, restock_amt=0).save()
+        first = ProductInformation.reserve(1, 'new', 3, 60)
+        self.assertEqual(('held', 3), (first.status, first.quantity))
+        change_seq = ProductInformation.current_change_seq()
+        # only two new products are left to promise
+        self.assertIsNone(ProductInformation.reserve(1, 'new', 3, 60))
+        self.assertIsNone(ProductInformation.reserve(2, 'new', 1, 60))
+        # rejected holds take no change sequence number
+        self.assertEqual(change_seq, ProductInformation.current_change_seq())
+        self.assertRaises(DataValidationError, ProductInformation.reserve, 1, 'broken', 1, 60)
+        second = ProductInformation.reserve(1, 'new', 2, 60)
+        lapsed = ProductInformation.reserve(1, 'used', 1, -1)
+        data = ProductInformation.find(1).serialize()
+        self.assertEqual((5, 0, 1, 0), (data[NEW_QTY], data['available_new_qty'],
+                                        data[USED_QTY], data['available_used_qty']))
+        self.assertEqual('reserve', ProductInformation.find(1).change_type)
+        # a write cannot leave fewer products than the reservations hold
+        prod_info = ProductInformation.find(1)
+        prod_info.new_qty = 4
+        self.assertRaises(ReservedQuantityError, prod_info.save)
+        db.session.rollback()
+        self.assertEqual(5, ProductInformation.find(1).new_qty)
+        report = bulk_import.import_rows([(1, {PROD_ID: 1, PROD_NAME: "foo", NEW_QTY: 4}),
+                                          (2, {PROD_ID: 3, PROD_NAME: "bar"})], bulk_import.UPSERT)
+        self.assertEqual((1, [1]), (report.imported, [error['line'] for error in report.errors]))
+        self.assertEqual(5, ProductInformation.find(1).new_qty)
+
+        self.assertEqual('confirmed',
+                         ProductInformation.confirm_reservation(1, first.reservation_id).status)
+        self.assertIsNone(ProductInformation.confirm_reservation(1, first.reservation_id))
+        self.assertIsNone(ProductInformation.release_reservation(1, first.reservation_id))
+        self.assertEqual('released',
+                         ProductInformation.release_reservation(1, second.reservation_id).status)
+        self.assertIsNone(ProductInformation.find_reservation(2, second.reservation_id))
+
+        self.assertEqual(1, ProductInformation.expire_reservations(10))
+        self.assertEqual(0, ProductInformation.expire_reservations(10))
+        self.assertEqual('expired',
+                         ProductInformation.find_reservation(1, lapsed.reservation_id).status)
+        prod_info = ProductInformation.find(1)
+        self.assertEqual((2, 2, 1, 1), (prod_info.new_qty, prod_info.available(NEW_QTY),
+                                        prod_info.used_qty, prod_info.available(USED_QTY)))
+        movement = ProductInformation.find_movements(1, 0, 100)[-1]
+        self.assertEqual(('new', -3, 'confirm'),
+                         (movement.condition, movement.delta, movement.reason))
+
     def assert_fields_equal(self, prod_info, expect_prod_id, expect_prod_name, expect_new_qty,
                             expect_used_qty, expect_open_boxed_qty, expect_restock_level, expect_restock_amt):
         """ Utility function for checking if fields are equal """
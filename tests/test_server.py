@@ -6,13 +6,23 @@ Test cases can be run with the following:
   coverage report -m
 """
 
+import gzip
+import io
 import logging
 import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import msgpack
+from flask import g
 from flask_api import status
-from app import db, server
+from app import assets, db, server, storage
+from app.coalescing import SingleFlight
 from app.models import ProductInformation
+from app.replicas import on_primary
 
 ######################################################################
 #  Fixed Global Variables
@@ -38,11 +48,35 @@ PATH_INVENTORY_PROD_ID = '/inventory/{}'
 PATH_INVENTORY_QUERY_BY_PROD_NAME = '/inventory?prod_name={}'
 PATH_INVENTORY_QUERY_BY_QUANTITY = '/inventory?quantity={}'
 PATH_INVENTORY_QUERY_BY_CONDITION = '/inventory?condition={}'
+PATH_INVENTORY_SEARCH = '/inventory?{}={}'
+PATH_INVENTORY_SORT = '/inventory?sort={}&order={}&limit={}'
+PATH_INVENTORY_PAGE = '/inventory?after={}&limit={}'
+PATH_INVENTORY_FIELDS = '/inventory?fields={}'
+PATH_INVENTORY_IDS = '/inventory?ids={}'
+PATH_LOOKUP = '/inventory/lookup'
+PATH_BATCH = '/inventory/batch'
+PATH_INVENTORY_PROD_ID_FIELDS = '/inventory/{}?fields={}'
 PATH_RESTOCK = '/inventory/{}/restock'
+PATH_EXPORT = '/inventory/export?format={}'
+PATH_EXPORT_ALL = '/inventory/export'
+PATH_IMPORT = '/inventory/import?mode={}&chunk_size={}'
+PATH_SPEC = '/v1/spec'
+PATH_ADMISSION = '/admission'
+PATH_CHANGES = '/inventory/changes?since={}&limit={}'
+PATH_MOVEMENTS = '/inventory/{}/movements?since={}&limit={}'
+PATH_EVENTS = '/inventory/events?ids={}'
+PATH_RESERVATIONS = '/inventory/{}/reservations'
+PATH_RESERVATION = '/inventory/{}/reservations/{}/{}'
 # Content type
 JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+COLUMNAR_JSON = 'application/vnd.inventory.columnar+json'
+COLUMNAR_MSGPACK = 'application/vnd.inventory.columnar+msgpack'
 # Location header
 LOCATION = 'Location'
+# Tests of the SQL engine itself, skipped when the suite runs with STORAGE_BACKEND=memory
+sql_only = unittest.skipIf(server.app.config['STORAGE_BACKEND'] == 'memory',
+                           'needs the SQL database')
 
 ######################################################################
 #  Test Cases
@@ -67,6 +101,10 @@ class TestInventoryServer(unittest.TestCase):
         server.init_db()
         db.drop_all()
         db.create_all()
+        # the change counter starts over with the database
+        # and the in-memory products with STORAGE_BACKEND=memory
+        storage.reset()
+        server.query_cache.clear()
         # automatic restock will be triggered when the 2 products are saved to database.
         ProductInformation(prod_id=1, prod_name='a', new_qty=1, used_qty=1, open_boxed_qty=1,
                            restock_level=10, restock_amt=10).save()
@@ -83,6 +121,59 @@ class TestInventoryServer(unittest.TestCase):
         response = self.app.get(PATH_ROOT)
         self.assertEqual(status.HTTP_200_OK, response.status_code)
 
+    def test_spec(self):
+        """ The API spec is served from memory and revalidated with its ETag """
+        response = self.app.get(PATH_SPEC)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn('/inventory/{prod_id}', json.loads(response.data)['paths'])
+        self.assertIn('max-age', response.headers.get('Cache-Control'))
+        etag = response.headers.get('ETag')
+        response = self.app.get(PATH_SPEC, headers={'If-None-Match': etag})
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+    def test_spec_matches_docstrings(self):
+        """ The generated spec files are up to date (regenerate with python -m app.docs) """
+        docs = server.app.extensions['lazy_swagger']
+        for spec in server.app.config['SWAGGER']['specs']:
+            self.assertEqual(docs.generate_spec(spec), docs.load_spec(spec))
+
+    def test_assets(self):
+        """ The homepage links fingerprinted assets served precompressed and cached forever """
+        asset_dir = tempfile.mkdtemp()
+        server.app.config['ASSET_DIR'] = asset_dir
+        try:
+            manifest = assets.build(asset_dir)
+            response = self.app.get(PATH_ROOT)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertEqual('no-cache', response.headers.get('Cache-Control'))
+            css = 'assets/' + manifest['css/flatly_bootstrap.min.css']
+            self.assertIn(css, response.data)
+            self.assertNotIn('static/js/rest_api.js', response.data)
+
+            response = self.app.get('/' + css, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertEqual('gzip', response.headers.get('Content-Encoding'))
+            self.assertIn('immutable', response.headers.get('Cache-Control'))
+            self.assertIn('Accept-Encoding', response.headers.get('Vary'))
+            with open(os.path.join(assets.STATIC_DIR, 'css', 'flatly_bootstrap.min.css'), 'rb') as css_file:
+                content = css_file.read()
+            self.assertEqual(content, gzip.GzipFile(fileobj=io.BytesIO(response.data)).read())
+
+            response = self.app.get('/' + css, headers={'Accept-Encoding': 'identity'})
+            self.assertIsNone(response.headers.get('Content-Encoding'))
+            self.assertEqual(content, response.data)
+            response = self.app.get('/assets/css/flatly_bootstrap.min.css')
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+            # a build for a CDN links the assets there
+            assets.main([asset_dir, '--base-url', 'https://cdn.example.com/inventory'])
+            response = self.app.get(PATH_ROOT)
+            self.assertIn('https://cdn.example.com/inventory/' + manifest['css/flatly_bootstrap.min.css'],
+                          response.data)
+        finally:
+            server.app.config['ASSET_DIR'] = None
+            shutil.rmtree(asset_dir)
+
     def test_create_prod_info_bad_request(self):
         """ Test for create ProductInformation with bad request. """
         # Test cases where not all mandatory fields are given.
@@ -308,6 +399,414 @@ class TestInventoryServer(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(2, len(data))
 
+    def test_list_pages(self):
+        """ List products page by page """
+        response = self.app.get(PATH_INVENTORY_PAGE.format(0, 1))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        data = json.loads(response.data)
+        self.assertEqual([1], [prod_info[PROD_ID] for prod_info in data])
+
+        response = self.app.get(PATH_INVENTORY_PAGE.format(1, 1) + '&condition=new')
+        data = json.loads(response.data)
+        self.assertEqual([2], [prod_info[PROD_ID] for prod_info in data])
+
+        response = self.app.get(PATH_INVENTORY_PAGE.format(2, 1))
+        self.assertEqual([], json.loads(response.data))
+
+        response = self.app.get(PATH_INVENTORY_PAGE.format(0, 0))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.get(PATH_INVENTORY_PAGE.format('a', 1))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_export(self):
+        """ Export products as CSV and NDJSON a batch at a time, resuming after a prod_id """
+        server.app.config['EXPORT_BATCH_SIZE'] = 2
+        try:
+            ProductInformation().deserialize({PROD_ID: 3, PROD_NAME: 'c, "d"', NEW_QTY: 3}).save()
+            response = self.app.get(PATH_EXPORT.format('csv'))
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertIn('text/csv', response.headers.get('Content-Type'))
+            lines = response.data.split('\r\n')
+            self.assertEqual(','.join([PROD_ID, PROD_NAME, NEW_QTY, USED_QTY, OPEN_BOXED_QTY,
+                                       RESTOCK_LEVEL, RESTOCK_AMT]), lines[0])
+            self.assertEqual(['1', '2', '3', ''], [line.split(',')[0] for line in lines[1:]])
+            self.assertEqual('3,"c, ""d""",3,0,0,-1,0', lines[3])
+
+            response = self.app.get(PATH_EXPORT.format('ndjson') + '&after=1')
+            data = [json.loads(line) for line in response.data.splitlines()]
+            self.assertEqual([2, 3], [prod_info[PROD_ID] for prod_info in data])
+
+            response = self.app.get(PATH_EXPORT.format('ndjson') + '&condition=used')
+            data = [json.loads(line) for line in response.data.splitlines()]
+            self.assertEqual([1, 2], [prod_info[PROD_ID] for prod_info in data])
+
+            response = self.app.get(PATH_EXPORT.format('xml'))
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+            response = self.app.get(PATH_EXPORT.format('csv') + '&quantity=a')
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        finally:
+            server.app.config['EXPORT_BATCH_SIZE'] = 1000
+
+    def test_response_formats(self):
+        """ Negotiate MessagePack and columnar responses and accept MessagePack bodies """
+        response = self.app.get(PATH_INVENTORY, headers={'Accept': MSGPACK})
+        self.assertEqual(MSGPACK, response.headers.get('Content-Type'))
+        self.assertEqual('Accept', response.headers.get('Vary'))
+        self.assertEqual([1, 2], [prod_info[PROD_ID] for prod_info in
+                                  msgpack.unpackb(response.data, raw=False)])
+        response = self.app.get(PATH_INVENTORY_FIELDS.format('prod_id,used_qty'),
+                                headers={'Accept': COLUMNAR_JSON})
+        self.assertEqual({PROD_ID: [1, 2], USED_QTY: [1, 2]}, json.loads(response.data))
+        response = self.app.get(PATH_INVENTORY_PROD_ID.format(2),
+                                headers={'Accept': COLUMNAR_MSGPACK})
+        self.assertEqual(['b'], msgpack.unpackb(response.data, raw=False)[PROD_NAME])
+        self.assertEqual('"1"', response.headers.get('ETag'))
+        response = self.app.get(PATH_INVENTORY_PROD_ID.format(2), headers={'Accept': 'text/html'})
+        self.assertEqual(JSON, response.headers.get('Content-Type'))
+
+        data = msgpack.packb({PROD_ID: 3, PROD_NAME: 'c', NEW_QTY: 3}, use_bin_type=True)
+        response = self.app.post(PATH_INVENTORY, data=data, content_type=MSGPACK,
+                                 headers={'Accept': MSGPACK})
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual('c', msgpack.unpackb(response.data, raw=False)[PROD_NAME])
+        data = msgpack.packb({RESTOCK_AMT: 2}, use_bin_type=True)
+        response = self.app.put(PATH_RESTOCK.format(3), data=data, content_type=MSGPACK)
+        self.assertEqual(5, json.loads(response.data)[NEW_QTY])
+        response = self.app.put(PATH_INVENTORY_PROD_ID.format(3), data=b'\xc1', content_type=MSGPACK)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+        server.app.config['EXPORT_BATCH_SIZE'] = 2
+        try:
+            response = self.app.get(PATH_EXPORT_ALL, headers={'Accept': MSGPACK})
+            self.assertEqual(MSGPACK, response.headers.get('Content-Type'))
+            unpacker = msgpack.Unpacker(io.BytesIO(response.data), raw=False)
+            self.assertEqual([1, 2, 3], [prod_info[PROD_ID] for prod_info in unpacker])
+            response = self.app.get(PATH_EXPORT.format('columnar'))
+            self.assertEqual([[1, 2], [3]], [json.loads(line)[PROD_ID]
+                                             for line in response.data.splitlines()])
+            response = self.app.get(PATH_EXPORT_ALL)
+            self.assertIn('text/csv', response.headers.get('Content-Type'))
+        finally:
+            server.app.config['EXPORT_BATCH_SIZE'] = 1000
+
+    def test_batch(self):
+        """ Apply mixed operations in one transaction, all or nothing """
+        operations = [
+            {'op': 'create', 'data': {PROD_ID: 3, PROD_NAME: 'c', NEW_QTY: 1}},
+            {'op': 'restock', PROD_ID: 3, 'data': {RESTOCK_AMT: 4}},
+            {'op': 'update', PROD_ID: 1, 'data': {PROD_NAME: 'z'}, 'if_match': '1'}
+        ]
+        response = self.app.post(PATH_BATCH, data=json.dumps({'operations': operations}),
+                                 content_type=JSON)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        results = json.loads(response.data)['results']
+        self.assertEqual([201, 200, 200], [result['status'] for result in results])
+        self.assertEqual([1, 5], [result['data'][NEW_QTY] for result in results[:2]])
+        self.assertEqual(5, ProductInformation.find(3).new_qty)
+        self.assertEqual('z', ProductInformation.find(1).prod_name)
+        response = self.app.get(PATH_CHANGES.format(2, 10))
+        self.assertEqual(['create', 'update'],
+                         [change['change_type'] for change in json.loads(response.data)['changes']])
+
+        # the automatic restock an operation sets off is booked as one in the ledger
+        operations = [
+            {'op': 'update', PROD_ID: 1, 'data': {NEW_QTY: 2}},
+            {'op': 'update', PROD_ID: 1, 'data': {PROD_NAME: 'x'}}
+        ]
+        response = self.app.post(PATH_BATCH, data=json.dumps({'operations': operations}),
+                                 content_type=JSON)
+        self.assertEqual(12, ProductInformation.find(1).new_qty)
+        self.assertEqual([(-9, 'update'), (10, 'automatic_restock')],
+                         [(movement.delta, movement.reason)
+                          for movement in ProductInformation.find_movements(1, 0, 100)[-2:]])
+
+        # the failing restock rolls back the update before it
+        operations = [
+            {'op': 'update', PROD_ID: 2, 'data': {PROD_NAME: 'y'}},
+            {'op': 'restock', PROD_ID: 2, 'data': {RESTOCK_AMT: -1}}
+        ]
+        response = self.app.post(PATH_BATCH, data=json.dumps({'operations': operations}),
+                                 content_type=JSON)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEqual(1, json.loads(response.data)['index'])
+        self.assertEqual('b', ProductInformation.find(2).prod_name)
+
+        # the data of all the operations is validated first, listing every error
+        operations = [
+            {'op': 'update', PROD_ID: 9, 'data': {}},
+            {'op': 'create', 'data': {PROD_ID: 4, NEW_QTY: -1}},
+            {'op': 'update', PROD_ID: 2, 'data': {PROD_NAME: 'y'}},
+            {'op': 'update', PROD_ID: 2, 'data': {USED_QTY: 'x'}}
+        ]
+        response = self.app.post(PATH_BATCH, data=json.dumps({'operations': operations}),
+                                 content_type=JSON)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        data = json.loads(response.data)
+        self.assertEqual(1, data['index'])
+        self.assertEqual([1, 3], [error['index'] for error in data['errors']])
+        self.assertEqual('Invalid ProductInformation: missing prod_name, '
+                         'new_qty must be an integer of at least 0', data['errors'][0]['message'])
+
+        for operation, status_code in [({'op': 'update', PROD_ID: 9, 'data': {}}, 404),
+                                       ({'op': 'create', 'data': {PROD_ID: 1, PROD_NAME: 'a'}}, 400),
+                                       ({'op': 'update', PROD_ID: 2, 'data': {},
+                                         'if_match': '7'}, 412),
+                                       ({'op': 'delete', PROD_ID: 2, 'data': {}}, 400)]:
+            response = self.app.post(PATH_BATCH, data=json.dumps({'operations': [operation]}),
+                                     content_type=JSON)
+            self.assertEqual(status_code, response.status_code)
+        response = self.app.post(PATH_BATCH, data=json.dumps([]), content_type=JSON)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_admission_control(self):
+        """ Shed, rate limit and cancel requests past the limits, counting them """
+        config = server.app.config
+        saved = dict((key, value) for key, value in config.items() if key.startswith('ADMISSION_'))
+        try:
+            config.update(ADMISSION_MAX_READS=1, ADMISSION_MAX_QUEUE=0)
+            server.admission.reset()
+            reads = server.admission.limits['reads']
+            self.assertTrue(reads.acquire(0))
+            response = self.app.get(PATH_INVENTORY)
+            self.assertEqual(status.HTTP_503_SERVICE_UNAVAILABLE, response.status_code)
+            self.assertEqual('1', response.headers.get('Retry-After'))
+            # waiting requests get the slot when it is released
+            config.update(ADMISSION_MAX_QUEUE=1)
+            server.admission.reset()
+            reads = server.admission.limits['reads']
+            self.assertTrue(reads.acquire(0))
+            threading.Timer(0.05, reads.release).start()
+            response = self.app.get(PATH_INVENTORY)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertEqual(1, reads.queued)
+            self.assertEqual(0, reads.active)
+
+            config.update(ADMISSION_RATE=0.1, ADMISSION_BURST=1)
+            server.admission.reset()
+            self.assertEqual(status.HTTP_200_OK, self.app.get(PATH_INVENTORY).status_code)
+            response = self.app.get(PATH_INVENTORY)
+            self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS, response.status_code)
+            self.assertEqual('10', response.headers.get('Retry-After'))
+            # a client cannot get a fresh bucket by making up an X-Forwarded-For
+            response = self.app.get(PATH_INVENTORY, headers={'X-Forwarded-For': '10.0.0.1'})
+            self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS, response.status_code)
+            # but behind a trusted proxy the address it appends is the client
+            config.update(ADMISSION_TRUSTED_PROXIES=1)
+            response = self.app.get(PATH_INVENTORY,
+                                    headers={'X-Forwarded-For': '10.0.0.1, 10.0.0.2'})
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+        finally:
+            config.update(saved)
+            server.admission.reset()
+
+    @sql_only
+    def test_admission_deadline(self):
+        """ Cancel the statements of a request past its deadline, counting them """
+        config = server.app.config
+        saved = dict((key, value) for key, value in config.items() if key.startswith('ADMISSION_'))
+        try:
+            config.update(ADMISSION_DEADLINE=-1)
+            server.admission.reset()
+            response = self.app.get(PATH_INVENTORY_PROD_ID.format(1))
+            self.assertEqual(status.HTTP_503_SERVICE_UNAVAILABLE, response.status_code)
+            stats = json.loads(self.app.get(PATH_ADMISSION).data)
+            self.assertEqual(1, stats['deadline_exceeded'])
+            self.assertEqual(1, stats['reads']['admitted'])
+        finally:
+            config.update(saved)
+            server.admission.reset()
+
+    def test_coalescing(self):
+        """ Identical concurrent reads share one call and its response """
+        flights = SingleFlight()
+        started = threading.Event()
+        finish = threading.Event()
+        calls = []
+        results = []
+
+        def slow_read():
+            """ A read that waits until it is told to finish """
+            calls.append(1)
+            started.set()
+            finish.wait()
+            return 'products'
+
+        leader = threading.Thread(target=lambda: results.append(flights.do('key', slow_read)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=lambda: results.append(flights.do('key', slow_read)))
+        follower.start()
+        while not flights.coalesced:
+            time.sleep(0.001)
+        finish.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(['products', 'products'], results)
+        self.assertEqual(1, len(calls))
+        # nothing is kept once the call returns
+        self.assertRaises(ValueError, flights.do, 'key', lambda: int('a'))
+        self.assertEqual('again', flights.do('key', lambda: 'again'))
+
+        response = self.app.get(PATH_INVENTORY_PROD_ID.format(1))
+        self.assertEqual('"1"', response.headers.get('ETag'))
+        self.assertEqual(1, json.loads(response.data)[PROD_ID])
+
+    def test_query_cache(self):
+        """ Repeated lists are served from the cache until the next write """
+        cache = server.query_cache
+        first = self.app.get(PATH_INVENTORY_FIELDS.format('prod_id'))
+        second = self.app.get(PATH_INVENTORY_FIELDS.format('prod_id'))
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(1, cache.hits)
+        response = self.app.get(PATH_INVENTORY_FIELDS.format('prod_id'), headers={'Accept': MSGPACK})
+        self.assertEqual(MSGPACK, response.headers.get('Content-Type'))
+        self.assertEqual(1, cache.hits)
+
+        self.app.put(PATH_RESTOCK.format(2), data=json.dumps({RESTOCK_AMT: 5}), content_type=JSON)
+        response = self.app.get(PATH_INVENTORY_FIELDS.format('new_qty'))
+        self.assertEqual([{NEW_QTY: 11}, {NEW_QTY: 27}], json.loads(response.data))
+        self.assertEqual(1, len(cache.entries))
+        # reads of an older generation, from a replica further behind, leave the entries be
+        self.assertIsNone(cache.get(cache.generation - 1, list(cache.entries)[0]))
+        self.assertEqual(1, len(cache.entries))
+
+        # the least recently used entries are evicted beyond the memory cap
+        server.app.config['QUERY_CACHE_MAX_BYTES'] = len(response.data) + 10
+        try:
+            self.app.get(PATH_INVENTORY_FIELDS.format('used_qty'))
+            self.assertEqual([('/inventory', (('fields', 'used_qty'),))],
+                             [key[1:3] for key in cache.entries])
+            self.assertLessEqual(cache.size, len(response.data) + 10)
+        finally:
+            server.app.config['QUERY_CACHE_MAX_BYTES'] = 16 * 1024 * 1024
+
+    def test_import(self):
+        """ Import CSV and NDJSON uploads a chunk at a time, reporting invalid rows """
+        data = 'prod_id,prod_name,new_qty\r\n3,c,3\r\n1,dup,1\r\n4,"d, e",x\r\n5,,5\r\n6,f,\r\n'
+        response = self.app.post(PATH_IMPORT.format('insert', 2), data=data, content_type='text/csv')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        report = json.loads(response.data)
+        self.assertEqual(5, report['rows'])
+        self.assertEqual(3, report['imported'])
+        self.assertEqual([3, 4], [error['line'] for error in report['errors']])
+        self.assertEqual(3, ProductInformation.find(3).new_qty)
+        self.assertEqual(0, ProductInformation.find(6).new_qty)
+        self.assertEqual('a', ProductInformation.find(1).prod_name)
+
+        data = '\n'.join(json.dumps(row) for row in [{PROD_ID: 1, PROD_NAME: 'z', USED_QTY: 5},
+                                                     {PROD_ID: 7, PROD_NAME: 'g'}, [7]])
+        response = self.app.post(PATH_IMPORT.format('upsert', 10), data=data,
+                                 content_type='application/x-ndjson')
+        report = json.loads(response.data)
+        self.assertEqual(2, report['imported'])
+        self.assertEqual([3], [error['line'] for error in report['errors']])
+        self.assertEqual('z', ProductInformation.find(1).prod_name)
+        self.assertEqual(5, ProductInformation.find(1).used_qty)
+        self.assertEqual(6, self.get_entry_count())
+        self.assertEqual('', ProductInformation.find(5).prod_name)
+
+        response = self.app.post(PATH_IMPORT.format('insert', 2), data='id\r\n1\r\n',
+                                 content_type='text/csv')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.post(PATH_IMPORT.format('merge', 2), data=data,
+                                 content_type='application/x-ndjson')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.post(PATH_IMPORT.format('insert', 2), data=data, content_type=JSON)
+        self.assertEqual(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, response.status_code)
+
+    def test_search_names(self):
+        """ Search products by the start of their name and by a ranked substring """
+        for prod_id, prod_name in [(3, 'Blue Widget'), (4, 'widget'), (5, 'Red widgets'), (6, 'gadget')]:
+            ProductInformation(prod_id=prod_id, prod_name=prod_name).save()
+        response = self.app.get(PATH_INVENTORY_SEARCH.format('name_prefix', 'Red'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([5], [prod_info[PROD_ID] for prod_info in json.loads(response.data)])
+
+        response = self.app.get(PATH_INVENTORY_SEARCH.format('name_contains', 'WIDGET'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([4, 5, 3], [prod_info[PROD_ID] for prod_info in json.loads(response.data)])
+        response = self.app.get(PATH_INVENTORY_SEARCH.format('name_contains', 'adget') + '&limit=1')
+        self.assertEqual([6], [prod_info[PROD_ID] for prod_info in json.loads(response.data)])
+
+        # the index follows later writes
+        self.app.delete(PATH_INVENTORY_PROD_ID.format(4))
+        data = json.dumps({PROD_NAME: 'Green widget'})
+        self.app.put(PATH_INVENTORY_PROD_ID.format(6), data=data, content_type=JSON)
+        response = self.app.get(PATH_INVENTORY_SEARCH.format('name_contains', 'widget'))
+        self.assertEqual([5, 3, 6], [prod_info[PROD_ID] for prod_info in json.loads(response.data)])
+        response = self.app.get(PATH_INVENTORY_SEARCH.format('name_contains', 'e'))
+        self.assertEqual(3, len(json.loads(response.data)))
+        response = self.app.get(PATH_INVENTORY_SEARCH.format('name_contains', 'GR'))
+        self.assertEqual([6], [prod_info[PROD_ID] for prod_info in json.loads(response.data)])
+
+        response = self.app.get(PATH_INVENTORY_SEARCH.format('name_contains', 'widget') + '&after=1')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_list_sorted(self):
+        """ List the top products by a sort key """
+        ProductInformation(prod_id=3, prod_name='c', new_qty=50, used_qty=0, open_boxed_qty=0,
+                           restock_level=-1, restock_amt=0).save()
+        response = self.app.get(PATH_INVENTORY_SORT.format('quantity', 'desc', 2))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([3, 2], [prod_info[PROD_ID] for prod_info in json.loads(response.data)])
+        response = self.app.get(PATH_INVENTORY_SORT.format('restock_distance', 'asc', 5))
+        self.assertEqual([1, 2], [prod_info[PROD_ID] for prod_info in json.loads(response.data)])
+        response = self.app.get(PATH_INVENTORY_SORT.format('prod_id', 'desc', 5) + '&condition=new')
+        self.assertEqual([3, 2, 1], [prod_info[PROD_ID] for prod_info in json.loads(response.data)])
+
+        response = self.app.get(PATH_INVENTORY_SORT.format('version', 'asc', 5))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.get(PATH_INVENTORY_SORT.format('quantity', 'up', 5))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.get(PATH_INVENTORY_SORT.format('quantity', 'asc', 5) + '&after=1')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_sparse_fields(self):
+        """ Return only the requested fields """
+        response = self.app.get(PATH_INVENTORY_FIELDS.format('prod_id,prod_name'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([{PROD_ID: 1, PROD_NAME: 'a'}, {PROD_ID: 2, PROD_NAME: 'b'}],
+                         json.loads(response.data))
+        response = self.app.get(PATH_INVENTORY_FIELDS.format('used_qty') + '&sort=quantity&order=desc')
+        self.assertEqual([{USED_QTY: 2}, {USED_QTY: 1}], json.loads(response.data))
+        response = self.app.get(PATH_INVENTORY_PROD_ID_FIELDS.format(1, 'new_qty'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({NEW_QTY: 11}, json.loads(response.data))
+        self.assertEqual('"1"', response.headers.get('ETag'))
+
+        response = self.app.get(PATH_INVENTORY_FIELDS.format('version'))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.get(PATH_INVENTORY_PROD_ID_FIELDS.format(1, ''))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_multi_get(self):
+        """ Fetch products by a list of ids in the requested order """
+        response = self.app.get(PATH_INVENTORY_IDS.format('2,5,1,2'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        data = json.loads(response.data)
+        self.assertEqual([2, 1], [prod_info[PROD_ID] for prod_info in data['products']])
+        self.assertEqual([5], data['missing'])
+        response = self.app.get(PATH_INVENTORY_IDS.format('1,2') + '&fields=new_qty',
+                                headers={'Accept': COLUMNAR_JSON})
+        self.assertEqual({'products': {NEW_QTY: [11, 22]}, 'missing': []}, json.loads(response.data))
+
+        response = self.app.post(PATH_LOOKUP, data=json.dumps({'ids': [7, 1]}), content_type=JSON)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        data = json.loads(response.data)
+        self.assertEqual([1], [prod_info[PROD_ID] for prod_info in data['products']])
+        self.assertEqual([7], data['missing'])
+
+        response = self.app.get(PATH_INVENTORY_IDS.format('1,a'))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.get(PATH_INVENTORY_IDS.format('1') + '&prod_name=a')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.get(PATH_INVENTORY_IDS.format(','.join(str(i) for i in range(1001))))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.post(PATH_LOOKUP, data=json.dumps({'ids': ['1']}), content_type=JSON)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.post(PATH_LOOKUP, data=json.dumps([1]), content_type=JSON)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
     def test_query_by_invalid_parameters(self):
         """ Query by invalid parameters (A bad request error is expected.) """
         # Product name
@@ -326,6 +825,285 @@ class TestInventoryServer(unittest.TestCase):
         response = self.app.get(PATH_INVENTORY_QUERY_BY_QUANTITY.format('a'))
         self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
 
+    def test_query_changes(self):
+        """ Pull the change feed page by page """
+        self.app.delete(PATH_INVENTORY_PROD_ID.format(1), content_type=JSON)
+        self.app.put(PATH_RESTOCK.format(2), data=json.dumps({RESTOCK_AMT: 5}), content_type=JSON)
+
+        response = self.app.get(PATH_CHANGES.format(0, 1))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        data = json.loads(response.data)
+        self.assertTrue(data['has_more'])
+        self.assertEqual(1, len(data['changes']))
+        self.assertEqual(1, data['changes'][0][PROD_ID])
+        self.assertTrue(data['changes'][0]['deleted'])
+        self.assertIsNone(data['changes'][0]['data'])
+
+        response = self.app.get(PATH_CHANGES.format(data['next_since'], 1))
+        data = json.loads(response.data)
+        self.assertFalse(data['has_more'])
+        self.assertEqual(2, data['changes'][0][PROD_ID])
+        self.assertEqual(27, data['changes'][0]['data'][NEW_QTY])
+
+        response = self.app.get(PATH_CHANGES.format(data['next_since'], 1))
+        data = json.loads(response.data)
+        self.assertEqual([], data['changes'])
+
+        response = self.app.get(PATH_CHANGES.format(-1, 1))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.get(PATH_CHANGES.format(0, 'a'))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_query_movements(self):
+        """ Read the stock ledger of a product page by page """
+        self.app.put(PATH_RESTOCK.format(2), data=json.dumps({RESTOCK_AMT: 5}), content_type=JSON)
+
+        response = self.app.get(PATH_MOVEMENTS.format(2, 0, 3))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        data = json.loads(response.data)
+        self.assertTrue(data['has_more'])
+        self.assertEqual([('new', 2, 'create'), ('open-boxed', 2, 'create'),
+                          ('used', 2, 'create')],
+                         [(movement['condition'], movement['delta'], movement['reason'])
+                          for movement in data['movements']])
+        response = self.app.get(PATH_MOVEMENTS.format(2, data['next_since'], 3))
+        data = json.loads(response.data)
+        self.assertFalse(data['has_more'])
+        self.assertEqual([('new', 20, 'automatic_restock'), ('new', 5, 'restock')],
+                         [(movement['condition'], movement['delta'], movement['reason'])
+                          for movement in data['movements']])
+
+        # the history outlives the product, and adds up to nothing once it is deleted
+        self.app.delete(PATH_INVENTORY_PROD_ID.format(2), content_type=JSON)
+        movements = json.loads(self.app.get(PATH_MOVEMENTS.format(2, 0, 100)).data)['movements']
+        self.assertEqual(['delete'] * 3, [movement['reason'] for movement in movements[-3:]])
+        self.assertEqual(0, sum(movement['delta'] for movement in movements))
+
+        response = self.app.get(PATH_MOVEMENTS.format(2, -1, 1))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.app.get(PATH_MOVEMENTS.format(2, 0, 1001))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_stream_events(self):
+        """ Resume the event stream and receive live changes """
+        response = self.app.get(PATH_EVENTS.format(2), headers={'Last-Event-ID': '0'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('text/event-stream', response.mimetype)
+        stream = iter(response.response)
+        try:
+            # the creation of product 1 is filtered out
+            message = next(stream)
+            self.assertIn('event: create', message)
+            data = json.loads(message.split('data: ')[1])
+            self.assertEqual(2, data[PROD_ID])
+
+            self.app.put(PATH_RESTOCK.format(1), data=json.dumps({RESTOCK_AMT: 5}),
+                         content_type=JSON)
+            self.app.put(PATH_RESTOCK.format(2), data=json.dumps({RESTOCK_AMT: 5}),
+                         content_type=JSON)
+            message = next(stream)
+            self.assertIn('event: restock', message)
+            data = json.loads(message.split('data: ')[1])
+            self.assertEqual(27, data['data'][NEW_QTY])
+        finally:
+            response.close()
+            server.broker.stop()
+
+        response = self.app.get(PATH_EVENTS.format('a'))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_update_with_if_match(self):
+        """ Update and restock only when If-Match matches the current version """
+        response = self.app.get(PATH_INVENTORY_PROD_ID.format(1))
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+
+        data = json.dumps({PROD_NAME: 'zen'})
+        response = self.app.put(PATH_INVENTORY_PROD_ID.format(1), data=data, content_type=JSON,
+                                headers={'If-Match': etag})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        new_etag = response.headers.get('ETag')
+        self.assertNotEqual(etag, new_etag)
+
+        # the old version no longer matches
+        response = self.app.put(PATH_INVENTORY_PROD_ID.format(1), data=data, content_type=JSON,
+                                headers={'If-Match': etag})
+        self.assertEqual(status.HTTP_412_PRECONDITION_FAILED, response.status_code)
+        response = self.app.put(PATH_RESTOCK.format(1), data=json.dumps({RESTOCK_AMT: 5}),
+                                content_type=JSON, headers={'If-Match': etag})
+        self.assertEqual(status.HTTP_412_PRECONDITION_FAILED, response.status_code)
+
+        response = self.app.put(PATH_RESTOCK.format(1), data=json.dumps({RESTOCK_AMT: 5}),
+                                content_type=JSON, headers={'If-Match': new_etag})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        response = self.app.put(PATH_RESTOCK.format(1), data=json.dumps({RESTOCK_AMT: 5}),
+                                content_type=JSON, headers={'If-Match': '*'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+    @sql_only
+    def test_hot_restock(self):
+        """ Restocks of a hot product go to its counters until they are folded """
+        server.app.config['HOT_WRITE_RATE'] = 2
+        server.app.config['HOT_WRITE_WINDOW'] = 60
+        server.app.config['HOT_FOLD_INTERVAL'] = None
+        server.hot_products.rates = {}
+        try:
+            etags = []
+            for _ in range(3):
+                response = self.app.put(PATH_RESTOCK.format(1), data=json.dumps({RESTOCK_AMT: 5}),
+                                        content_type=JSON)
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                etags.append(response.headers.get('ETag'))
+            # the second restock turns the product hot, the row version stays
+            self.assertEqual(['"2"', '"2.5"', '"2.10"'], etags)
+            self.assertEqual(26, json.loads(response.data)[NEW_QTY])
+            response = self.app.get(PATH_INVENTORY_PROD_ID.format(1))
+            self.assertEqual(26, json.loads(response.data)[NEW_QTY])
+            self.assertEqual('"2.10"', response.headers.get('ETag'))
+            data = json.loads(self.app.get(PATH_INVENTORY).data)
+            self.assertEqual([26, 22], [prod_info[NEW_QTY] for prod_info in data])
+
+            self.assertEqual(1, server.hot_products.fold())
+            response = self.app.get(PATH_INVENTORY_PROD_ID.format(1))
+            self.assertEqual(26, json.loads(response.data)[NEW_QTY])
+            self.assertEqual('"3"', response.headers.get('ETag'))
+            changes = json.loads(self.app.get(PATH_CHANGES.format(3, 10)).data)['changes']
+            self.assertEqual([('restock', 26)], [(change['change_type'], change['data'][NEW_QTY])
+                                                 for change in changes])
+
+            # after a quiet window the restocks write the row again
+            server.hot_products.rates[1][0] -= 120
+            response = self.app.put(PATH_RESTOCK.format(1), data=json.dumps({RESTOCK_AMT: 5}),
+                                    content_type=JSON)
+            self.assertEqual('"4"', response.headers.get('ETag'))
+            self.assertEqual(31, json.loads(response.data)[NEW_QTY])
+        finally:
+            server.app.config['HOT_WRITE_RATE'] = 50
+            server.app.config['HOT_WRITE_WINDOW'] = 1.0
+            server.app.config['HOT_FOLD_INTERVAL'] = 1.0
+            server.hot_products.rates = {}
+
+    def test_reservations(self):
+        """ Hold products for a checkout, then confirm, release or let them expire """
+        server.app.config['RESERVATION_SWEEP_INTERVAL'] = None
+        try:
+            response = self.app.post(PATH_RESERVATIONS.format(1),
+                                     data=json.dumps({'quantity': 10}), content_type=JSON)
+            self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+            reservation = json.loads(response.data)
+            self.assertEqual(('held', 'new', 10), (reservation['status'], reservation['condition'],
+                                                   reservation['quantity']))
+            data = json.loads(self.app.get(PATH_INVENTORY_PROD_ID.format(1)).data)
+            self.assertEqual((11, 1), (data[NEW_QTY], data['available_new_qty']))
+            response = self.app.put(PATH_INVENTORY_PROD_ID.format(1),
+                                    data=json.dumps({NEW_QTY: 5}), content_type=JSON)
+            self.assertEqual(status.HTTP_409_CONFLICT, response.status_code)
+            data = json.loads(self.app.get(PATH_INVENTORY_PROD_ID.format(1)).data)
+            self.assertEqual(11, data[NEW_QTY])
+
+            response = self.app.post(PATH_RESERVATIONS.format(1),
+                                     data=json.dumps({'quantity': 2}), content_type=JSON)
+            self.assertEqual(status.HTTP_409_CONFLICT, response.status_code)
+            response = self.app.post(PATH_RESERVATIONS.format(9),
+                                     data=json.dumps({'quantity': 1}), content_type=JSON)
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+            for data in [{'quantity': 0}, {'quantity': 'a'}, {'quantity': 1, 'condition': 'old'},
+                         {'quantity': 1, 'ttl': 0}, {'quantity': 1, 'note': 'x'}, [1]]:
+                response = self.app.post(PATH_RESERVATIONS.format(1), data=json.dumps(data),
+                                         content_type=JSON)
+                self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+            # every error of a body is reported at once
+            response = self.app.post(PATH_RESERVATIONS.format(1), content_type=JSON,
+                                     data=json.dumps({'quantity': 0, 'condition': 'old',
+                                                      'ttl': 10 ** 9}))
+            self.assertEqual('Invalid reservation: quantity must be an integer of at least 1, '
+                             'condition must be one of new, open-boxed, used, '
+                             'ttl must be more than 0 and at most 86400 seconds',
+                             json.loads(response.data)['message'])
+
+            # confirming takes the products out, which triggers the automatic restock
+            path = PATH_RESERVATION.format(1, reservation['reservation_id'], 'confirm')
+            response = self.app.post(path)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertEqual('confirmed', json.loads(response.data)['status'])
+            data = json.loads(self.app.get(PATH_INVENTORY_PROD_ID.format(1)).data)
+            self.assertEqual((11, 11), (data[NEW_QTY], data['available_new_qty']))
+            self.assertEqual(status.HTTP_409_CONFLICT, self.app.post(path).status_code)
+            response = self.app.post(PATH_RESERVATION.format(2, reservation['reservation_id'],
+                                                             'release'))
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+            response = self.app.post(PATH_RESERVATIONS.format(2),
+                                     data=json.dumps({'quantity': 2, 'condition': 'used'}),
+                                     content_type=JSON)
+            path = PATH_RESERVATION.format(2, json.loads(response.data)['reservation_id'],
+                                           'release')
+            self.assertEqual('released', json.loads(self.app.post(path).data)['status'])
+            data = json.loads(self.app.get(PATH_INVENTORY_PROD_ID.format(2)).data)
+            self.assertEqual(2, data['available_used_qty'])
+
+            self.app.post(PATH_RESERVATIONS.format(2),
+                          data=json.dumps({'quantity': 2, 'condition': 'open-boxed', 'ttl': 0.01}),
+                          content_type=JSON)
+            data = json.loads(self.app.get(PATH_INVENTORY_PROD_ID.format(2)).data)
+            self.assertEqual(0, data['available_open_boxed_qty'])
+            time.sleep(0.02)
+            self.assertEqual(1, server.sweeper.sweep())
+            data = json.loads(self.app.get(PATH_INVENTORY_PROD_ID.format(2)).data)
+            self.assertEqual(2, data['available_open_boxed_qty'])
+        finally:
+            server.app.config['RESERVATION_SWEEP_INTERVAL'] = 1.0
+
+    @sql_only
+    def test_read_from_replicas(self):
+        """ Reads go to the replicas until the client writes """
+        replica_dir = tempfile.mkdtemp()
+        replica_uris = ['sqlite:///' + os.path.join(replica_dir, name)
+                        for name in ['replica0.db', 'replica1.db']]
+        server.app.config['SQLALCHEMY_REPLICA_URIS'] = replica_uris
+        db.session.remove()
+        try:
+            # the replicas have only replicated product 1 so far
+            for engine in db.get_replica_engines(server.app):
+                db.Model.metadata.create_all(engine)
+                engine.execute(ProductInformation.__table__.insert().values(
+                    prod_id=1, prod_name='a', version=1))
+
+            for _ in replica_uris:
+                response = self.app.get(PATH_INVENTORY)
+                self.assertEqual(1, len(json.loads(response.data)))
+                response = self.app.get(PATH_INVENTORY_PROD_ID.format(2))
+                self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+            # a session reads everything from the replica it picked first
+            with server.app.test_request_context():
+                g.use_replica = True
+                session = db.session()
+                engine = session.get_bind()
+                self.assertIn(engine, db.get_replica_engines(server.app))
+                self.assertIs(engine, session.get_bind())
+                # except for the reads that must not fall behind
+                with on_primary():
+                    self.assertNotIn(session.get_bind(), db.get_replica_engines(server.app))
+                self.assertIs(engine, session.get_bind())
+                session.close()
+                self.assertNotIn('replica', session.info)
+                db.session.remove()
+
+            # the client reads its own writes from the primary
+            data = json.dumps({PROD_ID: 3, PROD_NAME: 'c'})
+            response = self.app.post(PATH_INVENTORY, data=data, content_type=JSON)
+            self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+            response = self.app.get(PATH_INVENTORY_PROD_ID.format(3))
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            response = self.app.get(PATH_INVENTORY)
+            self.assertEqual(3, len(json.loads(response.data)))
+        finally:
+            for engine in db.get_replica_engines(server.app):
+                engine.dispose()
+            server.app.config['SQLALCHEMY_REPLICA_URIS'] = []
+            shutil.rmtree(replica_dir)
+
 
 ######################################################################
 # Utility functions